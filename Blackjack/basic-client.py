@@ -111,7 +111,7 @@ def RunClient(ip: str, my_name: str, token = None):
             token = noun
             send_to_server(sock, "LOGIN " + token)
         elif verb == "OK":
-            continue
+            pass
         elif verb == "READY":
             nouns = noun.split(" ")
             my_money = int(nouns[0])
@@ -0,0 +1,273 @@
+#!/usr/bin/python3
+"""Basic strategy tables for this server's rules, worked out from evsolver's expected values rather than copied from a
+published chart - the charts assume rules this server doesn't have (doubles on any two cards, no resplitting of aces,
+blackjack after a split, insurance paying 2:1).
+
+There is one table per deck count, since the server deals from max(MINIMUM_DECKS, round(players / 8)) decks, plus one
+for an infinite shoe.  A table holds the rows of a POLICY line (see Communications Format.txt) - H<total>, S<total> and
+P<rank>, a letter per dealer upcard 2-9, T, A - along with the insurance decision and the expected return per hand of
+playing it.  Each row is the play with the best expected value averaged over the two card hands it's looked up for,
+each with its own cards gone from the shoe, and the same row is used for any longer hand with that total.
+
+    basicstrategy.py --output strategy        Write strategy.json and strategy.bin for 1-16 decks and an infinite shoe.
+    basicstrategy.py --chart 6                Print the 6 deck chart.
+    basicstrategy.py --policy 6               Print the 6 deck table as a POLICY line, ready to send.
+
+The binary file is for clients that want the table without parsing anything:
+
+    magic       4s  b"BJBS".
+    rows        H   Rows per table - len(ROWS), in that order.
+    tables      H   Tables that follow, each:
+        decks       H   0 for the infinite shoe.
+        ev          d   Expected return per hand, in bets.
+        insurance   c   Y or N.
+        actions     rows * 10 bytes, one ASCII letter per row and upcard.
+
+all little endian.  load() reads it back into StrategyTables, where action() is a single index into the bytes.
+"server.py --check-strategy strategy.json" plays each table through the server's own Policy, hand_value and
+Player.Settle and checks the return comes out where the table says it will."""
+import json
+import struct
+import argparse
+import evsolver
+
+UPCARDS = "23456789TA"      # POLICY row order.
+ROWS = tuple(["H" + str(t) for t in range(4, 21)] + ["S" + str(t) for t in range(12, 21)] +
+             ["P" + r for r in "23456789TA"])
+ROW_INDEX = {key: i for (i, key) in enumerate(ROWS)}
+LETTERS = {"HIT": "H", "STAND": "S", "DOUBLE": "D", "SPLIT": "P"}
+FILE_MAGIC = b"BJBS"
+FILE_HEADER = struct.Struct("<4sHH")
+TABLE_HEADER = struct.Struct("<Hdc")
+
+
+def shoe(decks: int) -> tuple:
+    """Card counts by evsolver rank index for a shoe of decks, or the proportions of an infinite shoe for decks 0."""
+    return evsolver.composition(decks) if decks > 0 else (1,) * 9 + (4,)
+
+
+def two_card_hands(decks: int, upcard: int) -> list:
+    """Every two card hand the player can be dealt against upcard, as (ranks, chance)."""
+    left = list(shoe(decks))
+    used = 1 if decks > 0 else 0        # An infinite shoe doesn't run short of what's been dealt.
+    left[upcard] -= used
+    total = sum(left)
+    ret = []
+    for a in range(10):
+        for b in range(a, 10):
+            chance = left[a] / total * (left[b] - (used if a == b else 0)) / (total - used)
+            if a != b:
+                chance *= 2.0
+            if chance > 0.0:
+                ret.append(((a, b), chance))
+    return ret
+
+
+def situation(ranks: tuple, upcard: int, decks: int) -> evsolver.Situation:
+    """The evsolver Situation for a first hand of ranks against upcard - the same shoe evsolver.action_evs uses."""
+    if decks > 0:
+        return evsolver.Situation(upcard, evsolver.composition(decks, ranks + (upcard,)))
+    return evsolver.Situation(upcard, shoe(0))
+
+
+def evs(ranks: tuple, upcard: int, decks: int) -> dict:
+    """The value of each verb the server would accept for a first hand of ranks against upcard."""
+    if decks > 0:
+        return evsolver.action_evs(ranks, upcard, decks, 1, True)
+    return situation(ranks, upcard, decks).choices(list(ranks), 1)
+
+
+def row_key(ranks: tuple) -> str:
+    """The POLICY row a two card hand is looked up by when it isn't split."""
+    hard = sum(evsolver.VALUES[r] for r in ranks)
+    v = evsolver.value(hard, 0 in ranks)
+    return ("S" if v != hard else "H") + str(v)
+
+
+def pair_key(ranks: tuple) -> str:
+    return "P" + evsolver.RANKS[ranks[0]] if ranks[0] == ranks[1] else None
+
+
+def played(choices: dict, letter: str) -> float:
+    """The value of the verb the server plays for a POLICY letter."""
+    if letter == "P" and "SPLIT" in choices:
+        return choices["SPLIT"]
+    if letter == "D":
+        return choices.get("DOUBLE", choices["HIT"])
+    return choices["STAND" if letter == "S" or len(choices) == 1 else "HIT"]
+
+
+def best_letter(values: dict) -> str:
+    return LETTERS[max(values, key=values.get)]
+
+
+class StrategyTable:
+    """One deck count's table.  actions is len(ROWS) * 10 bytes of letters, rows in ROWS order."""
+
+    def __init__(self, decks: int, actions: bytes, insurance: str, ev: float):
+        self.decks = decks
+        self.actions = actions
+        self.insurance = insurance
+        self.ev = ev
+
+    def action(self, key: str, upcard: str) -> str:
+        """The letter for a row (like "H16") against a dealer upcard (a card or rank character)."""
+        up = upcard[0] if upcard[0] in UPCARDS else "T"
+        return chr(self.actions[ROW_INDEX[key] * 10 + UPCARDS.index(up)])
+
+    def row(self, key: str) -> str:
+        i = ROW_INDEX[key] * 10
+        return str(self.actions[i:i + 10], "ascii")
+
+    def policy_line(self) -> str:
+        return "POLICY " + " ".join(key + "=" + self.row(key) for key in ROWS) + " INS=" + self.insurance
+
+    def chart(self) -> list:
+        """Lines of the table laid out like a published chart."""
+        ret = ["{0} decks, expected return {1:+.3%} per hand, insurance {2}".format(
+                   self.decks if self.decks > 0 else "Infinite", self.ev, "yes" if self.insurance == "Y" else "no"),
+               "     " + " ".join(UPCARDS)]
+        for key in ROWS:
+            ret.append("{0:<4} ".format(key) + " ".join(self.row(key)))
+        return ret
+
+
+def solve(decks: int) -> StrategyTable:
+    """Work out the table for a shoe of decks (0 for an infinite one)."""
+    counts = shoe(decks)
+    actions = bytearray(b"-" * (len(ROWS) * 10))
+    ev = 0.0
+    for (col, up_char) in enumerate(UPCARDS):
+        upcard = evsolver.rank_index(up_char)
+        up_chance = counts[upcard] / sum(counts)
+        hands = two_card_hands(decks, upcard)
+
+        # Each total row is the best play on average over the two card hands that get looked up by it - the pairs
+        # only count where nothing else makes the total, as they have rows of their own.
+        totals = {}
+        for (ranks, chance) in hands:
+            choices = evs(ranks, upcard, decks)
+            if len(choices) > 1:
+                totals.setdefault(row_key(ranks), []).append((ranks, chance, choices))
+            if pair_key(ranks) is not None:
+                actions[ROW_INDEX[pair_key(ranks)] * 10 + col] = ord(best_letter(choices))
+        for (key, entries) in totals.items():
+            if any(pair_key(ranks) is None for (ranks, chance, choices) in entries):
+                entries = [e for e in entries if pair_key(e[0]) is None]
+            weight = sum(chance for (ranks, chance, choices) in entries)
+            values = {}
+            for verb in ("HIT", "STAND", "DOUBLE"):
+                if all(verb in choices for (ranks, chance, choices) in entries):
+                    values[verb] = sum(chance * choices[verb] for (ranks, chance, choices) in entries) / weight
+            actions[ROW_INDEX[key] * 10 + col] = ord(best_letter(values))
+
+        # The return of playing the table.  The dealer peeks with an ace up: a blackjack there takes every bet but a
+        # player's blackjack, which pushes.  evsolver's values are for the hands that get past the peek.  Past it (or
+        # with no peek), a player's blackjack pays 3:2 unless the dealer makes 21, which pushes.
+        for (ranks, chance) in hands:
+            choices = evs(ranks, upcard, decks)
+            natural = row_key(ranks) == "S21"
+            dealer_blackjack = 0.0
+            if up_char == "A":
+                if decks > 0:
+                    left = evsolver.composition(decks, ranks + (upcard,))
+                    dealer_blackjack = left[9] / sum(left)
+                else:
+                    dealer_blackjack = counts[9] / sum(counts)
+            if natural:
+                (win, push, loss) = situation(ranks, upcard, decks).outcome(21)
+                value = 1.5 * win
+            else:
+                key = pair_key(ranks)
+                letter = chr(actions[ROW_INDEX[key] * 10 + col]) if key is not None else "-"
+                if letter not in "PHSD" or (letter == "P" and "SPLIT" not in choices):
+                    letter = chr(actions[ROW_INDEX[row_key(ranks)] * 10 + col])
+                value = played(choices, letter)
+            ev += up_chance * chance * ((1.0 - dealer_blackjack) * value - (0.0 if natural else dealer_blackjack))
+
+    # Insurance costs half the bet and, on a dealer blackjack, pays back the bet - worth it only if the hole card is
+    # more likely a ten than not.  Off the top of the shoe, it never is.
+    tens = counts[9] / (sum(counts) - (1 if decks > 0 else 0))
+    return StrategyTable(decks, bytes(actions), "Y" if tens > 0.5 else "N", ev)
+
+
+def save(tables: list, path: str):
+    """Write tables to path + ".json" and path + ".bin"."""
+    doc = {"upcards": UPCARDS,
+           "tables": {str(t.decks) if t.decks > 0 else "infinite":
+                      {"ev": round(t.ev, 6), "insurance": t.insurance, "rows": {key: t.row(key) for key in ROWS}}
+                      for t in tables}}
+    with open(path + ".json", "w") as f:
+        json.dump(doc, f, indent=1)
+    with open(path + ".bin", "wb") as f:
+        f.write(FILE_HEADER.pack(FILE_MAGIC, len(ROWS), len(tables)))
+        for t in tables:
+            f.write(TABLE_HEADER.pack(t.decks, t.ev, bytes(t.insurance, "ascii")) + t.actions)
+
+
+def load(path: str) -> dict:
+    """Read a .bin or .json file written by save().  Returns {decks: StrategyTable}, with the infinite shoe's table
+    under 0."""
+    ret = {}
+    if path.endswith(".json"):
+        with open(path) as f:
+            doc = json.load(f)
+        for (decks, t) in doc["tables"].items():
+            actions = bytes("".join(t["rows"][key] for key in ROWS), "ascii")
+            n = 0 if decks == "infinite" else int(decks)
+            ret[n] = StrategyTable(n, actions, t["insurance"], t["ev"])
+        return ret
+    with open(path, "rb") as f:
+        data = f.read()
+    (magic, rows, count) = FILE_HEADER.unpack_from(data, 0)
+    if magic != FILE_MAGIC or rows != len(ROWS):
+        raise ValueError(path + " is not a strategy file for this version of basicstrategy.py.")
+    pos = FILE_HEADER.size
+    for i in range(count):
+        (decks, ev, insurance) = TABLE_HEADER.unpack_from(data, pos)
+        pos += TABLE_HEADER.size
+        ret[decks] = StrategyTable(decks, data[pos:pos + rows * 10], str(insurance, "ascii"), ev)
+        pos += rows * 10
+    return ret
+
+
+def table_for(tables: dict, decks: int) -> StrategyTable:
+    """The table for a shoe of decks - the nearest one there is, or the infinite shoe's past the last of them."""
+    finite = sorted(d for d in tables if d > 0)
+    if decks in tables:
+        return tables[decks]
+    if 0 in tables and (len(finite) == 0 or decks > finite[-1]):
+        return tables[0]
+    return tables[min(finite, key=lambda d: abs(d - decks))]
+
+
+def parse_decks(text: str) -> list:
+    """ "1-8,12" -> [1, 2, ..., 8, 12]"""
+    ret = []
+    for part in text.split(","):
+        (low, dash, high) = part.partition("-")
+        ret += list(range(int(low), int(high or low) + 1))
+    return ret
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Work out basic strategy tables for the server's rules.")
+    parser.add_argument("--decks", default="1-16", help="Deck counts to make tables for, like 1-8,12 (default 1-16).")
+    parser.add_argument("--no-infinite", action="store_true", help="Leave out the infinite shoe's table.")
+    parser.add_argument("--output", help="Write the tables to OUTPUT.json and OUTPUT.bin.")
+    parser.add_argument("--chart", type=int, metavar="DECKS", help="Print the table for DECKS (0 for infinite).")
+    parser.add_argument("--policy", type=int, metavar="DECKS", help="Print the table for DECKS as a POLICY line.")
+    args = parser.parse_args()
+    if args.chart is not None or args.policy is not None:
+        for decks in (args.chart, args.policy):
+            if decks is None:
+                continue
+            t = solve(decks)
+            print("\n".join(t.chart()) if decks == args.chart else t.policy_line())
+    else:
+        tables = [solve(d) for d in parse_decks(args.decks)] + ([] if args.no_infinite else [solve(0)])
+        for t in tables:
+            print("{0:>8} decks: return {1:+.3%}, insurance {2}".format(
+                t.decks if t.decks > 0 else "Infinite", t.ev, t.insurance))
+        if args.output is not None:
+            save(tables, args.output)
@@ -0,0 +1,204 @@
+#!/usr/bin/python3
+"""Compact binary encoding of the Blackjack protocol ("BIN1").
+
+The server offers it by ending its HELLO with BIN1.  A client opts in by adding BIN1 to its LOGIN line:
+    C:LOGIN f5db0a04b3aed563e57d1fad8374483f BIN1
+    S:OK
+The OK is still plain text.  Everything after it, in both directions, is a frame: a varint payload length, then the
+payload - a one byte opcode and a verb-specific body.
+
+Cards are one byte each (rank * 4 + suit, 0xFF for a face down card).  A table (as sent with ACT, INSURANCE and DONE) is
+a varint seat count, then for each seat a varint hand count and for each hand a header byte (card count << 2 | status,
+status 0 = in play, 1 = '.', 2 = '+') followed by its cards.  A seat sitting out has zero hands.  The dealer is a seat
+like any other, second in the list as in the text protocol.
+
+The functions here turn text protocol lines into frames and back, so both ends can keep working in text lines."""
+
+CAPABILITY = "BIN1"
+
+RANKS = "A23456789TJQK"
+SUITS = "CHDS"
+HIDDEN_CARD = 0xFF
+STATUS_CHARS = ("", ".", "+")
+
+# Opcode 0 carries any line we have no compact encoding for as UTF-8 text.
+OP_TEXT = 0
+SERVER_OPCODES = {"HELLO": 1, "TOKEN": 2, "OK": 3, "READY": 4, "INSURANCE": 5, "ACT": 6, "DONE": 7, "TIMEOUT": 8,
+                  "INVALID": 9, "BYE": 10}
+CLIENT_OPCODES = {"BET": 1, "HIT": 2, "STAND": 3, "DOUBLE": 4, "SPLIT": 5, "YES": 6, "NO": 7}
+SERVER_VERBS = {v: k for k, v in SERVER_OPCODES.items()}
+CLIENT_VERBS = {v: k for k, v in CLIENT_OPCODES.items()}
+
+
+def encode_varint(n: int) -> bytes:
+    ret = bytearray()
+    while n >= 0x80:
+        ret.append((n & 0x7F) | 0x80)
+        n >>= 7
+    ret.append(n)
+    return bytes(ret)
+
+
+def decode_varint(data: bytes, pos: int) -> (int, int):
+    """Decode a varint starting at pos.  Returns (value, position after it)."""
+    ret = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        ret |= (b & 0x7F) << shift
+        if b < 0x80:
+            return (ret, pos)
+        shift += 7
+
+
+def encode_signed(n: int) -> bytes:
+    return encode_varint(n * 2 if n >= 0 else -n * 2 - 1)
+
+
+def decode_signed(data: bytes, pos: int) -> (int, int):
+    (n, pos) = decode_varint(data, pos)
+    return ((n >> 1) if n % 2 == 0 else -((n + 1) >> 1), pos)
+
+
+def encode_card(card: str) -> int:
+    if card[0] not in RANKS:
+        return HIDDEN_CARD
+    return RANKS.index(card[0]) * 4 + SUITS.index(card[1])
+
+
+def decode_card(b: int) -> str:
+    if b == HIDDEN_CARD:
+        return "--"
+    return RANKS[b // 4] + SUITS[b % 4]
+
+
+def encode_table(table: str) -> bytes:
+    """Encode a table string such as "9STH/9D2S AC-- 2S4D. ----"."""
+    seats = table.split(" ")
+    ret = bytearray(encode_varint(len(seats)))
+    for seat in seats:
+        if seat == "----":
+            ret.append(0)
+            continue
+        hands = seat.split("/")
+        ret += encode_varint(len(hands))
+        for h in hands:
+            status = STATUS_CHARS.index(h[-1]) if len(h) % 2 == 1 else 0
+            cards = len(h) // 2
+            ret.append(cards << 2 | status)
+            ret += bytes(encode_card(h[i * 2:i * 2 + 2]) for i in range(0, cards))
+    return bytes(ret)
+
+
+def decode_table(data: bytes, pos: int) -> (str, int):
+    """Decode a table encoded by encode_table.  Returns (table string, position after it)."""
+    (count, pos) = decode_varint(data, pos)
+    seats = []
+    for i in range(0, count):
+        (num_hands, pos) = decode_varint(data, pos)
+        if num_hands == 0:
+            seats.append("----")
+            continue
+        hands = []
+        for j in range(0, num_hands):
+            header = data[pos]
+            cards = header >> 2
+            hands.append("".join(decode_card(b) for b in data[pos + 1:pos + 1 + cards]) + STATUS_CHARS[header & 3])
+            pos += 1 + cards
+        seats.append("/".join(hands))
+    return (" ".join(seats), pos)
+
+
+def frame(payload: bytes) -> bytes:
+    return encode_varint(len(payload)) + payload
+
+
+def split_frame(buf: bytes) -> (bytes, bytes):
+    """Pull the first complete frame out of buf.  Returns (payload, rest of buf), or (None, buf) if buf doesn't hold a
+    whole frame yet."""
+    length = 0
+    shift = 0
+    for pos in range(0, len(buf)):
+        length |= (buf[pos] & 0x7F) << shift
+        shift += 7
+        if buf[pos] < 0x80:
+            end = pos + 1 + length
+            if end > len(buf):
+                return (None, buf)
+            return (bytes(buf[pos + 1:end]), buf[end:])
+    return (None, buf)
+
+
+def encode_text(line: str) -> bytes:
+    return frame(bytes([OP_TEXT]) + bytes(line, "utf-8"))
+
+
+def encode_server(line: str) -> bytes:
+    """Encode a line the server would have sent in the text protocol."""
+    (verb, _, noun) = line.partition(" ")
+    op = SERVER_OPCODES.get(verb)
+    try:
+        if verb == "READY":
+            body = b"".join(encode_varint(int(n)) for n in noun.split(" "))
+        elif verb in ("ACT", "INSURANCE"):
+            body = encode_table(noun)
+        elif verb == "DONE":
+            (table, _, amount) = noun.rpartition(":")
+            body = encode_table(table) + encode_signed(int(amount))
+        elif op is not None:
+            body = bytes(noun, "utf-8")
+        else:
+            return encode_text(line)
+    except (ValueError, IndexError):
+        return encode_text(line)
+    return frame(bytes([op]) + body)
+
+
+def decode_server(payload: bytes) -> str:
+    """Turn a server frame's payload back into the text protocol line."""
+    op = payload[0]
+    verb = SERVER_VERBS.get(op)
+    if verb is None:
+        return str(payload[1:], "utf-8")
+    if verb == "READY":
+        nums = []
+        pos = 1
+        while pos < len(payload):
+            (n, pos) = decode_varint(payload, pos)
+            nums.append(str(n))
+        return "READY " + " ".join(nums)
+    if verb in ("ACT", "INSURANCE"):
+        return verb + " " + decode_table(payload, 1)[0]
+    if verb == "DONE":
+        (table, pos) = decode_table(payload, 1)
+        return "DONE " + table + ":" + str(decode_signed(payload, pos)[0])
+    if len(payload) == 1:
+        return verb
+    return verb + " " + str(payload[1:], "utf-8")
+
+
+def encode_client(line: str) -> bytes:
+    """Encode a line a client would have sent in the text protocol."""
+    (verb, _, noun) = line.partition(" ")
+    op = CLIENT_OPCODES.get(verb.upper())
+    if op is None:
+        return encode_text(line)
+    if verb.upper() == "BET":
+        try:
+            return frame(bytes([op]) + encode_varint(int(noun)))
+        except ValueError:
+            return encode_text(line)
+    return frame(bytes([op]))
+
+
+def decode_client(payload: bytes) -> str:
+    """Turn a client frame's payload back into the text protocol line."""
+    if len(payload) == 0:
+        return ""
+    verb = CLIENT_VERBS.get(payload[0])
+    if verb is None:
+        return str(payload[1:], "utf-8", "replace")
+    if verb == "BET":
+        return "BET " + str(decode_varint(payload, 1)[0])
+    return verb
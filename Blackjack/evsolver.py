@@ -0,0 +1,206 @@
+#!/usr/bin/python3
+"""Expected values of blackjack decisions under this server's rules, for scoring how well clients play.
+
+The rules, as server.py deals and settles them:
+- The dealer stands on all 17s, soft 17 included.  With an ace up the dealer peeks, so a hand that gets an ACT is
+  facing a dealer without blackjack.  With a ten up there is no peek, and a dealer blackjack is settled as a plain 21.
+- DOUBLE is allowed on any two cards totalling 9 to 11, split hands included, and draws exactly one card.  A doubled
+  hand that pushes only gets one bet back.
+- SPLIT is allowed on any two cards of the same value while holding four hands or fewer, and split hands play on as
+  usual (split aces too).  A two card 21 after a split is a plain 21.
+- Hands reaching 21 or more stand automatically.
+
+Values are in bets (the hand's original bet).  Cards are drawn from a shoe of the table's decks less the cards the
+player can see that matter most - their own hand and the dealer's up card - and that composition is held fixed for
+the rest of the hand.  That is what makes it cheap: the dealer's outcomes are solved once per composition and
+memoized, and the player's hit/stand/double/split values are a small recursion on top."""
+import os
+import signal
+import threading
+import time
+from functools import lru_cache
+
+RANKS = "A23456789T"
+VALUES = (1, 2, 3, 4, 5, 6, 7, 8, 9, 10)    # By index into RANKS.
+DEALER_FINALS = (17, 18, 19, 20, 21)        # Dealer outcomes, in order, followed by a bust.
+MAX_SPLIT_HANDS = 4         # Splitting is allowed while holding this many hands or fewer.
+MISTAKE_EPSILON = 1e-6      # EV differences smaller than this (in bets) are ties, not mistakes.
+
+
+def rank_index(card: str) -> int:
+    """Index into RANKS for a card or rank character - J, Q and K count as T."""
+    return RANKS.find(card[0]) if card[0] in RANKS else 9
+
+
+def hand_ranks(hand: str) -> list:
+    """The rank indexes of a hand string as the server writes them ("9STH" -> [8, 9]), ignoring the '.' and '+'
+    markers."""
+    return [rank_index(hand[i]) for i in range(0, len(hand) - 1, 2) if hand[i] not in ".+"]
+
+
+def value(hard: int, ace: bool) -> int:
+    """A hand's value, as server.hand_value works it out: one ace counts 11 when that doesn't bust."""
+    return hard + 10 if ace and hard + 10 <= 21 else hard
+
+
+def composition(decks: int, removed: list = ()) -> tuple:
+    """Card counts by rank for a shoe of decks, less the removed rank indexes."""
+    counts = [4 * decks] * 9 + [16 * decks]
+    for r in removed:
+        counts[r] = max(0, counts[r] - 1)
+    return tuple(counts)
+
+
+@lru_cache(maxsize=65536)
+def dealer_outcomes(upcard: int, counts: tuple) -> tuple:
+    """Chances of the dealer finishing on 17, 18, 19, 20, 21 or busting, given the up card and the shoe.  With an ace
+    up, the hand has already been peeked at, so a ten in the hole is ruled out."""
+    total = sum(counts)
+    p = [c / total for c in counts]
+    memo = {}
+
+    def draw(hard: int, ace: bool) -> tuple:
+        v = value(hard, ace)
+        if v >= 17:
+            ret = [0.0] * 6
+            ret[v - 17 if v <= 21 else 5] = 1.0
+            return tuple(ret)
+        if (hard, ace) not in memo:
+            ret = [0.0] * 6
+            for r in range(10):
+                if p[r] > 0.0:
+                    sub = draw(hard + VALUES[r], ace or r == 0)
+                    for i in range(6):
+                        ret[i] += p[r] * sub[i]
+            memo[(hard, ace)] = tuple(ret)
+        return memo[(hard, ace)]
+
+    hole = list(p)
+    if upcard == 0:
+        hole[9] = 0.0
+    norm = sum(hole)
+    ret = [0.0] * 6
+    for r in range(10):
+        if hole[r] > 0.0:
+            sub = draw(VALUES[upcard] + VALUES[r], upcard == 0 or r == 0)
+            for i in range(6):
+                ret[i] += hole[r] / norm * sub[i]
+    return tuple(ret)
+
+
+class Situation:
+    """The values of every play from one shoe composition against one dealer up card."""
+
+    def __init__(self, upcard: int, counts: tuple, affordable: bool = True):
+        total = sum(counts)
+        self.p = [c / total for c in counts]
+        self.dealer = dealer_outcomes(upcard, counts)
+        self.affordable = affordable    # Whether the player has the currency to double and split.
+        self.memo = {}
+
+    def outcome(self, v: int) -> (float, float, float):
+        """Chances of (win, push, loss) standing on v."""
+        if v > 21:
+            return (0.0, 0.0, 1.0)
+        d = self.dealer
+        win = d[5] + sum(d[i] for i in range(5) if DEALER_FINALS[i] < v)
+        push = d[v - 17] if v >= 17 else 0.0
+        return (win, push, 1.0 - win - push)
+
+    def stand(self, v: int) -> float:
+        (win, push, loss) = self.outcome(v)
+        return win - loss
+
+    def doubled(self, v: int) -> float:
+        """Settlement of a doubled hand: two bets won or lost, and a push loses the double."""
+        (win, push, loss) = self.outcome(v)
+        return 2.0 * win - push - 2.0 * loss
+
+    def best(self, hard: int, ace: bool) -> float:
+        """Value of a hand that may only HIT or STAND from here on."""
+        v = value(hard, ace)
+        if v >= 21:
+            return self.stand(v)
+        key = ("B", hard, ace)
+        if key not in self.memo:
+            self.memo[key] = max(self.stand(v), self.hit(hard, ace))
+        return self.memo[key]
+
+    def hit(self, hard: int, ace: bool) -> float:
+        return sum(self.p[r] * self.best(hard + VALUES[r], ace or r == 0) for r in range(10) if self.p[r] > 0.0)
+
+    def double(self, hard: int, ace: bool) -> float:
+        return sum(self.p[r] * self.doubled(value(hard + VALUES[r], ace or r == 0)) for r in range(10)
+                   if self.p[r] > 0.0)
+
+    def split(self, r: int, hands: int) -> float:
+        """Value of splitting a pair of r while holding hands hands: two hands, each dealt a second card and played on
+        (including further splits) while holding one more hand than before."""
+        key = ("P", r, hands)
+        if key not in self.memo:
+            one = 0.0
+            for c in range(10):
+                if self.p[c] > 0.0:
+                    evs = self.choices([r, c], hands + 1)
+                    one += self.p[c] * max(evs.values())
+            self.memo[key] = 2.0 * one
+        return self.memo[key]
+
+    def choices(self, ranks: list, hands: int) -> dict:
+        """The value of each verb the server would accept for a hand of ranks, holding hands hands.  Only STAND when
+        the hand stands automatically."""
+        hard = sum(VALUES[r] for r in ranks)
+        ace = 0 in ranks
+        v = value(hard, ace)
+        if v >= 21:
+            return {"STAND": self.stand(v)}
+        ret = {"HIT": self.hit(hard, ace), "STAND": self.stand(v)}
+        if len(ranks) == 2 and self.affordable:
+            if 9 <= v <= 11:
+                ret["DOUBLE"] = self.double(hard, ace)
+            if VALUES[ranks[0]] == VALUES[ranks[1]] and hands <= MAX_SPLIT_HANDS:
+                ret["SPLIT"] = self.split(ranks[0], hands)
+        return ret
+
+
+@lru_cache(maxsize=65536)
+def action_evs(ranks: tuple, upcard: int, decks: int, hands: int, affordable: bool) -> dict:
+    """The value of each valid verb for a hand (a tuple of rank indexes, sorted so equal hands share an entry) against
+    upcard, with those cards gone from a shoe of decks."""
+    return Situation(upcard, composition(decks, ranks + (upcard,)), affordable).choices(list(ranks), hands)
+
+
+def score_hand(decks: int, upcard: str, seats: list) -> list:
+    """Score one hand's decisions.  seats is a list of (key, bet, decisions), each decision a tuple of (hand string,
+    hands held, whether the player could afford to double or split, verb played).  Returns (key, decisions, mistakes,
+    expected Randy Bucks lost to the best play) for each seat."""
+    up = rank_index(upcard)
+    ret = []
+    for (key, bet, decisions) in seats:
+        mistakes = 0
+        lost = 0.0
+        for (hand, hands, affordable, verb) in decisions:
+            evs = action_evs(tuple(sorted(hand_ranks(hand))), up, decks, hands, affordable)
+            if verb not in evs:
+                continue
+            delta = max(evs.values()) - evs[verb]
+            if delta > MISTAKE_EPSILON:
+                mistakes += 1
+                lost += delta * bet
+        ret.append((key, len(decisions), mistakes, lost))
+    return ret
+
+
+def init_worker(parent: int):
+    """Process pool initializer: leave Ctrl-C and SIGTERM to the server, and exit if the server goes away without
+    shutting the pool down (as it does when it hands off to an upgraded copy).  A worker killed while waiting for a task
+    would take the pool's task queue lock with it, and the server could never shut the pool down."""
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+
+    def watch():
+        while os.getppid() == parent:
+            time.sleep(1.0)
+        os._exit(0)
+
+    threading.Thread(target=watch, daemon=True).start()
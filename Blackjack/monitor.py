@@ -1,4 +1,5 @@
 #!/usr/bin/python3
+from __future__ import annotations
 import time
 import re
 from random import shuffle
@@ -9,7 +10,21 @@ from hashlib import md5
 from pprint import pprint
 from multiprocessing.dummy import Pool as ThreadPool
 import sys
-import pygame
+import threading
+import argparse
+import gzip
+import heapq
+import signal
+import os
+import json
+from collections import deque
+from array import array
+from bisect import bisect_left, bisect_right
+import tablesnapshot
+try:
+    import pygame
+except ImportError:         # Only the graphical monitor needs pygame, --headless runs without it.
+    pygame = None
 
 
 # PyGame defines
@@ -17,17 +32,35 @@ PI = 3.141592653
 TABLE_COLOR     = [  8, 128,  18]
 
 # Globals
+SERVER_PORT = 9876      # Port to find the server (or a relay.py) on.
 CARD_IMAGES = {}
 CARD_IMAGES_R = {}
 WINDOW_WIDTH = 1600
 WINDOW_HEIGHT = 1000
 PLAYERS_PER_ROW = 8
+SEAT_ROWS = (WINDOW_HEIGHT - 40) // 200     # Rows of full seats that fit under the dealer.
+SUMMARY_TOP = 130               # Summary rows start under the dealer's hand and the table stats.
+SUMMARY_ROW_HEIGHT = 18
+SUMMARY_COL_WIDTH = 320
+SUMMARY_BAR_WIDTH = 60
+MAX_FPS = 30            # Cap on how often we redraw.  Bounds the update -> pixels latency to about 1/MAX_FPS seconds.
+CARD_DIR = "cards"
+CARD_SIZE = (75, 108)           # Upright card sprite size.  The double-down sprite is the same, rotated.
+ATLAS_IMAGE = os.path.join(CARD_DIR, "atlas.png")
+ATLAS_INDEX = os.path.join(CARD_DIR, "atlas.json")
+ATLAS_COLUMNS = 14
+HEADLESS_SAMPLE_TIME = 1.0      # How often headless mode looks at the latest table state.
+HEADLESS_WINDOW = 60.0          # Length of the rolling window headless aggregates are computed over.
+SNAPSHOT_POLL_TIME = 0.005      # How often --shared checks the server's snapshot for a new version.
+HISTORY_MB = 64                 # Memory kept for scrubbing back through past table states.
+HISTORY_KEYFRAME_INTERVAL = 64  # States between full copies in the history.  Seeks replay at most this many diffs.
+HISTORY_ENTRY_OVERHEAD = 48     # Rough bytes of bookkeeping per stored state, on top of the data itself.
 
 
 def connect_to_server(ip: str) -> socket:
     # Straight from https://docs.python.org/3/library/socket.html
     s = None
-    for res in socket.getaddrinfo(ip, 9876, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE):
+    for res in socket.getaddrinfo(ip, SERVER_PORT, socket.AF_UNSPEC, socket.SOCK_STREAM, 0, socket.AI_PASSIVE):
         af, socktype, proto, canonname, sa = res
         try:
             s = socket.socket(af, socktype, proto)
@@ -79,15 +112,66 @@ def send_to_server(sock: socket, s: str):
             raise ConnectionError
 
 
-def load_card_images():
-    ci = {}
+def card_sources() -> dict:
+    """Return a dictionary of card sprite name to the source PNG it's made from."""
+    ret = {}
     for suit in ("C", "D", "S", "H"):
         for value in ("A", "2", "3", "4", "5", "6", "7", "8", "9", "T", "J", "Q", "K"):
-            ci[value + suit] = pygame.image.load("cards/" + suit.lower() + value.lower() + ".png").convert_alpha()
-    ci["back"] = pygame.image.load("cards/back.png").convert_alpha()
-    for i in ci.keys():
-        CARD_IMAGES_R[i] = pygame.transform.smoothscale(pygame.transform.rotate(ci[i], 90), (108, 75))
-        CARD_IMAGES[i] = pygame.transform.smoothscale(ci[i], (75, 108))
+            ret[value + suit] = os.path.join(CARD_DIR, suit.lower() + value.lower() + ".png")
+    ret["back"] = os.path.join(CARD_DIR, "back.png")
+    return ret
+
+
+def build_card_atlas(sources: dict) -> (pygame.Surface, dict):
+    """Scale (and rotate, for double downs) every card once, and pack them into a single atlas surface.  Returns the
+    atlas and its index, which maps each sprite name to its [x, y, w, h] rectangle in the atlas.  Upright cards fill
+    the top rows, rotated cards the rows below."""
+    (w, h) = CARD_SIZE
+    rows = (len(sources) + ATLAS_COLUMNS - 1) // ATLAS_COLUMNS
+    atlas = pygame.Surface((ATLAS_COLUMNS * h, rows * h + rows * w), pygame.SRCALPHA, 32)
+    index = {"sources": {}, "upright": {}, "rotated": {}}
+    for i, (name, path) in enumerate(sorted(sources.items())):
+        img = pygame.image.load(path)
+        index["sources"][path] = os.path.getmtime(path)
+        upright = [(i % ATLAS_COLUMNS) * w, (i // ATLAS_COLUMNS) * h, w, h]
+        rotated = [(i % ATLAS_COLUMNS) * h, rows * h + (i // ATLAS_COLUMNS) * w, h, w]
+        atlas.blit(pygame.transform.smoothscale(img, (w, h)), upright[0:2])
+        atlas.blit(pygame.transform.smoothscale(pygame.transform.rotate(img, 90), (h, w)), rotated[0:2])
+        index["upright"][name] = upright
+        index["rotated"][name] = rotated
+    return (atlas, index)
+
+
+def save_card_atlas(atlas: pygame.Surface, index: dict):
+    pygame.image.save(atlas, ATLAS_IMAGE)
+    with open(ATLAS_INDEX, "w") as f:
+        json.dump(index, f)
+
+
+def load_card_images():
+    """Fill CARD_IMAGES and CARD_IMAGES_R from the card atlas.  The atlas is only rebuilt if it's missing or any source
+    PNG's mtime no longer matches what the atlas was built from, so normal starts are one image load."""
+    sources = card_sources()
+    atlas = None
+    try:
+        with open(ATLAS_INDEX) as f:
+            index = json.load(f)
+        if index["sources"] == {p: os.path.getmtime(p) for p in sources.values()}:
+            atlas = pygame.image.load(ATLAS_IMAGE)
+    except (OSError, ValueError, KeyError, pygame.error):
+        pass
+    if atlas is None:
+        print("Building card atlas " + ATLAS_IMAGE)
+        (atlas, index) = build_card_atlas(sources)
+        try:
+            save_card_atlas(atlas, index)
+        except (OSError, pygame.error) as e:
+            print("Could not save card atlas: " + str(e))
+    atlas = atlas.convert_alpha()
+    for name, rect in index["upright"].items():
+        CARD_IMAGES[name] = atlas.subsurface(rect)
+    for name, rect in index["rotated"].items():
+        CARD_IMAGES_R[name] = atlas.subsurface(rect)
 
 
 def draw_arrow(screen:pygame.Surface, color, SX:int, SY:int, W:int, H:int, width:int):
@@ -159,6 +243,8 @@ def draw_player(screen:pygame.Surface, hand_data:str, pSX, pSY):
     if int(player_stats[5]):
         stat_line = "C: {:,} ({:.1f} ms/xact)".format(int(player_stats[5]), \
                                                       float(player_stats[6]) / float(player_stats[5]) * 1000.0)
+        if len(player_stats) > 7:
+            stat_line += "  M: R${:.2f}/hand".format(float(player_stats[7]))
         screen.blit(stats_font.render(stat_line, True, (0, 0, 0)), (pSX, pSY - 10))
 
     if hand_data[3] is "a":
@@ -166,8 +252,133 @@ def draw_player(screen:pygame.Surface, hand_data:str, pSX, pSY):
         draw_arrow(screen, (240, 240, 240), pSX - 40, pSY, 30, 30, 2)
 
 
-def draw_screen(screen:pygame.Surface, hand:str):
+class MonitorView:
+    """Which part of the player list the screen shows.  With many players only one page is drawn, either as full seats
+    with cards, or as compact summary rows (name, balance, W/L bar).  The top view orders players by balance.  With a
+    StateHistory, it can also be paused on a past table state instead of following the live one."""
+    DETAILS = ("auto", "full", "summary")
+
+    def __init__(self, history: StateHistory = None):
+        self.detail = "auto"        # "auto" shows full seats while everyone fits on one page, summary rows otherwise.
+        self.sort_top = False
+        self.page = 0
+        self.history = history
+        self.paused_at = None       # Index into history of the state on screen, or None to follow the live state.
+
+    def step_hands(self, hands: int):
+        """Move to the first state of the hand hands hands before or after the one on screen."""
+        self.paused_at = self.history.find_hand(self.history.hand_at(self.paused_at) + hands)
+
+    def handle_key(self, key) -> bool:
+        """Update the view for a key press.  Returns True if the view changed and the screen needs a redraw.
+        PageUp/PageDown page, Home goes to the first page, D cycles the detail level and T toggles the top view.
+        Space pauses (and goes back to live), Left/Right step one update, [ and ] one hand, - and = 100 hands, and
+        End goes back to live."""
+        if self.history is not None and len(self.history) > 0 and key in (
+                pygame.K_SPACE, pygame.K_LEFT, pygame.K_RIGHT, pygame.K_LEFTBRACKET, pygame.K_RIGHTBRACKET,
+                pygame.K_MINUS, pygame.K_EQUALS, pygame.K_END):
+            if key == pygame.K_END or (key == pygame.K_SPACE and self.paused_at is not None):
+                self.paused_at = None
+                return True
+            if self.paused_at is None:
+                self.paused_at = self.history.newest()
+            if key == pygame.K_LEFT:
+                self.paused_at -= 1
+            elif key == pygame.K_RIGHT:
+                self.paused_at += 1
+            elif key == pygame.K_LEFTBRACKET:
+                self.step_hands(-1)
+            elif key == pygame.K_RIGHTBRACKET:
+                self.step_hands(1)
+            elif key == pygame.K_MINUS:
+                self.step_hands(-100)
+            elif key == pygame.K_EQUALS:
+                self.step_hands(100)
+            return True
+        if key == pygame.K_PAGEDOWN:
+            self.page += 1
+        elif key == pygame.K_PAGEUP:
+            self.page = max(0, self.page - 1)
+        elif key == pygame.K_HOME:
+            self.page = 0
+        elif key == pygame.K_d:
+            self.detail = self.DETAILS[(self.DETAILS.index(self.detail) + 1) % len(self.DETAILS)]
+            self.page = 0
+        elif key == pygame.K_t:
+            self.sort_top = not self.sort_top
+            self.page = 0
+        else:
+            return False
+        return True
+
+    def layout(self, num_players: int) -> (str, int):
+        """Return the detail level to draw at and how many players fit on a page at that level."""
+        full_per_page = PLAYERS_PER_ROW * SEAT_ROWS
+        detail = self.detail
+        if detail == "auto":
+            detail = "full" if num_players <= full_per_page and not self.sort_top else "summary"
+        if detail == "full":
+            return (detail, full_per_page)
+        return (detail, ((WINDOW_HEIGHT - SUMMARY_TOP) // SUMMARY_ROW_HEIGHT) * (WINDOW_WIDTH // SUMMARY_COL_WIDTH))
+
+    def visible(self, players: list) -> (str, list):
+        """Pick out the players on the current page.  Returns the detail level and a list of (position, player
+        string).  Only the top view has to look at every player, and that is a partial heap select, not a full sort."""
+        (detail, per_page) = self.layout(len(players))
+        pages = max(1, (len(players) + per_page - 1) // per_page)
+        self.page = min(self.page, pages - 1)
+        start = self.page * per_page
+        if self.sort_top:
+            shown = heapq.nlargest(start + per_page, players, key=lambda p: int(p.split(":", 2)[1]))[start:]
+        else:
+            shown = players[start:start + per_page]
+        return (detail, list(enumerate(shown, start)))
+
+
+def draw_player_summary(screen:pygame.Surface, hand_data:list, pSX, pSY, position:int):
+    """Draw a player as a single compact row - rank/position, W/L bar, name and balance."""
+    player_stats = hand_data[2].split(',')
+    wins = int(player_stats[0])
+    losses = int(player_stats[1])
+    pygame.draw.rect(screen, (160, 0, 0), (pSX + 40, pSY + 4, SUMMARY_BAR_WIDTH, 10))
+    if wins + losses > 0:
+        pygame.draw.rect(screen, (0, 200, 0), (pSX + 40, pSY + 4, round(SUMMARY_BAR_WIDTH * wins / (wins + losses)), 10))
+    color = (240, 0, 0) if hand_data[3] == "a" else (0, 0, 0)
+    screen.blit(stats_font.render(str(position + 1), True, color), (pSX, pSY + 2))
+    screen.blit(stats_font.render(hand_data[0], True, color), (pSX + 46 + SUMMARY_BAR_WIDTH, pSY + 2))
+    t = stats_font.render("R${:,}".format(int(hand_data[1])), True, (0, 0, 0))
+    r = t.get_rect()
+    r.right = pSX + SUMMARY_COL_WIDTH - 10
+    r.top = pSY + 2
+    screen.blit(t, r)
+
+
+def draw_players(screen:pygame.Surface, players:list, view:MonitorView):
+    """Draw the page of players the view selects, at the view's detail level."""
+    (detail, shown) = view.visible(players)
+    if len(shown) > 0:
+        draw_text_right(screen, "Players {:,}-{:,} of {:,}{}".format(shown[0][0] + 1, shown[-1][0] + 1, len(players),
+                                                                    " by balance" if view.sort_top else ""),
+                        (0, 0, 0), WINDOW_WIDTH - 10, 70)
+    rows_per_col = (WINDOW_HEIGHT - SUMMARY_TOP) // SUMMARY_ROW_HEIGHT
+    for slot, (position, player) in enumerate(shown):
+        hand_data = player.split(":")
+        if detail == "full":
+            pSX = (slot % PLAYERS_PER_ROW) * 200 + 50
+            pSY = WINDOW_HEIGHT - 40 - 200*(slot // PLAYERS_PER_ROW)
+            draw_player(screen, hand_data, pSX, pSY)
+        else:
+            pSX = (slot // rows_per_col) * SUMMARY_COL_WIDTH + 10
+            pSY = SUMMARY_TOP + (slot % rows_per_col) * SUMMARY_ROW_HEIGHT
+            draw_player_summary(screen, hand_data, pSX, pSY, position)
+
+
+def draw_screen(screen:pygame.Surface, hand:str, view:MonitorView = None, status:str = None):
+    """Draw a table state.  status, if given, is shown under the table stats - the time travel position when we're
+    looking at the past, which also leaves the hands/min figure alone."""
     global screen_draws, screen_draw_time_last_100, screen_draw_count_last_100, hands_played_ratio
+    if view is None:
+        view = MonitorView()
     # Redraw screen
     screen.fill(TABLE_COLOR)
     if hand != "":
@@ -179,7 +390,7 @@ def draw_screen(screen:pygame.Surface, hand:str):
 
         # Recalculate our hands per minute if need be
         screen_draws += 1
-        if screen_draws % 100 == 0:
+        if screen_draws % 100 == 0 and status is None:
             if screen_draw_time_last_100 is not None:
                 hands_played_ratio = (float(table_data[0]) - screen_draw_count_last_100) / \
                                      (time.monotonic() - screen_draw_time_last_100) * 60.0
@@ -196,52 +407,411 @@ def draw_screen(screen:pygame.Surface, hand:str):
                                float(table_data[3]) / float(table_data[0]),
                                float(table_data[3]) / float(table_data[4]) * 100.0),
                         (0, 0, 0), WINDOW_WIDTH - 10, 50)
+        if len(table_data) > 5 and table_data[5] != "":
+            draw_text_right(screen, "Leaders: " + ", ".join(e.replace("=", " R$") for e in table_data[5].split(";")),
+                            (0, 0, 0), WINDOW_WIDTH - 10, 90)
+        if status is not None:
+            draw_text_right(screen, status, (200, 0, 0), WINDOW_WIDTH - 10, 110)
 
         # Render dealer's hand
         draw_hand(screen, hands[1], 50, 10)
 
-        # Render players' hands
-        for i in range(2, len(hands)):
-            playernum = i - 2
-            pSX = (playernum % PLAYERS_PER_ROW) * 200 + 50
-            pSY = WINDOW_HEIGHT - 40 - 200*(playernum // PLAYERS_PER_ROW)
-            hand_data = hands[i].split(":")
-            draw_player(screen, hand_data, pSX, pSY)
+        # Render players' hands - only the ones inside the viewport cost anything beyond a split.
+        draw_players(screen, hands[2:], view)
 
     # Push update to the screen
     pygame.display.update()
-    pygame.event.get()
 
 
-def RunMonitor(ip:str):
+class HistorySegment:
+    """A full table state and the diffs that follow it, with the hand number and arrival time of each state."""
+    __slots__ = ("first", "keyframe", "diffs", "hands", "times", "size")
+
+    def __init__(self, first: int, keyframe: bytes):
+        self.first = first          # Index in the history of the keyframe.
+        self.keyframe = keyframe
+        self.diffs = []
+        self.hands = array("l")
+        self.times = array("d")
+        self.size = len(keyframe) + HISTORY_ENTRY_OVERHEAD
+
+
+def encode_diff(old: list, new: list) -> bytes:
+    """The difference between two table states split into their space separated fields: the new field count, then a
+    tab, index, tab and field for every field that changed.  Players keep their place in the line from update to
+    update, so most updates only touch a few fields."""
+    ret = [bytes(str(len(new)), "utf-8")]
+    for i in range(len(new)):
+        if i >= len(old) or new[i] != old[i]:
+            ret.append(bytes(str(i), "utf-8"))
+            ret.append(new[i])
+    return b"\t".join(ret)
+
+
+def apply_diff(fields: list, diff: bytes) -> list:
+    parts = diff.split(b"\t")
+    count = int(parts[0])
+    ret = fields[:count] + [b""] * (count - len(fields))
+    for i in range(1, len(parts), 2):
+        ret[int(parts[i])] = parts[i + 1]
+    return ret
+
+
+class StateHistory:
+    """Every table state received lately, for scrubbing back through.  States are stored in segments of a full
+    keyframe followed by up to HISTORY_KEYFRAME_INTERVAL - 1 diffs, so getting any state back means finding its
+    segment (a bisect) and replaying at most that many diffs.  Once the history goes over its memory budget the oldest
+    segments are dropped whole, so memory stays fixed however long the monitor runs.  States are numbered from 0 in the
+    order they arrived, and keep their numbers as older ones are dropped."""
+
+    def __init__(self, budget: int = HISTORY_MB * 1024 * 1024, keyframe_interval: int = HISTORY_KEYFRAME_INTERVAL):
+        self.budget = budget
+        self.keyframe_interval = keyframe_interval
+        self.lock = threading.Lock()
+        self.segments = []          # Oldest first.
+        self.starts = []            # The first index of each segment, for bisecting.
+        self.size = 0
+        self.count = 0              # States ever added - the newest is count - 1.
+        self.last = None            # Fields of the newest state, to diff the next one against.
+
+    def __len__(self):
+        with self.lock:
+            return self.count - self.starts[0] if len(self.starts) > 0 else 0
+
+    def oldest(self) -> int:
+        with self.lock:
+            return self.starts[0]
+
+    def newest(self) -> int:
+        return self.count - 1
+
+    def append(self, state: bytes, when: float):
+        fields = state.split(b" ")
+        try:
+            hand = int(fields[0].split(b",", 1)[0])
+        except ValueError:
+            return
+        with self.lock:
+            if fields == self.last:
+                return
+            diff = None
+            if len(self.segments) > 0 and len(self.segments[-1].diffs) + 1 < self.keyframe_interval:
+                diff = encode_diff(self.last, fields)
+                if len(diff) * 2 > len(state):
+                    diff = None     # Most of the line changed (players came or went) - a fresh keyframe is smaller.
+            if diff is None:
+                segment = HistorySegment(self.count, state)
+                self.segments.append(segment)
+                self.starts.append(self.count)
+                self.size += segment.size
+            else:
+                segment = self.segments[-1]
+                segment.diffs.append(diff)
+                segment.size += len(diff) + HISTORY_ENTRY_OVERHEAD
+                self.size += len(diff) + HISTORY_ENTRY_OVERHEAD
+            segment.hands.append(hand)
+            segment.times.append(when)
+            self.last = fields
+            self.count += 1
+            while self.size > self.budget and len(self.segments) > 1:
+                self.size -= self.segments[0].size
+                del self.segments[0]
+                del self.starts[0]
+
+    def seek(self, index: int) -> (str, int, int, float):
+        """Rebuild the state at index, clamped to what's still held.  Returns the state, the index it ended up at, its
+        hand number and when it arrived."""
+        with self.lock:
+            index = max(self.starts[0], min(index, self.count - 1))
+            segment = self.segments[bisect_right(self.starts, index) - 1]
+            offset = index - segment.first
+            fields = segment.keyframe.split(b" ")
+            for diff in segment.diffs[:offset]:
+                fields = apply_diff(fields, diff)
+            return (str(b" ".join(fields), "utf-8"), index, segment.hands[offset], segment.times[offset])
+
+    def hand_at(self, index: int) -> int:
+        with self.lock:
+            index = max(self.starts[0], min(index, self.count - 1))
+            segment = self.segments[bisect_right(self.starts, index) - 1]
+            return segment.hands[index - segment.first]
+
+    def find_hand(self, hand: int) -> int:
+        """The index of the first state held of the given hand (or the nearest one, if it's gone or yet to come)."""
+        with self.lock:
+            i = max(0, bisect_right([s.hands[0] for s in self.segments], hand) - 1)
+            segment = self.segments[i]
+            j = bisect_left(segment.hands, hand)
+            if j == len(segment.hands) and i + 1 < len(self.segments):
+                return self.segments[i + 1].first
+            return segment.first + min(j, len(segment.hands) - 1)
+
+
+class TableStateReceiver(threading.Thread):
+    """Background thread that reads the monitor stream off the server and keeps only the most recent table state.
+    The render loop polls get_latest() and only redraws when the version has moved on, so bursts of updates from the
+    server collapse into a single frame."""
+
+    def __init__(self, ip: str, name: str, record=None, history: StateHistory = None):
+        super().__init__(daemon=True)
+        self.ip = ip
+        self.name = name
+        self.record = record        # Optional binary file-like object every received state is appended to.
+        self.history = history      # Optional StateHistory that gets every received state.
+        self.error = None           # Set to the exception that ended the thread, if any.
+        self._lock = threading.Lock()
+        self._latest = ""
+        self._version = 0
+
+    def publish(self, state: str):
+        """Replace the latest table state.  Duplicate states don't bump the version."""
+        with self._lock:
+            if state != self._latest:
+                self._latest = state
+                self._version += 1
+
+    def get_latest(self) -> (int, str):
+        """Return (version, table state) of the newest state received."""
+        with self._lock:
+            return (self._version, self._latest)
+
+    def close_record(self):
+        """Stop recording and close the file, even while the thread is still receiving."""
+        with self._lock:
+            record = self.record
+            self.record = None
+        if record is not None:
+            record.close()
+
+    def run(self):
+        try:
+            s = connect_to_server(self.ip)
+            buf = bytearray()
+            said_hello = False
+            while True:
+                select([s], [], [], 1.0)
+                try:
+                    data = s.recv(65536)
+                except BlockingIOError:  # Nothing there yet.
+                    continue
+                if len(data) == 0:
+                    raise ConnectionError("Server closed the monitor connection.")
+                buf += data
+                end = buf.rfind(b"\n")
+                if end < 0:
+                    continue
+                lines = [l for l in bytes(buf[:end]).split(b"\n") if l.strip() != b""]
+                del buf[:end + 1]
+                if not said_hello:
+                    # The first line is the server's HELLO - answer it and switch into monitor mode.
+                    lines = lines[1:]
+                    send_to_server(s, "MONITOR " + self.name)
+                    said_hello = True
+                self.deliver(lines)
+        except Exception as e:
+            self.error = e
+
+    def deliver(self, lines: list):
+        """Take a batch of received states (as bytes)."""
+        if len(lines) == 0:
+            return
+        with self._lock:    # So close_record can't close the file under a write.
+            if self.record is not None:
+                # Recording wants every state, not just the latest.  One "<unix time> <state>" line each.
+                stamp = bytes("{:.3f} ".format(time.time()), "utf-8")
+                self.record.write(b"".join(stamp + l.strip() + b"\n" for l in lines))
+        if self.history is not None:
+            now = time.time()
+            for l in lines:
+                self.history.append(l.strip(), now)
+        # Only the newest state matters, anything older would just be overdrawn.
+        self.publish(str(lines[-1], "utf-8").strip())
+
+
+class SnapshotReceiver(TableStateReceiver):
+    """Takes the table states from the server's shared memory snapshot (see tablesnapshot.py) rather than a MONITOR
+    connection - for monitors on the server's own machine, which then cost the server nothing.  It polls, so states
+    that come and go between polls are missed, by recordings and the history too.  ip is ignored."""
+
+    def run(self):
+        try:
+            reader = tablesnapshot.SnapshotReader()
+            seen_version = None
+            while True:
+                if reader.version() != seen_version:
+                    (header, line) = reader.read()
+                    seen_version = header["version"]
+                    if header["length"] > 0:
+                        self.deliver([bytes(line, "utf-8")])
+                time.sleep(SNAPSHOT_POLL_TIME)
+        except Exception as e:
+            self.error = e
+
+
+def parse_table_state(state: str) -> dict:
+    """Split a monitor line into its table counters and per-player statistics.  Players are keyed by name, with their
+    statistics as a list of numbers in the same order the server sends them (wins, losses, pushes, sitouts, total bets,
+    interactions count, interactions time, and from newer servers the Randy Bucks per hand its mistakes cost).  Newer
+    servers also send the leaderboard's top players by currency, as a list of (name, currency)."""
+    fields = state.split(" ")
+    table_data = fields[0].split(",")
+    ret = {"hands": int(table_data[0]), "decks": int(table_data[1]), "shoe": int(table_data[2]),
+           "house_currency": int(table_data[3]), "house_total": int(table_data[4]), "players": {}, "leaders": []}
+    if len(table_data) > 5 and table_data[5] != "":
+        for e in table_data[5].split(";"):
+            (name, _, cur) = e.rpartition("=")
+            ret["leaders"].append((name, int(cur)))
+    for f in fields[2:]:
+        hand_data = f.split(":")
+        stats = hand_data[2].split(",")
+        ret["players"][hand_data[0]] = [int(hand_data[1])] + [int(x) for x in stats[0:6]] + \
+            [float(x) for x in stats[6:8]]
+    return ret
+
+
+class RollingAggregates:
+    """Keeps one sample of the table per HEADLESS_SAMPLE_TIME over the last HEADLESS_WINDOW seconds, and summarizes the
+    difference between the oldest and newest samples.  All the server counters are cumulative, so the window only
+    needs its two ends to get rates."""
+
+    def __init__(self, window: float = HEADLESS_WINDOW):
+        self.window = window
+        self.samples = deque()
+
+    def add(self, when: float, table: dict):
+        self.samples.append((when, table))
+        while len(self.samples) > 2 and when - self.samples[1][0] >= self.window:
+            self.samples.popleft()
+
+    def summary(self) -> list:
+        """Return a list of compact summary lines - one for the table, then one per player seen in the window."""
+        if len(self.samples) == 0:
+            return ["no data"]
+        (t1, new) = self.samples[-1]
+        (t0, old) = self.samples[0]
+        elapsed = max(t1 - t0, 0.001)
+        hands = new["hands"] - old["hands"]
+        bets = new["house_total"] - old["house_total"]
+        edge = (new["house_currency"] - old["house_currency"]) / bets * 100.0 if bets > 0 else 0.0
+        ret = ["{0} hands={1:,} window={2:.0f}s hands/s={3:.2f} edge={4:.2f}% decks={5} shoe={6} players={7}".format(
+            time.strftime("%H:%M:%S"), new["hands"], elapsed, hands / elapsed, edge, new["decks"], new["shoe"],
+            len(new["players"]))]
+        if len(new["leaders"]) > 0:
+            ret.append("  top: " + ", ".join("{0} R${1:,}".format(name, cur) for (name, cur) in new["leaders"]))
+        for name, cur in sorted(new["players"].items()):
+            prev = old["players"].get(name)
+            if prev is None or cur[6] < prev[6]:     # New this window, or reconnected with fresh counters.
+                prev = [0] * 8
+            (w, l, p) = (cur[1] - prev[1], cur[2] - prev[2], cur[3] - prev[3])
+            count = cur[6] - prev[6]
+            ret.append("  {0} R${1:,} W/L/P={2}/{3}/{4} win={5:.3f} ms/xact={6:.1f}{7}".format(
+                name, cur[0], w, l, p, w / (w + l + p) if w + l + p > 0 else 0.0,
+                (cur[7] - prev[7]) / count * 1000.0 if count > 0 else 0.0,
+                " mistakes=R${0:.2f}/hand".format(cur[8]) if len(cur) > 8 else ""))
+        return ret
+
+
+def RunHeadless(ip: str, interval: float, record: str = None, output: str = None, shared: bool = False):
+    """Run the monitor without a display, printing rolling summaries every interval seconds.  Optionally record the
+    raw monitor stream to a gzip file, and/or append the summaries to a file instead of printing them."""
+    record_file = gzip.open(record, "ab") if record is not None else None
+    receiver = (SnapshotReceiver if shared else TableStateReceiver)(ip, "Headless_Mon", record_file)
+    receiver.start()
+    # Run as a background service, so make sure a plain kill still flushes the recording.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    aggregates = RollingAggregates()
+    seen_version = 0
+    next_summary = time.monotonic() + interval
+    try:
+        while receiver.is_alive():
+            time.sleep(HEADLESS_SAMPLE_TIME)
+            (version, state) = receiver.get_latest()
+            if version != seen_version:
+                seen_version = version
+                try:
+                    aggregates.add(time.monotonic(), parse_table_state(state))
+                except (ValueError, IndexError):
+                    print("MONITOR could not parse " + state)
+            if time.monotonic() >= next_summary:
+                next_summary += interval
+                lines = "\n".join(aggregates.summary())
+                if output is None:
+                    print(lines, flush=True)
+                else:
+                    with open(output, "a") as f:
+                        f.write(lines + "\n")
+        raise ConnectionError("Lost monitor connection: " + str(receiver.error))
+    finally:
+        receiver.close_record()
+
+
+def RunMonitor(ip:str, history_mb:int = HISTORY_MB, shared:bool = False):
     screen = pygame.display.set_mode((WINDOW_WIDTH, WINDOW_HEIGHT))
     pygame.display.set_caption("Blackjack Monitor", "Blackjack Monitor")
     load_card_images()
     if ip != "test":
         draw_screen(screen, "")
-        s = connect_to_server(ip)
-        inp = sock_readline(s, 500.0)  # Ignore the HELLO.
-        send_to_server(s, "MONITOR Andrews_Mon")
-        inp = sock_readline(s, 500.0)
-        previnp = ""
+        history = StateHistory(history_mb * 1024 * 1024) if history_mb > 0 else None
+        receiver = (SnapshotReceiver if shared else TableStateReceiver)(ip, "Andrews_Mon", history=history)
+        receiver.start()
+        clock = pygame.time.Clock()
+        view = MonitorView(history)
+        drawn_version = 0
         while True:
-            if inp is None:
-                inp = ""
-            if inp == previnp:
-                print("MONITOR ignoring duplicate " + inp)
-            else:
-                print("MONITOR drawing " + inp)
-                draw_screen(screen, inp)
-            inp = sock_readline(s, 500.0)
+            view_changed = False
+            for event in pygame.event.get():
+                if event.type == pygame.QUIT:
+                    return
+                if event.type == pygame.KEYDOWN:
+                    view_changed = view.handle_key(event.key) or view_changed
+            if not receiver.is_alive():
+                raise ConnectionError("Lost monitor connection: " + str(receiver.error))
+            if view.paused_at is not None:
+                # Looking at the past - the live state can wait, only redraw when we move.
+                if view_changed:
+                    (inp, view.paused_at, hand, when) = history.seek(view.paused_at)
+                    draw_screen(screen, inp, view, "Paused at update {:,} of {:,} (hand #{:,}, {:.1f}s ago)".format(
+                        view.paused_at - history.oldest() + 1, len(history), hand, time.time() - when))
+                clock.tick(MAX_FPS)
+                continue
+            (version, inp) = receiver.get_latest()
+            if version != drawn_version or view_changed:
+                # Anything that arrived since the last frame has been collapsed into this one.
+                draw_screen(screen, inp, view)
+                drawn_version = version
+            clock.tick(MAX_FPS)
     else:
         draw_screen(screen, "QS?? TestP2:318923:AC9HTD+/AHTD./ASTS./ADAHTC8H. P2:3829:6H4Sa P3:38291:QDQSp P4:12839:KCKSp")
+        pygame.event.get()
         time.sleep(20)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Blackjack table monitor.")
+    parser.add_argument("ip", nargs="?", help="Server to monitor, or 'test' to draw a sample table.")
+    parser.add_argument("--port", type=int, default=SERVER_PORT, help="Port the server or relay.py listens on.")
+    parser.add_argument("--headless", action="store_true", help="Print rolling summaries instead of drawing.")
+    parser.add_argument("--interval", type=float, default=10.0, help="Seconds between headless summaries.")
+    parser.add_argument("--record", help="Append the raw monitor stream to this gzip file.")
+    parser.add_argument("--output", help="Append headless summaries to this file instead of printing them.")
+    parser.add_argument("--build-atlas", action="store_true", help="Just (re)build the card sprite atlas and exit.")
+    parser.add_argument("--shared", action="store_true",
+                        help="On the server's machine, read its shared memory snapshot instead of connecting.")
+    parser.add_argument("--history", type=int, default=HISTORY_MB,
+                        help="Megabytes of past table states to keep for pausing and scrubbing back (0 = none).")
+    args = parser.parse_args()
+    SERVER_PORT = args.port
+    if args.build_atlas:
+        save_card_atlas(*build_card_atlas(card_sources()))
+        sys.exit(0)
+    if args.ip is None and not args.shared:
+        parser.error("the server ip is required")
+    if args.headless:
+        RunHeadless(args.ip, args.interval, args.record, args.output, args.shared)
+        sys.exit(0)
     pygame.init()
     pygame.font.init()
     name_font = pygame.font.SysFont("Arial", 18)
     stats_font = pygame.font.SysFont("Arial", 12)
     print("Using backend "+pygame.display.get_driver())
-    RunMonitor(sys.argv[1])
\ No newline at end of file
+    RunMonitor(args.ip, args.history, args.shared)
\ No newline at end of file
@@ -0,0 +1,154 @@
+#!/usr/bin/python3
+import selectors
+import socket
+import sys
+import argparse
+from collections import deque
+
+# Some global variables
+RELAY_PORT = 9877               # Where spectators connect.  Point monitor.py at it with --port.
+SPECTATOR_BUFFER_LIMIT = 262144 # Bytes we let queue up for one spectator before throwing away stale table states.
+RELAY_NAME = "Relay"
+
+
+class Spectator:
+    """A downstream monitor connection, with its own queue of frames waiting to be written.  Every frame is a complete
+    table state, so when a slow spectator falls behind we drop the states it hasn't started on and just keep the
+    newest."""
+
+    def __init__(self, sock: socket):
+        self.sock = sock
+        self.frames = deque()
+        self.offset = 0             # How much of frames[0] has already been sent.
+        self.queued = 0
+        self.dropped = 0
+
+    def push(self, frame: bytes):
+        self.frames.append(frame)
+        self.queued += len(frame)
+        if self.queued > SPECTATOR_BUFFER_LIMIT and len(self.frames) > 1:
+            # Keep the frame we're part way through (so the stream stays line-aligned) and the newest one.
+            keep = [self.frames[0]] if self.offset > 0 else []
+            self.dropped += len(self.frames) - len(keep) - 1
+            self.frames = deque(keep + [frame])
+            self.queued = sum(len(f) for f in self.frames) - self.offset
+
+    def flush(self) -> bool:
+        """Write as much as the socket takes without blocking.  Returns True if everything queued went out."""
+        while len(self.frames) > 0:
+            try:
+                sent = self.sock.send(self.frames[0][self.offset:])
+            except BlockingIOError:
+                return False
+            self.offset += sent
+            self.queued -= sent
+            if self.offset < len(self.frames[0]):
+                return False
+            self.frames.popleft()
+            self.offset = 0
+        return True
+
+
+def connect_upstream(ip: str, port: int) -> socket:
+    s = socket.create_connection((ip, port))
+    s.setblocking(False)
+    return s
+
+
+def RunRelay(ip: str, port: int, listen_port: int):
+    """Watch the server as a single monitor, and pass its table states on to any number of spectators."""
+    sel = selectors.DefaultSelector()
+    upstream = connect_upstream(ip, port)
+    sel.register(upstream, selectors.EVENT_READ, None)
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', listen_port))
+    listener.listen(50)
+    listener.setblocking(False)
+    sel.register(listener, selectors.EVENT_READ, listener)
+    print("Relaying " + ip + ":" + str(port) + " to spectators on port " + str(listen_port) + ".")
+
+    hello = None                # The server's HELLO line, replayed to each spectator.
+    latest = None               # The newest table state, serialized once and shared by every spectator.
+    upbuf = bytearray()
+    spectators = {}
+
+    def drop(spec: Spectator):
+        if spectators.pop(spec.sock, None) is not spec:
+            return      # Already dropped.
+        sel.unregister(spec.sock)
+        spec.sock.close()
+
+    def send(spec: Spectator, frame: bytes):
+        spec.push(frame)
+        try:
+            done = spec.flush()
+        except OSError:
+            drop(spec)
+            return
+        sel.modify(spec.sock, selectors.EVENT_READ if done else selectors.EVENT_READ | selectors.EVENT_WRITE, spec)
+
+    while True:
+        for key, mask in sel.select():
+            if key.data is None:
+                # The server.
+                data = upstream.recv(65536)
+                if len(data) == 0:
+                    raise ConnectionError("Server closed the monitor connection.")
+                upbuf += data
+                end = upbuf.rfind(b"\n")
+                if end < 0:
+                    continue
+                lines = [l + b"\n" for l in bytes(upbuf[:end]).split(b"\n") if l.strip() != b""]
+                del upbuf[:end + 1]
+                if hello is None:
+                    hello = lines.pop(0)
+                    upstream.sendall(bytes("MONITOR " + RELAY_NAME + "\n", "utf-8"))
+                if len(lines) > 0:
+                    # Only the newest state is worth passing on.
+                    latest = lines[-1]
+                    for spec in list(spectators.values()):
+                        send(spec, latest)
+            elif key.data is listener:
+                try:
+                    (conn, address) = listener.accept()
+                except BlockingIOError:
+                    continue
+                conn.setblocking(False)
+                spec = Spectator(conn)
+                spectators[conn] = spec
+                sel.register(conn, selectors.EVENT_READ, spec)
+                # Late joiners get the HELLO and the current table straight away.
+                send(spec, hello if hello is not None else b"HELLO BlackjackServer v1.00\n")
+                if latest is not None and conn in spectators:
+                    send(spec, latest)
+            else:
+                spec = key.data
+                if spectators.get(spec.sock) is not spec:
+                    continue    # Dropped while handling an earlier event from this select().
+                if mask & selectors.EVENT_READ:
+                    # Spectators only ever send their MONITOR line - read and ignore, but notice hang ups.
+                    try:
+                        data = spec.sock.recv(4096)
+                    except BlockingIOError:
+                        data = None
+                    except OSError:
+                        data = b""
+                    if data == b"":
+                        drop(spec)
+                        continue
+                if mask & selectors.EVENT_WRITE:
+                    try:
+                        if spec.flush():
+                            sel.modify(spec.sock, selectors.EVENT_READ, spec)
+                    except OSError:
+                        drop(spec)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fan the server's monitor stream out to many spectators.")
+    parser.add_argument("ip", help="Server to relay.")
+    parser.add_argument("--server-port", type=int, default=9876)
+    parser.add_argument("--port", type=int, default=RELAY_PORT, help="Port to serve spectators on.")
+    args = parser.parse_args()
+    RunRelay(args.ip, args.server_port, args.port)
@@ -0,0 +1,214 @@
+#!/usr/bin/python3
+import socket
+import struct
+import gzip
+import json
+import time
+import threading
+import argparse
+from collections import deque
+import monitor
+
+# Some global variables - the capture layout must match server.py's TrafficCapture.
+CAPTURE_RECORD = "<fBBH"
+CAPTURE_PROMPTS = ("READY", "INSURANCE", "ACT")
+CAPTURE_JOIN = 255
+CAPTURE_FOLLOW_UP = 0x80
+REPORT_METRICS = ("hands_per_min", "prompts_per_sec", "timeout_rate", "invalid_rate", "turnaround_p50_ms",
+                  "turnaround_p99_ms")
+
+
+def read_capture(path: str) -> (list, dict):
+    """Read a capture made with "server.py --capture".  Returns the clients as a list of (join time, name) in the order
+    they joined, and each client's responses as {name: {prompt kind: deque of (seconds, line, follow up)}}."""
+    header = struct.Struct(CAPTURE_RECORD)
+    joins = []
+    streams = {}
+    with gzip.open(path, "rb") as f:
+        data = f.read()
+    pos = 0
+    while pos + header.size <= len(data):
+        (seconds, kind, name_len, line_len) = header.unpack_from(data, pos)
+        pos += header.size
+        name = str(data[pos:pos + name_len], "utf-8", "replace")
+        line = str(data[pos + name_len:pos + name_len + line_len], "utf-8", "replace")
+        pos += name_len + line_len
+        if kind == CAPTURE_JOIN:
+            # A server upgraded part way through the capture starts counting again - keep the first join.
+            if name not in streams:
+                joins.append((seconds, name))
+                streams[name] = {k: deque() for k in CAPTURE_PROMPTS}
+            continue
+        streams[name][CAPTURE_PROMPTS[kind & ~CAPTURE_FOLLOW_UP]].append(
+            (None if seconds < 0 else seconds, line, kind & CAPTURE_FOLLOW_UP != 0))
+    return (joins, streams)
+
+
+class ReplayClient(threading.Thread):
+    """Plays one captured client back: registers under its name, then answers each prompt with the next line it sent
+    to that kind of prompt, after the same (sped up) think time.  A captured timeout is replayed by not answering, and
+    lines the client sent after an INVALID are sent again after an INVALID.  Leaves once its responses run out."""
+
+    def __init__(self, ip: str, port: int, name: str, join_at: float, responses: dict, speed: float):
+        threading.Thread.__init__(self, daemon=True)
+        self.ip = ip
+        self.port = port
+        self.name = name
+        self.join_at = join_at
+        self.responses = responses
+        self.speed = speed
+        self.buf = b""
+        self.last_kind = None
+        self.sent_at = None
+        self.turnarounds = []       # Seconds from each answer to the server's next line.
+        self.prompts = 0
+        self.timeouts = 0
+        self.invalids = 0
+        self.dones = 0
+        self.error = None
+
+    def readline(self, sock: socket) -> str:
+        while b"\n" not in self.buf:
+            data = sock.recv(4096)
+            if len(data) == 0:
+                raise ConnectionError("Server closed the connection.")
+            self.buf += data
+        (line, _, self.buf) = self.buf.partition(b"\n")
+        if self.sent_at is not None:
+            self.turnarounds.append(time.monotonic() - self.sent_at)
+            self.sent_at = None
+        return str(line, "utf-8").strip()
+
+    def answer(self, sock: socket, kind: str, follow_up: bool) -> bool:
+        """Send the next captured line for kind.  Returns False once this client has nothing left to say."""
+        queue = self.responses[kind]
+        if follow_up and (len(queue) == 0 or not queue[0][2]):
+            return True     # The client didn't retry after this INVALID - the server will prompt again or time out.
+        if len(queue) == 0:
+            return False
+        (seconds, line, _) = queue.popleft()
+        if seconds is None:
+            return True
+        time.sleep(seconds / self.speed)
+        sock.sendall(bytes(line + "\n", "utf-8"))
+        self.sent_at = time.monotonic()
+        return True
+
+    def run(self):
+        try:
+            sock = socket.create_connection((self.ip, self.port))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            while True:
+                (verb, _, noun) = self.readline(sock).partition(" ")
+                if verb == "HELLO":
+                    sock.sendall(bytes("REGISTER " + self.name + "\n", "utf-8"))
+                elif verb == "TOKEN":
+                    sock.sendall(bytes("LOGIN " + noun + "\n", "utf-8"))
+                elif verb in CAPTURE_PROMPTS:
+                    self.prompts += 1
+                    self.last_kind = verb
+                    if not self.answer(sock, verb, False):
+                        break
+                elif verb == "INVALID":
+                    self.invalids += 1
+                    if self.last_kind is None:
+                        raise ConnectionError("Server refused us: " + noun)
+                    self.answer(sock, self.last_kind, True)
+                elif verb == "OK" and self.last_kind is not None:
+                    # A POLICY the client sent in place of an answer was accepted - it answered after that.
+                    self.answer(sock, self.last_kind, True)
+                elif verb == "TIMEOUT":
+                    self.timeouts += 1
+                elif verb == "DONE":
+                    self.dones += 1
+                elif verb == "BYE":
+                    break
+            sock.close()
+        except OSError as e:
+            self.error = e
+
+
+def percentile(values: list, fraction: float) -> float:
+    if len(values) == 0:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def latest_table(receiver: monitor.TableStateReceiver) -> dict:
+    (version, state) = receiver.get_latest()
+    return monitor.parse_table_state(state) if version > 0 else None
+
+
+def RunReplay(args) -> dict:
+    (joins, streams) = read_capture(args.capture)
+    print("Replaying {0!s} clients from {1} at {2:g}x.".format(len(joins), args.capture, args.speed), flush=True)
+    monitor.SERVER_PORT = args.port
+    receiver = monitor.TableStateReceiver(args.ip, "Replay_Mon")
+    receiver.daemon = True
+    receiver.start()
+    time.sleep(0.5)
+    # An idle server sends monitors nothing, so the hand count may only start showing up once our clients play.
+    first = latest_table(receiver)
+
+    start = time.monotonic()
+    clients = []
+    for (join_at, name) in joins:
+        delay = start + (join_at - joins[0][0]) / args.speed - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+        client = ReplayClient(args.ip, args.port, args.prefix + name, join_at, streams[name], args.speed)
+        client.start()
+        clients.append(client)
+    for client in clients:
+        while client.is_alive():
+            client.join(0.5)
+            if first is None:
+                first = latest_table(receiver)
+    elapsed = time.monotonic() - start
+    last = latest_table(receiver)
+    if last is None:
+        raise ConnectionError("Never got a table state from the server.")
+
+    prompts = sum(c.prompts for c in clients)
+    turnarounds = [t for c in clients for t in c.turnarounds]
+    report = {"clients": len(clients), "seconds": elapsed, "hands": last["hands"] - first["hands"],
+              "hands_per_min": (last["hands"] - first["hands"]) * 60.0 / elapsed, "prompts_per_sec": prompts / elapsed,
+              "timeout_rate": sum(c.timeouts for c in clients) / max(prompts, 1),
+              "invalid_rate": sum(c.invalids for c in clients) / max(prompts, 1),
+              "turnaround_p50_ms": percentile(turnarounds, 0.5) * 1000.0,
+              "turnaround_p99_ms": percentile(turnarounds, 0.99) * 1000.0}
+    for c in clients:
+        if c.error is not None:
+            print("  " + c.name + " stopped early: " + str(c.error))
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    print("{0} clients, {1} hands in {2:.1f}s".format(report["clients"], report["hands"], report["seconds"]))
+    for m in REPORT_METRICS:
+        line = "  {0:<18} {1:12.3f}".format(m, report[m])
+        if baseline is not None and m in baseline:
+            delta = report[m] - baseline[m]
+            line += "  {0:+12.3f}".format(delta)
+            if baseline[m] != 0:
+                line += " ({0:+.1%})".format(delta / baseline[m])
+        print(line)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Drive a server with client traffic captured by "
+                                                 "\"server.py --capture\", and report throughput and latency.  Start "
+                                                 "the server with --seed so each run deals the same shoes.")
+    parser.add_argument("capture", help="Capture file to replay.")
+    parser.add_argument("ip", nargs="?", default="localhost", help="Server to replay against.")
+    parser.add_argument("--port", type=int, default=monitor.SERVER_PORT)
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay think times this many times faster (1-100).")
+    parser.add_argument("--prefix", default="", help="Prepended to every client name, to replay into a busy server.")
+    parser.add_argument("--output", help="Save the results as JSON, to compare a later run against.")
+    parser.add_argument("--baseline", help="Results saved by an earlier run (--output) to print the deltas against.")
+    RunReplay(parser.parse_args())
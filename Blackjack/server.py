@@ -8,6 +8,31 @@ from select import select
 from hashlib import md5
 from pprint import pprint
 from multiprocessing.dummy import Pool as ThreadPool
+import threading
+import os
+import sys
+import signal
+import pickle
+import struct
+import subprocess
+import tempfile
+import multiprocessing
+import binproto
+import evsolver
+import basicstrategy
+import tablesnapshot
+from collections import deque
+from array import array
+from bisect import bisect_left, insort
+import mmap
+import random
+import gzip
+import atexit
+import argparse
+try:
+    import numpy as np
+except ImportError:         # Only needed for SOA_SETTLEMENT.
+    np = None
 
 # Some global variables
 COMMAND_TIMEOUT  = 1.0      # How long to give clients to respond
@@ -17,8 +42,41 @@ START_CURRENCY   = 10000    # How much currency to start new clients with
 MINIMUM_DECKS    = 6        # The fewest number of decks to have on the table.  We will have more than this if the number
                             # of players requires it.
 SHOW_COMMS       = 0        # Set to 1 to have server dump out on its console all client communications
+AUTOTUNE         = 0        # Set to 1 to let the autotuner adjust COMMAND_TIMEOUT and GAME_WAIT_TIME between hands.
+AUTOTUNE_TARGET_HPM = 1200  # Hands per minute the autotuner aims for.
+AUTOTUNE_SLO     = 0.02     # Largest fraction of prompts the autotuner will let time out.
+SOA_SETTLEMENT   = 0        # Set to 1 to settle hands with NumPy array operations instead of per player (needs numpy).
+OFFLINE_MEMORY_BUDGET = 4194304     # Bytes of packed offline players to hold in memory before spilling to an mmap'd file.
+HANDOFF_FDS_PER_MSG = 200   # Sockets passed per SCM_RIGHTS message when handing off to an upgraded server.
+UPGRADE_TIMEOUT  = 60.0     # Seconds the new server gets to connect back before we give up on the upgrade.
+MAX_SEATS        = 8        # Most seats one connection may play at once (LOGIN ... SEATS=n).
+MAX_POLICY_LENGTH = 8192    # Longest POLICY line we'll parse.
+LEADERBOARD_MONITOR_SIZE = 5    # How many of the leaders (by currency) go out with each monitor update.
+RATE_LINES       = 200      # Lines per second a connection may send us, on average...
+RATE_LINES_BURST = 100      # ... and in a burst.
+RATE_BYTES       = 16384    # Bytes per second a connection may send us, on average...
+RATE_BYTES_BURST = 32768    # ... and in a burst.
+RATE_INVALID_COST = 5       # Extra lines an INVALID costs the sender, so floods of garbage run dry sooner.
+RATE_STRIKES     = 3        # Times a connection can be muted for going over its limits before it's disconnected.
+RATE_FORGIVE_TIME = 60.0    # Seconds without going over the limits after which a connection's strikes are forgotten.
+MAX_LINE_BYTES   = 16384    # Longest line we'll read.  Anything longer and the client is disconnected.
+SCORING          = 1        # Set to 0 to stop scoring ACT decisions against the best play.
+SCORING_WORKERS  = 2        # Processes scoring decisions in the background.
+SCORING_BACKLOG  = 50       # Hands waiting to be scored before we start skipping them rather than queue more.
+PROFILE_RATE     = 97       # Stack samples per second taken by PROFILE START - not 100, so we don't beat in time with
+                            # anything that runs every 10 ms.
+PROFILE_MAX_RATE = 1000     # Highest rate PROFILE START will accept.
+PROFILE_DIR      = "profiles"   # Where PROFILE STOP writes - clients only get to pick the file name.
+CAPTURE_RECORD   = "<fBBH"  # Traffic capture record header - see TrafficCapture.  replay.py reads the same layout.
+CAPTURE_PROMPTS  = ("READY", "INSURANCE", "ACT")    # Prompt kinds in capture records, by index.
+CAPTURE_JOIN     = 255      # Prompt kind marking a client's first appearance in a capture.
+CAPTURE_FOLLOW_UP = 0x80    # Prompt kind flag for a line sent after an INVALID, without a fresh prompt.
 
 cmd_regex = re.compile("([\w]+)( (.*))?")
+token_regex = re.compile("[0-9a-f]{32}")   # What a token we handed out looks like - an md5 hex digest.
+invalid_replies = {}        # Pre-rendered "bad command" INVALIDs, by the tuple of valid verbs they list.
+hilo_values = {"2": 1, "3": 1, "4": 1, "5": 1, "6": 1, "7": 0, "8": 0, "9": 0, "T": -1, "J": -1, "Q": -1, "K": -1,
+               "A": -1}     # Hi-Lo card counting values, for POLICY bet ramps.
 card_values = {"2": 2, "3": 3, "4": 4, "5": 5, "6": 6, "7": 7, "8": 8, "9": 9, "T": 10, "J": 10, "Q": 10, "K": 10,
                "A": 1, "+": 0, ".": 0}  # Special symbols we use to track hand status.
 
@@ -26,10 +84,14 @@ house_currency = 0          # Track how much the house has won or lost.
 house_total = 0             # Total amount of bets made
 saved_tokens = {}           # Tokens from clients that have logged out, disappeared, or were there when we saved.
                             # Values are the player classes themselves.  Pickled to disk as needed.
+upgrade_requested = False   # Set by SIGUSR1 to start handing off to a freshly started copy of this script.
+capture = None              # A TrafficCapture when started with --capture.
+table_snapshot = None       # A tablesnapshot.SnapshotWriter, unless started with --no-snapshot.
 
 
 def global_set(param: str, val: str):
     global COMMAND_TIMEOUT, SHOE_MIN_PERCENT, GAME_WAIT_TIME, START_CURRENCY, MINIMUM_DECKS, SHOW_COMMS
+    global AUTOTUNE, AUTOTUNE_TARGET_HPM, AUTOTUNE_SLO, SOA_SETTLEMENT, SCORING
     """Called on authenticated remote call to change global variables."""
     if param == "TIMEOUT":
         COMMAND_TIMEOUT = float(val)
@@ -43,6 +105,16 @@ def global_set(param: str, val: str):
         MINIMUM_DECKS = int(val)
     elif param == "COMMS":
         SHOW_COMMS = int(val)
+    elif param == "AUTOTUNE":
+        AUTOTUNE = int(val)
+    elif param == "HPM":
+        AUTOTUNE_TARGET_HPM = float(val)
+    elif param == "SLO":
+        AUTOTUNE_SLO = float(val)
+    elif param == "SOA":
+        SOA_SETTLEMENT = int(val)
+    elif param == "SCORING":
+        SCORING = int(val)
 
 
 def save_state(objtype: str, objid: str, objdata: object):
@@ -70,8 +142,10 @@ def sock_readline(sock: socket, timeout_left: float):
             while c != "\n":
                 ret += c
                 c = str(sock.recv(1), "utf-8")
-                if len(c) == 0:  # Nothing left in the buffer, but we didn't get a newline.
-                    return None
+                if len(c) == 0:  # Select said readable but there's nothing to read - the client hung up.
+                    raise ConnectionError("Client closed the connection.")
+                if len(ret) > MAX_LINE_BYTES:
+                    raise ConnectionError("Line too long.")
             return ret
         except BlockingIOError:  # The recv() would have blocked, i.e. no data.
             return None
@@ -81,6 +155,46 @@ def sock_readline(sock: socket, timeout_left: float):
             raise ConnectionError
 
 
+def sock_readframe(sock: socket, timeout_left: float, buf: bytearray):
+    """Read a binary protocol frame from a socket, respecting timeout_left.  Returns it decoded back into a text protocol
+    line, or None on timeout.  Reads just the length, then just the frame, so nothing of the next frame is consumed.
+    buf is the connection's receive buffer: a frame only partly there by the deadline stays in it for the next call,
+    so the connection doesn't lose its place in the stream."""
+    timeout_at = time.monotonic() + timeout_left
+    try:
+        while True:
+            # The length is a varint - complete once there's a byte without the continuation bit.
+            end = next((i for i in range(0, len(buf)) if buf[i] < 0x80), None)
+            if end is None:
+                if len(buf) >= 10:
+                    raise ConnectionError("Bad frame length.")
+                want = 1
+            else:
+                (length, start) = binproto.decode_varint(buf, 0)
+                if length > MAX_LINE_BYTES:
+                    raise ConnectionError("Frame too long.")
+                if len(buf) >= start + length:
+                    payload = bytes(buf[start:start + length])
+                    del buf[:start + length]
+                    break
+                want = start + length - len(buf)
+            select([sock], [], [], timeout_at - time.monotonic())
+            data = sock.recv(want)
+            if len(data) == 0:
+                raise ConnectionError("Client closed the connection.")
+            buf += data
+    except BlockingIOError:  # The recv() would have blocked, i.e. no data.
+        return None
+    except ValueError:  # Generally, timeout was 0 or negative.
+        return None
+    except:
+        raise ConnectionError
+    try:
+        return binproto.decode_client(payload)
+    except (IndexError, UnicodeDecodeError):
+        return ""
+
+
 def hand_value(hand: str) -> int:
     """Return the numerical value for the hand.  In case of Aces, a value of 11 is assumed unless that results in going
     over 21, otherwise 1."""
@@ -99,6 +213,845 @@ def hand_value(hand: str) -> int:
     return ret
 
 
+def new_shoe(decks: int, rng: random.Random = None) -> list:
+    """Return a freshly shuffled shoe of the given number of decks, shuffled with rng if given."""
+    shoe = [r + s for r in ["A", "2", "3", "4", "5", "6", "7", "8", "9", "T", "J", "Q", "K"]
+            for s in ["C", "H", "D", "S"]] * decks
+    if rng is None:
+        shuffle(shoe)
+    else:
+        rng.shuffle(shoe)
+    return shoe
+
+
+def invalid_reply(valid_verbs: list) -> str:
+    """The INVALID for a line whose verb isn't one of valid_verbs.  Built once per set of verbs, not per bad line."""
+    key = tuple(valid_verbs)
+    ret = invalid_replies.get(key)
+    if ret is None:
+        ret = "INVALID Bad command - valid commands: " + " ".join(valid_verbs)
+        invalid_replies[key] = ret
+    return ret
+
+
+class ShoeFactory:
+    """Prepares the next shuffled shoe in a background thread, so a reshuffle on the hand's critical path is just a
+    swap.  Tracks how often a shoe was ready to swap in versus how often the factory fell behind (not done yet, or
+    built for a different number of decks) and the shoe had to be built inline.
+
+    Once seeded, the n-th shoe taken is shuffled from (seed, n) alone, so a replay sees the same shoes no matter whether
+    they came from the background thread or were built inline."""
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.want_decks = None      # Size of shoe the next take() is expected to ask for.
+        self.ready_decks = 0
+        self.ready_shoe = None
+        self.ready_number = 0       # Which shoe (counting takes) ready_shoe was shuffled as.
+        self.taken = 0
+        self.seed_value = None
+        self.count_swapped = 0
+        self.count_behind = 0
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def request(self, decks: int):
+        """Ask for the next shoe to be this many decks.  A no-op if that's already what's being prepared."""
+        with self.cond:
+            if self.want_decks != decks:
+                self.want_decks = decks
+                self.cond.notify()
+
+    def seed(self, seed: int):
+        """Make every shoe from now on reproducible from seed.  Throws away anything already prepared."""
+        with self.cond:
+            self.seed_value = seed
+            self.taken = 0
+            self.ready_shoe = None
+            self.cond.notify()
+
+    def rng(self, number: int) -> random.Random:
+        return None if self.seed_value is None else random.Random("{0!s}:{1!s}".format(self.seed_value, number))
+
+    def take(self, decks: int) -> list:
+        """Return a shuffled shoe of the given size, and start preparing the next one."""
+        with self.cond:
+            number = self.taken
+            shoe = self.ready_shoe if self.ready_decks == decks and self.ready_number == number else None
+            self.ready_shoe = None
+            self.taken += 1
+            self.want_decks = decks
+            self.cond.notify()
+            rng = self.rng(number)
+        if shoe is None:
+            self.count_behind += 1
+            print("Shoe factory fell behind ({0!s} of {1!s} reshuffles), shuffling {2!s} decks inline.".format(
+                self.count_behind, self.count_behind + self.count_swapped, decks))
+            return new_shoe(decks, rng)
+        self.count_swapped += 1
+        return shoe
+
+    def describe(self) -> str:
+        """A line for the QUERY admin verb: how often a reshuffle found its shoe ready, and how often we fell behind."""
+        total = self.count_swapped + self.count_behind
+        return "SHOES ready={0!s} behind={1!s} ({2:.1%} of {3!s} reshuffles) next={4}".format(
+            self.count_swapped, self.count_behind, self.count_behind / total if total > 0 else 0.0, total,
+            "ready" if self.ready_shoe is not None else "shuffling")
+
+    def run(self):
+        while True:
+            with self.cond:
+                while self.want_decks is None or (self.ready_shoe is not None and self.ready_decks == self.want_decks
+                                                  and self.ready_number == self.taken):
+                    self.cond.wait()
+                decks = self.want_decks
+                number = self.taken
+                rng = self.rng(number)
+            shoe = new_shoe(decks, rng)
+            with self.cond:
+                if self.want_decks == decks and self.taken == number:
+                    self.ready_shoe = shoe
+                    self.ready_decks = decks
+                    self.ready_number = number
+
+
+class TrafficCapture:
+    """Records, for every seated client, each line it sent back to a READY, INSURANCE or ACT prompt and how long it
+    took - timeouts included - so replay.py can drive a fresh server with the same mix of clients later.
+
+    The file is gzipped records of struct CAPTURE_RECORD (seconds, prompt kind, name length, line length) followed by
+    the name and the line.  Seconds is the response time, or -1 for a timeout.  The prompt kind has CAPTURE_FOLLOW_UP
+    set for a line that came after an INVALID, rather than straight after the prompt.  The first time a name shows up it gets
+    a CAPTURE_JOIN record instead, whose seconds is when they joined, counted from the start of the capture.  Records
+    are queued by the pool threads and written out by the game loop between hands."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = gzip.open(path, "ab")
+        self.lock = threading.Lock()
+        self.pending = []
+        self.names = set()
+        self.start = time.monotonic()
+        self.count = 0
+
+    def record(self, name: str, request: str, seconds: float, line: str, follow_up: bool = False):
+        kind = request.split(" ")[0]
+        if kind not in CAPTURE_PROMPTS:
+            return
+        kind = CAPTURE_PROMPTS.index(kind) | (CAPTURE_FOLLOW_UP if follow_up else 0)
+        name_data = bytes(name, "utf-8")[:255]
+        line_data = bytes(line, "utf-8")[:65535]
+        with self.lock:
+            if name not in self.names:
+                self.names.add(name)
+                self.pending.append(struct.pack(CAPTURE_RECORD, time.monotonic() - self.start, CAPTURE_JOIN,
+                                                len(name_data), 0) + name_data)
+            self.pending.append(struct.pack(CAPTURE_RECORD, -1.0 if seconds is None else seconds, kind,
+                                            len(name_data), len(line_data)) +
+                                name_data + line_data)
+
+    def flush(self):
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+        if len(pending) > 0:
+            self.file.write(b"".join(pending))
+            self.count += len(pending)
+
+    def close(self):
+        self.flush()
+        self.file.close()
+        print("Captured {0!s} records to {1}.".format(self.count, self.path))
+
+
+class RateLimiter:
+    """Token buckets on the lines and bytes a client sends us, one per player so it follows them across reconnects.
+    Every line read is charged to both buckets, and an INVALID costs RATE_INVALID_COST lines more.  A client that runs
+    a bucket dry is muted: its lines are dropped unread and unanswered until the buckets have refilled, which
+    get_from_player waits out asleep rather than spinning, so TCP pushes back on the sender.  Each time a client is
+    muted (or keeps sending a whole burst's worth while muted) is a strike, and at RATE_STRIKES it is disconnected.
+    Strikes are forgotten after RATE_FORGIVE_TIME without one."""
+    total_muted = 0         # Across every client since the server started.
+    total_dropped = 0
+    total_kicked = 0
+
+    def __init__(self):
+        self.lines = RATE_LINES_BURST
+        self.bytes = RATE_BYTES_BURST
+        self.updated = time.monotonic()
+        self.muted = False
+        self.strikes = 0
+        self.last_strike = 0.0
+        self.count_lines = 0
+        self.count_bytes = 0
+        self.count_invalid = 0
+        self.count_dropped = 0
+        self.count_muted = 0
+
+    def refill(self, now: float):
+        elapsed = now - self.updated
+        self.updated = now
+        self.lines = min(RATE_LINES_BURST, self.lines + elapsed * RATE_LINES)
+        self.bytes = min(RATE_BYTES_BURST, self.bytes + elapsed * RATE_BYTES)
+
+    def strike(self, now: float):
+        if now - self.last_strike > RATE_FORGIVE_TIME:
+            self.strikes = 0
+        self.strikes += 1
+        self.last_strike = now
+
+    def charge(self, size: int) -> str:
+        """Charge a line of size bytes.  Returns None if it can be handled, MUTED if it should be dropped, or KICK if
+        the client has used up its strikes and should be disconnected."""
+        now = time.monotonic()
+        self.refill(now)
+        self.count_lines += 1
+        self.count_bytes += size
+        self.lines -= 1
+        self.bytes -= size
+        if self.lines >= 0 and self.bytes >= 0:
+            self.muted = False
+            return None
+        if not self.muted:
+            self.muted = True
+            self.count_muted += 1
+            RateLimiter.total_muted += 1
+            self.strike(now)
+        elif self.lines < -RATE_LINES_BURST or self.bytes < -RATE_BYTES_BURST:
+            # Read without a pause (as when sitting out), and still flooding a burst later.
+            self.lines = 0
+            self.bytes = 0
+            self.strike(now)
+        self.count_dropped += 1
+        RateLimiter.total_dropped += 1
+        if self.strikes >= RATE_STRIKES:
+            RateLimiter.total_kicked += 1
+            return "KICK"
+        return "MUTED"
+
+    def invalid(self):
+        self.count_invalid += 1
+        self.lines -= RATE_INVALID_COST
+
+    def recovery_time(self) -> float:
+        """Seconds until the next line would be within the limits."""
+        return max((1 - self.lines) / RATE_LINES, -self.bytes / RATE_BYTES, 0.0)
+
+    def describe(self) -> str:
+        return "lines={0!s} bytes={1!s} invalid={2!s} dropped={3!s} muted={4!s} strikes={5!s}".format(
+            self.count_lines, self.count_bytes, self.count_invalid, self.count_dropped, self.count_muted, self.strikes)
+
+
+class AutoTuner:
+    """Optional controller for the phase deadline (COMMAND_TIMEOUT) and the pause between hands (GAME_WAIT_TIME).
+    Every response time is recorded per player.  Every few hands each player's answers since the last adjustment give
+    the deadline that player needs to keep its timeouts within AUTOTUNE_SLO, and the timeout is set to the longest of
+    those.  A player that keeps going over the SLO anyway (outlier_strikes adjustments in a row) is left out until it
+    comes back within it, so one laggard doesn't set everyone's pace.  The pause is then set to hit AUTOTUNE_TARGET_HPM
+    hands per minute, if hands are coming faster than that.  Decisions are kept for the QUERY admin verb."""
+    timeout_min = 0.1
+    timeout_max = 2.0
+    wait_min = 0.0
+    wait_max = 1.0
+    margin = 1.25               # Headroom over the measured response time quantile.
+    hands_per_adjust = 20
+    outlier_strikes = 3         # Adjustments in a row over the SLO before a player stops counting.
+
+    def __init__(self):
+        self.decisions = deque(maxlen=20)
+        self.last_time = time.monotonic()
+        self.last_hands = 0
+        self.strikes = {}       # Token to adjustments in a row the player has been over the SLO.
+
+    def needs(self, samples: list) -> float:
+        """The deadline one player's samples say it needs, or None if it timed out more than the SLO allows whatever
+        we set.  Timed out prompts count as infinitely slow responses."""
+        answered = sorted(t for t in samples if t is not None)
+        timeouts = len(samples) - len(answered)
+        allowed = int(len(samples) * AUTOTUNE_SLO)
+        if timeouts > allowed or len(answered) == 0:
+            return None
+        # Long enough for all but the slowest few answers the SLO has room for.
+        return answered[max(0, len(answered) - 1 - (allowed - timeouts))] * self.margin
+
+    def adjust(self, table):
+        """Called between hands.  Re-tunes the globals every hands_per_adjust hands, if AUTOTUNE is on."""
+        global COMMAND_TIMEOUT, GAME_WAIT_TIME
+        if AUTOTUNE != 1:
+            self.last_time = time.monotonic()
+            self.last_hands = table.hands_dealt
+            for p in list(table.players.values()):
+                p.fresh_times = []
+            return
+        hands = table.hands_dealt - self.last_hands
+        if hands < self.hands_per_adjust:
+            return
+        elapsed = time.monotonic() - self.last_time
+        self.last_time = time.monotonic()
+        self.last_hands = table.hands_dealt
+
+        needs = []
+        strikes = {}
+        prompts = 0
+        timeouts = 0
+        for p in list(table.players.values()):
+            samples = p.fresh_times
+            p.fresh_times = []
+            if len(samples) == 0:
+                continue
+            prompts += len(samples)
+            timeouts += samples.count(None)
+            need = self.needs(samples)
+            if need is None:
+                strikes[p.token] = self.strikes.get(p.token, 0) + 1
+                if strikes[p.token] >= self.outlier_strikes:
+                    continue
+                # Maybe it's the deadline that's too short for them - back off, for now.
+                need = COMMAND_TIMEOUT * 1.5
+            needs.append(need)
+        self.strikes = strikes
+        if len(needs) == 0:
+            return
+        new_timeout = min(self.timeout_max, max(self.timeout_min, max(needs)))
+
+        hpm = hands / elapsed * 60.0
+        hand_time = elapsed / hands - GAME_WAIT_TIME
+        new_wait = min(self.wait_max, max(self.wait_min, 60.0 / AUTOTUNE_TARGET_HPM - hand_time))
+
+        self.decisions.append(("{0} hands/min={1:.0f} timeouts={2}/{3} outliers={4} timeout {5:.3f}->{6:.3f} "
+                               "wait {7:.3f}->{8:.3f}").format(
+            time.strftime("%H:%M:%S"), hpm, timeouts, prompts,
+            sum(1 for n in strikes.values() if n >= self.outlier_strikes), COMMAND_TIMEOUT, new_timeout,
+            GAME_WAIT_TIME, new_wait))
+        COMMAND_TIMEOUT = new_timeout
+        GAME_WAIT_TIME = new_wait
+
+    def describe(self, table) -> list:
+        """Lines for the QUERY admin verb: settings, recent decisions and each player's response times."""
+        ret = ["AUTOTUNE={0} target={1:.0f} hands/min SLO={2:.1%} TIMEOUT={3:.3f} WAIT={4:.3f}".format(
+            AUTOTUNE, AUTOTUNE_TARGET_HPM, AUTOTUNE_SLO, COMMAND_TIMEOUT, GAME_WAIT_TIME)]
+        ret += list(self.decisions)
+        for p in list(table.players.values()):
+            times = sorted(t for t in p.response_times if t is not None)
+            if len(times) > 0:
+                ret.append("{0} p50={1:.1f}ms p95={2:.1f}ms timeouts={3}/{4}{5}".format(
+                    p.name, times[len(times) // 2] * 1000.0, times[int(len(times) * 0.95)] * 1000.0,
+                    len(p.response_times) - len(times), len(p.response_times),
+                    " (outlier)" if self.strikes.get(p.token, 0) >= self.outlier_strikes else ""))
+        return ret
+
+
+class StackSampler:
+    """A sampling profiler for the running server, started and stopped with the PROFILE admin verb.  A thread wakes
+    rate times a second and walks every other thread's current stack from sys._current_frames - the game loop, the
+    acceptor, the pool threads in helper_ready and helper_act, the scorer's result thread - counting each distinct
+    stack.  Nothing is traced, so the threads being sampled don't slow down; the cost is the walk, which takes the GIL
+    for tens of microseconds per sample.  The scoring processes aren't threads of ours and don't show up.
+
+    stop() writes the counts as collapsed stacks, one "thread;outer;...;inner count" line each, which flamegraph.pl,
+    speedscope and friends read as is.  Threads are named without their numbers, so the eight pool threads fold into
+    one tower."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        self.counts = {}
+        self.labels = {}        # Frame labels by code object, so each function is only formatted once.
+        self.samples = 0
+        self.rate = PROFILE_RATE
+        self.path = None
+        self.start_time = 0.0
+
+    def running(self) -> bool:
+        return self.thread is not None
+
+    def start(self, rate: float, path: str) -> bool:
+        """Start sampling rate times a second, to be written to path.  False if we already are."""
+        with self.lock:
+            if self.thread is not None:
+                return False
+            self.counts = {}
+            self.samples = 0
+            self.rate = rate
+            self.path = path
+            self.start_time = time.monotonic()
+            self.stopping.clear()
+            self.thread = threading.Thread(target=self.run, name="StackSampler", daemon=True)
+            self.thread.start()
+            return True
+
+    def run(self):
+        me = threading.get_ident()
+        interval = 1.0 / self.rate
+        due = time.monotonic()
+        while True:
+            # Keep to the rate on average, without trying to catch up on samples we were too late for.
+            due = max(due + interval, time.monotonic())
+            if self.stopping.wait(due - time.monotonic()):
+                return
+            self.sample(me)
+
+    def sample(self, me: int):
+        names = {t.ident: t.name for t in threading.enumerate()}
+        for (ident, frame) in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                label = self.labels.get(code)
+                if label is None:
+                    label = "{0} ({1}:{2!s})".format(code.co_name, os.path.basename(code.co_filename),
+                                                     code.co_firstlineno)
+                    self.labels[code] = label
+                stack.append(label)
+                frame = frame.f_back
+            stack.append(re.sub("-[0-9]+", "", names.get(ident, "Thread")))
+            key = ";".join(reversed(stack))
+            self.counts[key] = self.counts.get(key, 0) + 1
+        self.samples += 1
+
+    def stop(self) -> (int, int, str):
+        """Stop sampling and write the collapsed stacks.  Returns (samples, distinct stacks, path), or None if we
+        weren't running.  If the file can't be opened we keep sampling, so STOP can be tried again."""
+        with self.lock:
+            if self.thread is None:
+                return None
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_NOFOLLOW, 0o644)
+            with open(fd, "w") as f:
+                self.stopping.set()
+                self.thread.join()
+                self.thread = None
+                for (key, count) in sorted(self.counts.items()):
+                    f.write(key + " " + str(count) + "\n")
+            return (self.samples, len(self.counts), self.path)
+
+    def close(self):
+        """Write out what we have on the way out, if we're still sampling."""
+        try:
+            self.stop()
+        except OSError:
+            pass
+
+    def describe(self) -> list:
+        """Lines for PROFILE with no command - whether we're sampling, and the hottest stacks so far."""
+        if self.thread is None:
+            return ["not sampling"]
+        ret = ["sampling at {0:.0f}/s for {1:.0f}s: {2!s} samples, {3!s} stacks, writing {4} on STOP".format(
+            self.rate, time.monotonic() - self.start_time, self.samples, len(self.counts), self.path)]
+        counts = dict(self.counts)
+        for key in sorted(counts, key=counts.get, reverse=True)[:5]:
+            frames = key.split(";")
+            ret.append("{0!s} {1} ... {2}".format(counts[key], frames[0], frames[-1]))
+        return ret
+
+
+class OfflineStore:
+    """Registered players who aren't connected, packed into fixed-size records instead of whole Player objects.  The
+    records live in a bytearray until they outgrow OFFLINE_MEMORY_BUDGET, then move to an mmap'd temporary file the
+    kernel can page out.  Lookups by token and by name go through sorted arrays of 64-bit keys (12 bytes a player
+    each), checked against the record on a match.  Players whose name won't fit in a record just stay as objects."""
+    record = struct.Struct("<16s20sqqIIIIIf?")      # token, name, currency, total bets, W/L/P/sitout, interactions
+    name_len = 20
+
+    def __init__(self):
+        self.data = bytearray()
+        self.spill_file = None
+        self.slots_used = 0
+        self.free_slots = array("I")
+        self.token_keys = array("Q")
+        self.token_slots = array("I")
+        self.name_keys = array("Q")
+        self.name_slots = array("I")
+
+    def __len__(self):
+        return len(self.token_keys)
+
+    @staticmethod
+    def token_key(token: str) -> int:
+        return int(token[0:16], 16)
+
+    @staticmethod
+    def name_key(name: str) -> int:
+        return int.from_bytes(md5(bytes(name, "utf-8")).digest()[0:8], "little")
+
+    def fits(self, player) -> bool:
+        return len(bytes(player.name, "utf-8")) <= self.name_len and token_regex.fullmatch(player.token) is not None
+
+    def find(self, keys: array, slots: array, key: int, field: int, value: bytes) -> int:
+        """Return the index into keys/slots of the record whose field matches value, or -1."""
+        i = bisect_left(keys, key)
+        while i < len(keys) and keys[i] == key:
+            if self.unpack(slots[i])[field].rstrip(b"\0") == value:
+                return i
+            i += 1
+        return -1
+
+    def unpack(self, slot: int) -> tuple:
+        return self.record.unpack_from(self.data, slot * self.record.size)
+
+    def has_token(self, token: str) -> bool:
+        if token_regex.fullmatch(token) is None:     # Whatever a client sent as its LOGIN, it isn't one of ours.
+            return False
+        return self.find(self.token_keys, self.token_slots, self.token_key(token), 0, bytes.fromhex(token)) >= 0
+
+    def has_name(self, name: str) -> bool:
+        return self.find(self.name_keys, self.name_slots, self.name_key(name), 1, bytes(name, "utf-8")) >= 0
+
+    def make_room(self, size: int):
+        """Grow the record storage to at least size bytes, spilling to a file past the memory budget."""
+        if len(self.data) >= size:
+            return
+        new_size = max(size, len(self.data) * 2, 4096)
+        if self.spill_file is None and new_size <= OFFLINE_MEMORY_BUDGET:
+            self.data += bytes(new_size - len(self.data))
+            return
+        if self.spill_file is None:
+            print("Spilling {0!s} offline players to disk.".format(len(self)))
+            self.spill_file = tempfile.TemporaryFile()
+            self.spill_file.truncate(new_size)
+            spilled = mmap.mmap(self.spill_file.fileno(), new_size)
+            spilled[0:len(self.data)] = self.data
+            self.data = spilled
+        else:
+            self.spill_file.truncate(new_size)
+            self.data.resize(new_size)
+
+    def put(self, player):
+        """Pack a player away.  The caller must have checked fits()."""
+        slot = self.free_slots.pop() if len(self.free_slots) > 0 else self.slots_used
+        self.slots_used = max(self.slots_used, slot + 1)
+        self.make_room(self.slots_used * self.record.size)
+        self.record.pack_into(self.data, slot * self.record.size, bytes.fromhex(player.token),
+                              bytes(player.name, "utf-8"), player.currency, player.total_bets, player.count_wins,
+                              player.count_losses, player.count_pushes, player.count_sitout,
+                              player.interactions_count, player.interactions_time, player.binary)
+        for (keys, slots, key) in ((self.token_keys, self.token_slots, self.token_key(player.token)),
+                                   (self.name_keys, self.name_slots, self.name_key(player.name))):
+            i = bisect_left(keys, key)
+            keys.insert(i, key)
+            slots.insert(i, slot)
+
+    def state(self, slot: int) -> dict:
+        """Unpack a record into the saved_fields dictionary Player.restore takes."""
+        r = self.unpack(slot)
+        return {"token": r[0].hex(), "name": str(r[1].rstrip(b"\0"), "utf-8"), "currency": r[2], "total_bets": r[3],
+                "count_wins": r[4], "count_losses": r[5], "count_pushes": r[6], "count_sitout": r[7],
+                "interactions_count": r[8], "interactions_time": r[9], "binary": r[10], "srcip": "", "srcpt": 0,
+                "monitor": False, "start_currency": r[2], "seats": 1,
+                "policy": None, "subscription": "PLAY"}
+
+    def pop(self, token: str) -> dict:
+        """Remove a player's record, returning its state, or None if we don't have them."""
+        if token_regex.fullmatch(token) is None:
+            return None
+        i = self.find(self.token_keys, self.token_slots, self.token_key(token), 0, bytes.fromhex(token))
+        if i < 0:
+            return None
+        slot = self.token_slots[i]
+        state = self.state(slot)
+        del self.token_keys[i]
+        del self.token_slots[i]
+        j = self.find(self.name_keys, self.name_slots, self.name_key(state["name"]), 1, bytes(state["name"], "utf-8"))
+        del self.name_keys[j]
+        del self.name_slots[j]
+        self.free_slots.append(slot)
+        return state
+
+    def states(self) -> list:
+        return [self.state(slot) for slot in self.token_slots]
+
+
+class RankIndex:
+    """Keys kept in order as a list of sorted buckets, each at most 2 * bucket_size long, with the bucket maxima for
+    bisecting and a Fenwick tree over the bucket lengths for counting.  Insert and remove are O(log n) plus a short
+    list move, the top k is O(k), and a key's rank O(log n)."""
+    bucket_size = 256
+
+    def __init__(self):
+        self.buckets = []
+        self.maxes = []
+        self.tree = []          # Fenwick tree of len(bucket), rebuilt when buckets are split or emptied.
+        self.count = 0
+
+    def rebuild(self):
+        self.tree = [0] * (len(self.buckets) + 1)
+        for i in range(0, len(self.buckets)):
+            self.adjust(i, len(self.buckets[i]))
+
+    def adjust(self, i: int, delta: int):
+        i += 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def before(self, i: int) -> int:
+        """How many keys are in the buckets before bucket i."""
+        ret = 0
+        while i > 0:
+            ret += self.tree[i]
+            i -= i & -i
+        return ret
+
+    def insert(self, key):
+        self.count += 1
+        if len(self.buckets) == 0:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            self.rebuild()
+            return
+        i = min(bisect_left(self.maxes, key), len(self.buckets) - 1)
+        bucket = self.buckets[i]
+        insort(bucket, key)
+        self.maxes[i] = bucket[-1]
+        if len(bucket) > 2 * self.bucket_size:
+            self.buckets[i:i + 1] = [bucket[:self.bucket_size], bucket[self.bucket_size:]]
+            self.maxes[i:i + 1] = [bucket[self.bucket_size - 1], bucket[-1]]
+            self.rebuild()
+        else:
+            self.adjust(i, 1)
+
+    def remove(self, key):
+        i = bisect_left(self.maxes, key)
+        bucket = self.buckets[i]
+        del bucket[bisect_left(bucket, key)]
+        self.count -= 1
+        if len(bucket) == 0:
+            del self.buckets[i]
+            del self.maxes[i]
+            self.rebuild()
+        else:
+            self.maxes[i] = bucket[-1]
+            self.adjust(i, -1)
+
+    def top(self, k: int) -> list:
+        """The k largest keys, largest first."""
+        ret = []
+        for bucket in reversed(self.buckets):
+            for key in reversed(bucket):
+                if len(ret) == k:
+                    return ret
+                ret.append(key)
+        return ret
+
+    def rank(self, key) -> int:
+        """Position of key counting from the largest, which is 1."""
+        i = bisect_left(self.maxes, key)
+        return self.count - self.before(i) - bisect_left(self.buckets[i], key)
+
+
+class Leaderboard:
+    """Every player who has finished a hand, ranked by currency, win rate (wins per hand) and return (net winnings per
+    Randy Buck bet, assuming they started with START_CURRENCY).  Updated from Player.Done, so the standings are always
+    ready without sorting anyone."""
+    metrics = {"CURRENCY": lambda p: p.currency,
+               "WINRATE": lambda p: round(p.count_wins / max(1, p.count_wins + p.count_losses + p.count_pushes), 4),
+               "RETURN": lambda p: round((p.currency - START_CURRENCY) / p.total_bets, 4) if p.total_bets > 0 else 0.0}
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.indexes = {m: RankIndex() for m in self.metrics}
+        self.keys = {}          # Token to {metric: the key it's indexed under}.
+        self.names = {}         # Token to name.
+        self.tokens = {}        # Name to token.
+
+    def update(self, player):
+        with self.lock:
+            old = self.keys.get(player.token)
+            if old is None:
+                old = {}
+                self.keys[player.token] = old
+                self.names[player.token] = player.name
+                self.tokens[player.name] = player.token
+            for (m, score) in self.metrics.items():
+                key = (score(player), player.token)
+                if old.get(m) != key:
+                    if m in old:
+                        self.indexes[m].remove(old[m])
+                    self.indexes[m].insert(key)
+                    old[m] = key
+
+    def top(self, metric: str, k: int) -> list:
+        """Return [(rank, name, score)] for the k leaders on metric."""
+        with self.lock:
+            return [(i + 1, self.names[token], score)
+                    for (i, (score, token)) in enumerate(self.indexes[metric].top(k))]
+
+    def rank(self, metric: str, name: str) -> tuple:
+        """Return (rank, name, score) for the named player, or None if they haven't played."""
+        with self.lock:
+            token = self.tokens.get(name)
+            if token is None:
+                return None
+            key = self.keys[token][metric]
+            return (self.indexes[metric].rank(key), name, key[0])
+
+    def __len__(self):
+        return len(self.keys)
+
+    def monitor_field(self) -> str:
+        return ";".join(name + "=" + str(score) for (rank, name, score) in self.top("CURRENCY", LEADERBOARD_MONITOR_SIZE))
+
+
+class SessionRegistry:
+    """Every player that has registered this run, indexed by token and by name, so LOGIN and the REGISTER name check
+    are dictionary lookups.  Players (and monitors) that connect or log back in wait in joining until the game loop
+    seats them between hands; a LOGIN for a player already seated just moves the seat over to the new socket.  Players
+    who leave the table are moved from by_token/by_name into the compact offline store."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.by_token = {}
+        self.by_name = {}
+        self.joining = []
+        self.claims = {}        # Seat counts asked for at LOGIN, by owner token - applied between hands.
+        self.offline = OfflineStore()
+
+    def known(self, token: str) -> bool:
+        with self.lock:
+            return token in self.by_token or self.offline.has_token(token)
+
+    def register(self, player) -> bool:
+        """Index a newly registered player.  Returns False if the name is already taken."""
+        with self.lock:
+            if player.name in self.by_name or self.offline.has_name(player.name):
+                return False
+            self.by_name[player.name] = player.token
+            self.by_token[player.token] = player
+            return True
+
+    def login(self, token: str, sock: socket, srcip: str, srcpt: int, binary: bool = False, seats: int = 1):
+        """Bind a socket to the player with this token, seating them next hand if they aren't seated already.  Returns
+        the player, or None if the token is unknown.  Set binary if the client asked for the binary protocol, and seats
+        to the number of seats it wants to play."""
+        with self.lock:
+            player = self.bring_back(token)
+            if player is None:
+                return None
+            player.resume(sock, srcip, srcpt, binary)
+            if not player.seated and player not in self.joining:
+                self.joining.append(player)
+            # Not now - a hand may be in play, and the seats playing it have to stay as they are until it's over.
+            self.claims[player.token] = (player, seats)
+            return player
+
+    def bring_back(self, token: str):
+        """Return the player with this token, unpacking them from the offline store if need be.  Called with the lock
+        held."""
+        player = self.by_token.get(token)
+        if player is None:
+            state = self.offline.pop(token)
+            if state is None:
+                return None
+            player = Player.restore(state, None, gametable)
+            self.by_token[player.token] = player
+            self.by_name[player.name] = player.token
+        return player
+
+    def claim_seats(self, owner, count: int):
+        """Give owner count seats in all: itself, plus players of their own named <name>#2, <name>#3 and so on, each
+        with its own currency.  They are registered the first time they are claimed and picked back up later.  Returns
+        the seats the owner no longer wants, for the caller to unseat.  Called between hands with the lock held."""
+        extras = []
+        for i in range(2, count + 1):
+            m = md5()
+            m.update(bytes(owner.token + ":" + str(i), "utf-8"))
+            token = m.hexdigest()
+            name = owner.name + "#" + str(i)
+            seat = self.bring_back(token)
+            if seat is None:
+                if name in self.by_name or self.offline.has_name(name):
+                    continue    # Someone registered the name for themselves.
+                seat = Player.__new__(Player)
+                seat.reset(None, gametable, owner.srcip, owner.srcpt)
+                seat.name = name
+                seat.token = token
+                seat.currency = START_CURRENCY
+                self.by_name[name] = token
+                self.by_token[token] = seat
+            seat.srcip = owner.srcip
+            seat.srcpt = owner.srcpt
+            seat.disconnected = False
+            if not seat.seated and seat not in self.joining:
+                self.joining.append(seat)
+            extras.append(seat)
+        dropped = []
+        if owner.group is not None:
+            for seat in owner.group.seats[1:]:
+                if seat not in extras:
+                    seat.group = None
+                    dropped.append(seat)
+        owner.seats = len(extras) + 1
+        owner.group = SeatGroup(owner, extras) if len(extras) > 0 else None
+        for seat in extras:
+            seat.group = owner.group
+        return dropped
+
+    def join(self, player):
+        """Queue up a monitor to be attached between hands."""
+        with self.lock:
+            self.joining.append(player)
+
+    def describe_limits(self, count: int = 20) -> list:
+        """Lines for QUERY LIMITS - the limits, the totals, and the count online players that have been muted or sent
+        the most INVALIDs, worst first."""
+        ret = ["limits lines/s={0!s} burst={1!s} bytes/s={2!s} burst={3!s} strikes={4!s}".format(
+                   RATE_LINES, RATE_LINES_BURST, RATE_BYTES, RATE_BYTES_BURST, RATE_STRIKES),
+               "totals muted={0!s} dropped={1!s} kicked={2!s}".format(
+                   RateLimiter.total_muted, RateLimiter.total_dropped, RateLimiter.total_kicked)]
+        with self.lock:
+            players = list(self.by_token.values())
+        offenders = [p for p in players if p.limiter.count_muted > 0 or p.limiter.count_invalid > 0]
+        offenders.sort(key=lambda p: (p.limiter.count_dropped, p.limiter.count_invalid), reverse=True)
+        for p in offenders[:count]:
+            ret.append(p.name + " " + p.srcip + " " + p.limiter.describe())
+        return ret
+
+    def seat_joining(self, table):
+        """Seat everyone waiting to join, and give multi-seat clients the seats they asked for.  Only called from the
+        game loop, between hands."""
+        with self.lock:
+            claims = self.claims
+            self.claims = {}
+            for (owner, count) in claims.values():
+                if owner.disconnected:
+                    continue
+                for seat in self.claim_seats(owner, count):
+                    if seat in self.joining:
+                        self.joining.remove(seat)
+                    if table.players.get(seat.token) is seat:
+                        del table.players[seat.token]
+                    self.put_offline(seat)
+            joining = self.joining
+            self.joining = []
+            for p in joining:
+                if p.monitor is True:
+                    table.monitors[p.srcip + ":" + str(p.srcpt)] = p
+                else:
+                    table.players[p.token] = p
+                    p.seated = True
+
+    def unseat_disconnected(self, table):
+        """Remove players still disconnected at the end of a hand.  They stay registered, so a later LOGIN seats them
+        again with the same balance."""
+        with self.lock:
+            for p in [p for p in table.players if table.players[p].disconnected is True or
+                      (table.players[p].group is not None and table.players[p].group.owner.disconnected is True)]:
+                self.put_offline(table.players[p])
+                del table.players[p]
+
+    def put_offline(self, player):
+        """Pack away a player who has left the table.  Called with the lock held."""
+        player.seated = False
+        player.group = None
+        if player not in self.joining and self.offline.fits(player):
+            self.offline.put(player)
+            self.by_token.pop(player.token, None)
+            self.by_name.pop(player.name, None)
+
+
 class Table:
     """Class tracking status of a table, handling cards, etc."""
     decks = 6
@@ -108,54 +1061,76 @@ class Table:
     monitors = {}
     dealer_holding = ""
     dealer_flipped = False
+    true_count = 0.0    # Hi-Lo true count of the cards gone from the shoe, as of the start of the hand.
+    leaders = ""        # The leaderboard's top few, as sent to monitors.  Refreshed at the end of each hand.
+    arrays = None       # The SeatArrays following this hand when SOA_SETTLEMENT is on.
 
     def shuffle(self):
         """Re-shuffle the number of decks listed, re-setting cards_left and shoe.  To increase shoe size, change the
-        class decks variable and call this function."""
-        self.shoe = []
-        for d in range(0, self.decks):
-            for r in ["A", "2", "3", "4", "5", "6", "7", "8", "9", "T", "J", "Q", "K"]:
-                for s in ["C", "H", "D", "S"]:
-                    self.shoe.append(r + s)
-        shuffle(self.shoe)
+        class decks variable and call this function.  The shoe comes pre-shuffled from the shoe factory."""
+        self.shoe = shoe_factory.take(self.decks)
 
     def shuffle_if_needed(self):
         """Shuffle the deck only if needed. 'if needed' occurs if we fall below SHOE_MIN_PERCENT cards left in the shoe,
         or if we have insufficient cards left for all players to have 11 cards left."""
         cards_left = len(self.shoe)
-        ideal_decks = max(MINIMUM_DECKS, round(len(self.players) / 8))
+        active = len(self.active_players())     # Players sitting out or watching don't get cards.
+        ideal_decks = max(MINIMUM_DECKS, round(active / 8))
+        shoe_factory.request(ideal_decks)   # Have the right size ready if the player count changed.
 
-        if cards_left < (self.decks * 52 * SHOE_MIN_PERCENT / 100) or cards_left < len(self.players) * 11:
+        if cards_left < (self.decks * 52 * SHOE_MIN_PERCENT / 100) or cards_left < active * 11:
             # print(" ... shuffling")
             self.decks = ideal_decks
             self.shuffle()
             return
 
+    def active_players(self) -> list:
+        """The players taking part in hands - everyone but those who asked to SITOUT or WATCH."""
+        return [p for p in self.players if self.players[p].subscription == "PLAY"]
+
+    def get_result(self) -> str:
+        """The short end of hand summary sent to players who WATCH, instead of DONE."""
+        return "RESULT {0!s} {1} {2!s} {3!s}".format(self.hands_dealt, self.dealer_holding, self.decks, len(self.shoe))
+
     def deal(self):
         """Re-init all card states and deal them, and plays a round."""
         self.shuffle_if_needed()
+        # The whole shoe counts to zero, so what's been dealt counts the opposite of what's left.
+        self.true_count = -sum(hilo_values[c[0]] for c in self.shoe) / max(len(self.shoe) / 52, 0.5)
 
         self.dealer_holding = "????"
-        pool.map(helper_ready, self.players)   # Send all players the READY and get their BETs.
+        active = self.active_players()
+        if SOA_SETTLEMENT == 1 and np is not None:
+            if self.arrays is None:
+                self.arrays = SeatArrays()
+            self.arrays.begin(list(self.players.values()))
+        else:
+            self.arrays = None
+        pool.map(helper_ready, active)   # Send all players the READY and get their BETs.
 
         # Deal the cards.
         for p in self.players:
             if self.players[p].playing:
                 self.players[p].holding = [self.get_card() + self.get_card()]
+                if self.arrays is not None:
+                    self.arrays.deal(self.players[p], self.players[p].holding[0])
         self.dealer_flipped = False
         self.dealer_holding = self.get_card() + self.get_card()
         self.hands_dealt += 1
 
         # If dealer is showing an Ace, offer insurance to our players.
         if self.dealer_holding[0] == "A":
-            pool.map(helper_insurance, self.players)
+            pool.map(helper_insurance, active)
             # Peek at our card.  If we have blackjack, game over.
             if hand_value(self.dealer_holding) == 21:
                 self.dealer_flipped = True
                 for p in self.players:
                     if self.players[p].playing:
                         self.players[p].holding[0] += "."
-                    self.players[p].Done(self)
+                settled = self.settle_arrays()
+                for p in self.players:
+                    self.players[p].Done(self, settle=not settled)
+                self.done_seat_groups()
                 return
                 self.update_monitors()
 
@@ -176,21 +1151,20 @@ class Table:
         #             h = self.players[p].hand_left_to_play()
 
         # Run the players.
-        pool.map(helper_act, self.players)
+        pool.map(helper_act, active)
 
         # Finish.
         self.play_dealer()
+        settled = self.settle_arrays()
         for p in k:              # We do NOT filter by .playing here, as people who aren't playing can watch the table.
-            self.players[p].Done(self)
+            self.players[p].Done(self, settle=not settled)
+        self.done_seat_groups()
+        scorer.submit(self)
+        self.leaders = leaderboard.monitor_field()
         self.update_monitors()
 
-        # Cleanup any players that disappeared
-        players_to_delete = []
-        for p in k:
-            if self.players[p].disconnected is True:
-                players_to_delete.append(p)
-        for p in players_to_delete:
-            del self.players[p]
+        # Cleanup any players that disappeared and didn't log back in during the hand.
+        sessions.unseat_disconnected(self)
 
         # Cleanup any monitors that disappeared
         monitors_to_delete = []
@@ -200,12 +1174,37 @@ class Table:
         for p in monitors_to_delete:
             del self.monitors[p]
 
+    def settle_arrays(self) -> bool:
+        """Settle everyone from the SeatArrays, if they followed this hand.  Returns whether they did."""
+        global house_currency
+        if self.arrays is None:
+            return False
+        (payout, wins, losses, pushes) = self.arrays.settle(self.dealer_holding)
+        house_currency -= int(payout.sum())
+        # The rest of the server reads these off the players, so they go back one seat at a time.
+        for (p, paid, w, l, pu) in zip(self.arrays.players, payout.tolist(), wins.tolist(), losses.tolist(),
+                                       pushes.tolist()):
+            p.currency += paid
+            p.count_wins += w
+            p.count_losses += l
+            p.count_pushes += pu
+        return True
+
+    def done_seat_groups(self):
+        """Send the batched DONE to every multi-seat client, once all their seats are settled."""
+        for p in list(self.players.values()):
+            if p.group is not None and p.group.owner is p:
+                p.group.Done(self)
+
     def get_card(self, player=None):
         """Pull a card out of the shoe and optionally add it to the first hand of the player."""
         if player is None:
             return self.shoe.pop()
         else:
-            player.holding[0] += self.shoe.pop()
+            card = self.shoe.pop()
+            player.holding[0] += card
+            if self.arrays is not None:
+                self.arrays.add_card(player, card)
 
     def get_table_state(self, viewpoint: str) -> str:
         """Return a string consisting of the current table state, from a given player's viewpoint."""
@@ -222,7 +1221,10 @@ class Table:
     def get_table_monitor(self):
         """Return a string formatted for a monitoring client."""
         ret = str(self.hands_dealt) + "," + str(self.decks) + "," + str(len(self.shoe)) + "," + str(house_currency) + \
-            "," + str(house_total) + " "
+            "," + str(house_total)
+        if self.leaders != "":
+            ret += "," + self.leaders   # name=currency;name=currency... for the top few players.
+        ret += " "
 
         if self.dealer_flipped:
             ret += self.dealer_holding
@@ -242,8 +1244,11 @@ class Table:
         self.dealer_holding += "."
 
     def update_monitors(self):
-        """Update all our attached monitors."""
+        """Update all our attached monitors, and the shared memory snapshot."""
         mon = self.get_table_monitor()
+        if table_snapshot is not None:
+            table_snapshot.publish(self.hands_dealt, self.decks, len(self.shoe), house_currency, house_total,
+                                   len(self.players), mon)
         for p in self.monitors:
             if self.monitors[p].disconnected is False:
                 try:
@@ -252,45 +1257,192 @@ class Table:
                     self.monitors[p].discon()
 
 
+class DecisionScorer:
+    """Scores every ACT against the best play, to show what each client's mistakes cost it per hand.  Players note
+    their decisions as they act; at the end of the hand, Table.deal hands them over and they go to a process pool as
+    one task.  Nothing on the game loop waits for the pool: results are folded into the totals from the pool's result
+    thread whenever they arrive, and the monitor line just shows the latest.  If the pool falls SCORING_BACKLOG hands
+    behind, hands are skipped (and counted) rather than queued.
+
+    The pool isn't forked until there's something to score, so importing this module, the --check options and a server
+    with SCORING at 0 don't start any processes."""
+
+    def __init__(self, workers: int):
+        self.lock = threading.Lock()
+        self.workers = workers
+        self.pool = None
+        self.pending = []       # (token, bet, decisions) for the hand being finished.
+        self.in_flight = 0
+        self.skipped = 0
+        self.totals = {}        # Token to [hands, decisions, mistakes, Randy Bucks lost to them].
+        self.costs = {}         # Token to Randy Bucks lost per hand, as shown on the monitor line.
+
+    def start(self):
+        """Fork the worker processes.  RunServer does this before it takes any clients if SCORING is on, so the workers
+        are a clean copy; if SCORING is turned on later, the first hand to score does it."""
+        if self.pool is not None:
+            return
+        self.pool = multiprocessing.get_context("fork").Pool(self.workers, evsolver.init_worker, (os.getpid(),))
+        atexit.register(self.close)
+
+    def close(self):
+        """Let the workers finish what they have and exit.  Called on the way out."""
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def add(self, player):
+        self.pending.append((player.token, player.cur_bet, player.decisions))
+        player.decisions = []
+
+    def submit(self, table: Table):
+        """Send the finished hand's decisions off to be scored."""
+        if len(self.pending) == 0:
+            return
+        seats = self.pending
+        self.pending = []
+        self.start()
+        with self.lock:
+            if self.in_flight >= SCORING_BACKLOG:
+                self.skipped += 1
+                return
+            self.in_flight += 1
+        self.pool.apply_async(evsolver.score_hand, (table.decks, table.dealer_holding[0], seats),
+                              callback=self.scored, error_callback=self.failed)
+
+    def scored(self, results: list):
+        with self.lock:
+            self.in_flight -= 1
+            for (token, decisions, mistakes, lost) in results:
+                t = self.totals.setdefault(token, [0, 0, 0, 0.0])
+                t[0] += 1
+                t[1] += decisions
+                t[2] += mistakes
+                t[3] += lost
+                self.costs[token] = "{0:.2f}".format(t[3] / t[0])
+
+    def failed(self, e: BaseException):
+        with self.lock:
+            self.in_flight -= 1
+        print("Decision scoring failed: " + str(e))
+
+    def cost(self, token: str) -> str:
+        if self.pool is None:
+            return "0"
+        return self.costs.get(token, "0")
+
+    def restore(self, totals: dict):
+        """Pick up the totals of the server we took over from."""
+        with self.lock:
+            self.totals = totals
+            self.costs = {token: "{0:.2f}".format(t[3] / t[0]) for (token, t) in totals.items()}
+
+
+class Policy:
+    """A decision table a client uploads with POLICY, so the server can answer its prompts for it.  The line is a list
+    of space separated entries:
+        H<total>=<row>      Hard totals.
+        S<total>=<row>      Soft totals (an ace counted as 11).
+        P<rank>=<row>       Pairs, by rank (A, 2-9, T for any ten-value pair).
+        INS=Y or INS=N      Insurance.
+        BET=<bet>[,<true count>:<bet>...]   Bet, raised once the Hi-Lo true count reaches each threshold.
+    A row is 10 letters, one per dealer upcard 2, 3, ... 9, T, A: H to hit, S to stand, D to double (hitting if a double
+    isn't allowed), P to split, or - to be asked as usual.  A key can end in #<n> to apply only while holding n hands,
+    which takes precedence over the same key without it.  Anything the table doesn't cover is prompted for as usual."""
+    actions = {"H": "HIT", "S": "STAND", "D": "DOUBLE", "P": "SPLIT"}
+    upcards = "23456789TA"
+
+    def __init__(self, text: str):
+        """Parse a POLICY line, raising ValueError with the reason if it's no good."""
+        self.rows = {}
+        self.insurance = None
+        self.bets = None            # [(true count threshold, bet)], lowest threshold first.
+        for entry in text.split():
+            (key, eq, value) = entry.upper().partition("=")
+            if eq == "":
+                raise ValueError("POLICY entry '" + entry + "' has no '='.")
+            if key == "INS":
+                if value not in ("Y", "N"):
+                    raise ValueError("INS must be Y or N.")
+                self.insurance = "YES" if value == "Y" else "NO"
+            elif key == "BET":
+                steps = value.split(",")
+                try:
+                    self.bets = [(float("-inf"), int(steps[0]))] + \
+                        sorted((float(c), int(b)) for (c, b) in (step.split(":") for step in steps[1:]))
+                except ValueError:
+                    raise ValueError("BET must look like 10,2:20,4:40.")
+            else:
+                (hand, _, count) = key.partition("#")
+                if len(hand) < 2 or hand[0] not in "HSP" or (count != "" and not count.isdigit()) or \
+                        (hand[0] == "P" and hand[1:] not in self.upcards) or \
+                        (hand[0] != "P" and not hand[1:].isdigit()):
+                    raise ValueError("POLICY key '" + key + "' should be H<total>, S<total> or P<rank>, then #<hands>.")
+                if len(value) != len(self.upcards) or any(c not in "HSDP-" for c in value):
+                    raise ValueError("POLICY row for " + key + " must be 10 of H, S, D, P or -.")
+                self.rows[key] = value
+
+    def bet(self, true_count: float, currency: int) -> str:
+        """Return the bet for this true count, or None if it has to be asked for."""
+        if self.bets is None:
+            return None
+        ret = None
+        for (threshold, bet) in self.bets:
+            if true_count >= threshold:
+                ret = bet
+        return str(ret) if ret <= currency else None
+
+    def lookup(self, key: str, hands: int, upcard: int) -> str:
+        row = self.rows.get(key + "#" + str(hands)) or self.rows.get(key)
+        return None if row is None or row[upcard] == "-" else row[upcard]
+
+    def act(self, hand: str, hands: int, dealer: str, valid_verbs: list) -> str:
+        """Return the verb for this hand against the dealer's upcard, or None if it has to be asked for."""
+        up = dealer[0]
+        upcard = self.upcards.index("T" if card_values[up] == 10 else up)
+        total = hand_value(hand)
+        if len(hand) == 4 and card_values[hand[0]] == card_values[hand[2]]:
+            rank = "T" if card_values[hand[0]] == 10 else hand[0]
+            letter = self.lookup("P" + rank, hands, upcard)
+            if letter is not None and (letter != "P" or "SPLIT" in valid_verbs):
+                return self.choose(letter, valid_verbs)
+        hard = sum(card_values[hand[i]] for i in range(0, len(hand) - len(hand) % 2, 2))
+        letter = self.lookup(("S" if total != hard else "H") + str(total), hands, upcard)
+        if letter is None or (letter == "P" and "SPLIT" not in valid_verbs):
+            return None
+        return self.choose(letter, valid_verbs)
+
+    def choose(self, letter: str, valid_verbs: list) -> str:
+        verb = self.actions[letter]
+        if verb == "DOUBLE" and verb not in valid_verbs:
+            return "HIT"
+        return verb
+
+
 class Player:
-    """A single player that has registered with the server."""
-    global GAME_WAIT_TIME
-    sock = None
-    name = ""
-    token = ""
-    currency = 0
-    srcip = ""
-    srcpt = 0
-
-    cur_bet = 0
-    holding = []
-    start_currency = 0
-    total_bets = 0              # Track the total amount this client has bet in its lifetime
-    count_wins = 0
-    count_losses = 0
-    count_pushes = 0
-    count_sitout = 0
-    insured = False             # This gets set if the client opted to buy the insurance.
-    disconnected = False        # This gets set if the client disappeared during a hand, and needs to be removed.
-    timedout = False            # This gets set if the client timed out at some part in the past hand.
-    playing = False             # This gets set if the client made a bet, otherwise it is just watching the game
-    active = False              # This gets set if we are waiting for the client to respond (used mainly for monitor)
-    monitor = False             # This gets set if this client is in MONITOR mode.
-    interactions_count = 0      # Number of times we've asked the client for something
-    interactions_time = 0.0     # Sum total of time we've waited on the client
+    """A single player that has registered with the server.  Slotted, as there can be thousands of them - and once a
+    player goes offline, the registry packs them down even further into the OfflineStore."""
+    __slots__ = ("sock", "name", "token", "currency", "srcip", "srcpt", "cur_bet", "holding", "start_currency",
+                 "total_bets", "count_wins", "count_losses", "count_pushes", "count_sitout", "insured", "disconnected",
+                 "timedout", "playing", "active", "monitor", "interactions_count", "interactions_time", "seated",
+                 "binary", "response_times", "resumed", "session", "table", "lock", "reconnected", "seats", "group",
+                 "policy", "subscription", "decisions", "limiter", "frame_buffer", "seat_index",
+                 "fresh_times")
+    # What carries over to the new process on a server upgrade.
+    saved_fields = ("name", "token", "currency", "srcip", "srcpt", "monitor", "binary", "start_currency", "total_bets",
+                    "count_wins", "count_losses", "count_pushes", "count_sitout", "interactions_count",
+                    "interactions_time", "seats", "policy", "subscription")
 
     def __init__(self, sock: socket, table, srcip: str, srcpt: int):
-        self.sock = sock
-        self.srcip = srcip
-        self.srcpt = srcpt
-        self.table = table
+        self.reset(sock, table, srcip, srcpt)
 
         # Ensure socket is set non-blocking, if we're using a socket.
         if self.sock is not None:
             self.sock.setblocking(0)
         # Ask player to LOGIN or REGISTER.
-        v, n = self.get_from_player(COMMAND_TIMEOUT, "HELLO BlackjackServer v1.00",
-                                    ["LOGIN", "REGISTER", "MONITOR", "SET"], "")
+        v, n = self.get_from_player(COMMAND_TIMEOUT, "HELLO BlackjackServer v1.00 " + binproto.CAPABILITY,
+                                    ["LOGIN", "REGISTER", "MONITOR", "SET", "QUERY", "PROFILE", "LEADERBOARD"], "")
         if v == "":
             # Disconnect the player and go on.
             raise ConnectionError
@@ -308,7 +1460,26 @@ class Player:
                 m.update(bytes(str(time.monotonic()), "utf-8"))
                 self.token = m.hexdigest()
                 self.currency = START_CURRENCY
-                self.send_to_player("TOKEN " + self.token)
+                if not sessions.register(self):
+                    self.send_to_player("INVALID That name is already registered - LOGIN with its token instead.")
+                    raise ConnectionError
+                # Clients that don't bother to LOGIN after getting their token are logged in anyway.
+                v, n = self.get_from_player(COMMAND_TIMEOUT, "TOKEN " + self.token, ["LOGIN"], "LOGIN")
+                (token, binary, seats) = self.parse_login(n)
+                if token != "" and token != self.token:
+                    self.send_to_player("INVALID That is not the token you were given.")
+                    raise ConnectionError
+                self.send_to_player("OK")
+                sessions.login(self.token, self.sock, self.srcip, self.srcpt, binary, seats)
+            elif v == "LOGIN":
+                # Send the OK before the seat moves over, so it can't land after the seat's next prompt.
+                (token, binary, seats) = self.parse_login(n)
+                if sessions.known(token):
+                    self.send_to_player("OK")
+                    self.resumed = sessions.login(token, self.sock, self.srcip, self.srcpt, binary, seats)
+                if self.resumed is None:
+                    self.send_to_player("INVALID Unknown token - REGISTER first.")
+                    raise ConnectionError
             elif v == "MONITOR":
                 # Add ourselves to the list of monitoring clients.
                 self.monitor = True
@@ -323,6 +1494,159 @@ class Player:
                     self.send_to_player("BYE Invalid client.")
                     print("Client from " + self.srcip + " attempted an admin command with an invalid password.")
                 raise ConnectionError
+            elif v == "QUERY":
+                query_params = (n or "").split(" ")
+                if query_params[0] == "spork":      # Password.
+                    if len(query_params) > 1 and query_params[1].upper() == "AUTOTUNE":
+                        for line in autotuner.describe(self.table):
+                            self.send_to_player("INFO " + line)
+                        self.send_to_player("INFO " + shoe_factory.describe())
+                    elif len(query_params) > 1 and query_params[1].upper() == "LIMITS":
+                        for line in sessions.describe_limits():
+                            self.send_to_player("INFO " + line)
+                    else:
+                        self.send_to_player("INVALID Unknown query.")
+                else:
+                    self.send_to_player("BYE Invalid client.")
+                    print("Client from " + self.srcip + " attempted an admin command with an invalid password.")
+                raise ConnectionError
+            elif v == "PROFILE":
+                # PROFILE spork START [rate] [file] | STOP | (nothing, for the status)
+                profile_params = (n or "").split(" ")
+                if profile_params[0] == "spork":    # Password.
+                    command = profile_params[1].upper() if len(profile_params) > 1 else ""
+                    if command == "START":
+                        try:
+                            rate = float(profile_params[2]) if len(profile_params) > 2 else PROFILE_RATE
+                        except ValueError:
+                            rate = 0.0
+                        name = profile_params[3] if len(profile_params) > 3 else \
+                            time.strftime("profile-%Y%m%d-%H%M%S.folded")
+                        path = os.path.join(PROFILE_DIR, name)
+                        if not 0.0 < rate <= PROFILE_MAX_RATE:
+                            self.send_to_player("INVALID Rate must be more than 0 and at most " +
+                                                str(PROFILE_MAX_RATE) + " samples a second.")
+                        elif re.fullmatch("[A-Za-z0-9_-][A-Za-z0-9_.-]*", name) is None:
+                            self.send_to_player("INVALID The profile file must be a plain name - it goes in " +
+                                                PROFILE_DIR + ".")
+                        elif profiler.start(rate, path):
+                            print("Profiling at {0:.0f} samples/s into {1}.".format(rate, path))
+                            self.send_to_player("INFO Sampling at {0:.0f}/s - PROFILE STOP writes {1}".format(
+                                rate, path))
+                        else:
+                            self.send_to_player("INVALID Already sampling - STOP first.")
+                    elif command == "STOP":
+                        try:
+                            result = profiler.stop()
+                        except OSError as e:
+                            self.send_to_player("INVALID Couldn't write the profile: " + str(e))
+                        else:
+                            if result is None:
+                                self.send_to_player("INVALID Not sampling.")
+                            else:
+                                print("Wrote {0!s} samples ({1!s} stacks) to {2}.".format(*result))
+                                self.send_to_player("INFO Wrote {0!s} samples ({1!s} stacks) to {2}".format(*result))
+                    elif command == "":
+                        for line in profiler.describe():
+                            self.send_to_player("INFO " + line)
+                    else:
+                        self.send_to_player("INVALID Unknown profile command.")
+                else:
+                    self.send_to_player("BYE Invalid client.")
+                    print("Client from " + self.srcip + " attempted an admin command with an invalid password.")
+                raise ConnectionError
+            elif v == "LEADERBOARD":
+                # LEADERBOARD [CURRENCY|WINRATE|RETURN] [count] [player name]
+                metric = "CURRENCY"
+                count = 10
+                name = None
+                for arg in (n or "").split():
+                    if arg.upper() in Leaderboard.metrics:
+                        metric = arg.upper()
+                    elif arg.isdigit():
+                        count = min(int(arg), 1000)
+                    else:
+                        name = arg
+                self.send_to_player("LEADERBOARD {0} {1!s} of {2!s}".format(metric, count, len(leaderboard)))
+                for (rank, player, score) in leaderboard.top(metric, count):
+                    self.send_to_player("RANK {0!s} {1} {2!s}".format(rank, player, score))
+                if name is not None:
+                    r = leaderboard.rank(metric, name)
+                    if r is None:
+                        self.send_to_player("INVALID " + name + " hasn't played a hand yet.")
+                    else:
+                        self.send_to_player("RANK {0!s} {1} {2!s}".format(*r))
+                raise ConnectionError
+
+    def reset(self, sock: socket, table, srcip: str, srcpt: int):
+        """Give every field its starting value."""
+        self.sock = sock
+        self.name = ""
+        self.token = ""
+        self.currency = 0
+        self.srcip = srcip
+        self.srcpt = srcpt
+        self.table = table
+
+        self.cur_bet = 0
+        self.holding = []
+        self.start_currency = 0
+        self.total_bets = 0             # Track the total amount this client has bet in its lifetime
+        self.count_wins = 0
+        self.count_losses = 0
+        self.count_pushes = 0
+        self.count_sitout = 0
+        self.insured = False            # This gets set if the client opted to buy the insurance.
+        self.disconnected = False       # This gets set if the client disappeared during a hand, and needs to be removed.
+        self.timedout = False           # This gets set if the client timed out at some part in the past hand.
+        self.playing = False            # This gets set if the client made a bet, otherwise it is just watching the game
+        self.active = False             # This gets set if we are waiting for the client to respond (used mainly for monitor)
+        self.monitor = False            # This gets set if this client is in MONITOR mode.
+        self.interactions_count = 0     # Number of times we've asked the client for something
+        self.interactions_time = 0.0    # Sum total of time we've waited on the client
+        self.seated = False             # This gets set while the player has a seat at the table.
+        self.binary = False             # This gets set if the client logged in with the BIN1 binary protocol.
+        self.response_times = deque(maxlen=100)     # Recent response times in seconds, None for a timeout.
+        self.fresh_times = []           # The same, since the autotuner last took them.
+        self.resumed = None             # For a LOGIN connection, the registered player the socket was handed to.
+        self.session = 0                # Bumped every time the client logs back in on a new socket.
+        self.lock = threading.Lock()
+        self.reconnected = threading.Event()
+        self.seats = 1                  # How many seats this client asked to play at LOGIN.
+        self.group = None               # The SeatGroup, if this is one of the seats of a multi-seat client.
+        self.policy = None              # The Policy the client uploaded, if any.
+        self.subscription = "PLAY"      # PLAY, or SITOUT / WATCH to be left out of hands until the client sends RESUME.
+        self.decisions = []             # This hand's ACTs, for the DecisionScorer.
+        self.limiter = RateLimiter()    # What the client may send us, and what it has.
+        self.frame_buffer = bytearray() # Any binary protocol frame only partly received so far.
+        self.seat_index = -1            # Our row in the table's SeatArrays, when it has them.
+
+    @staticmethod
+    def parse_login(n: str) -> (str, bool, int):
+        """Split LOGIN's data into the token, whether the client asked for the binary protocol, and how many seats it
+        wants to play (SEATS=n, 1 if not given)."""
+        args = (n or "").split(" ")
+        options = [a.upper() for a in args[1:]]
+        seats = 1
+        for o in options:
+            if o.startswith("SEATS="):
+                try:
+                    seats = max(1, min(MAX_SEATS, int(o[6:])))
+                except ValueError:
+                    pass
+        return (args[0].lower(), binproto.CAPABILITY in options, seats)
+
+    @classmethod
+    def restore(cls, state: dict, sock: socket, table):
+        """Rebuild a player from saved_fields - handed over by the previous server process, or unpacked from the
+        OfflineStore - skipping the HELLO conversation.  A player without a socket is registered but offline until
+        they LOGIN."""
+        p = cls.__new__(cls)
+        p.reset(sock, table, state["srcip"], state["srcpt"])
+        for f in cls.saved_fields:
+            setattr(p, f, state[f])
+        p.disconnected = sock is None
+        return p
 
     def __del__(self):
         """Make sure we save our state."""
@@ -337,16 +1661,44 @@ class Player:
         an INVALID along with the error message specified as the value in the dictionary."""
         self.timedout = False
         self.active = True
-        self.table.update_monitors()
-        self.send_to_player(request)
+        if self.seated:
+            self.table.update_monitors()
         self.interactions_count += 1
         start_time = time.monotonic()
         timeout_at = start_time + timeout_left
+        sent_session = None     # Which connection the request went out on.
+        follow_up = False       # Set once we've read a line for this request - anything more came after an INVALID.
         while True:
+            if self.disconnected:
+                # Hold the seat until the deadline, in case the client logs back in on a new connection.
+                if not self.reconnected.wait(max(0.0, timeout_at - time.monotonic())):
+                    self.active = False
+                    self.timedout = True
+                    self.interactions_time += time.monotonic() - start_time
+                    if capture is not None and self.seated:
+                        capture.record(self.name, request, None, "", follow_up)
+                    return (timeout_verb, "")
+            sock = self.sock
+            if sent_session != self.session:
+                # First time through, or the client reconnected and needs to see the prompt again.
+                sent_session = self.session
+                self.send_to_player(request)
+                continue
             timeout_left = timeout_at - time.monotonic()
             if SHOW_COMMS == 1:
                 print("RECV waiting for " + self.name + " for " + str(timeout_left) + " seconds.")
-            ret = sock_readline(self.sock, timeout_left)
+            try:
+                if self.binary:
+                    ret = sock_readframe(sock, timeout_left, self.frame_buffer)
+                else:
+                    ret = sock_readline(sock, timeout_left)
+            except ConnectionError:
+                if not self.seated:
+                    raise
+                self.discon(sock)
+                continue
+            if ret is None and sock is not self.sock:
+                continue    # Swapped to a new connection while we were waiting on the old one.
             if ret is None or time.monotonic() > timeout_at:
                 if SHOW_COMMS == 1:
                     print("RECV:" + self.name + ":Timed out")
@@ -354,33 +1706,108 @@ class Player:
                 self.active = False
                 self.timedout = True
                 self.interactions_time += time.monotonic() - start_time
+                self.response_times.append(None)
+                self.fresh_times.append(None)
+                if capture is not None and self.seated:
+                    capture.record(self.name, request, None, "", follow_up)
                 return (timeout_verb, "")
+            status = self.limiter.charge(len(ret) + 1)
+            if status == "KICK":
+                self.kick(sock)
+                if not self.seated:
+                    raise ConnectionError
+                continue
+            if status is not None:
+                # Muted - drop the line, and don't read any more until the buckets have refilled.
+                time.sleep(max(0.0, min(self.limiter.recovery_time(), timeout_at - time.monotonic())))
+                continue
             if SHOW_COMMS == 1:
                 print("RECV:" + self.name + ":" + ret)
+            if capture is not None and self.seated:
+                capture.record(self.name, request, time.monotonic() - start_time, ret, follow_up)
+                follow_up = True
             m = cmd_regex.match(ret)
             if m:
                 verb = m.group(1).upper()
+                if verb == "POLICY" and self.seated:
+                    # Can come in answer to any prompt - after the OK the client still owes us its answer.
+                    self.send_to_player(self.set_policy(m.group(3)))
+                    continue
                 if verb in valid_verbs:
                     self.active = False
                     self.interactions_time += time.monotonic() - start_time
+                    self.response_times.append(time.monotonic() - start_time)
+                    self.fresh_times.append(self.response_times[-1])
                     return (verb, m.group(3))
                 else:
+                    self.limiter.invalid()
                     if verb in invalid_verbs:
                         self.send_to_player("INVALID " + invalid_verbs[verb])
                     else:
-                        self.send_to_player("INVALID Bad command '" + verb + "' - valid commands: " + " ".join(valid_verbs))
+                        self.send_to_player(invalid_reply(valid_verbs))
             else:
+                self.limiter.invalid()
                 self.send_to_player("INVALID Bad command format")
 
+    def kick(self, sock: socket):
+        """Disconnect a client that has run out of strikes for going over its rate limits."""
+        print("Disconnecting {0} ({1}) for flooding: {2}".format(self.name, self.srcip, self.limiter.describe()))
+        try:
+            self.send_to_player("BYE Too many lines - slow down.")
+        except ConnectionError:
+            pass
+        self.discon(sock)
+
+    def set_policy(self, text: str) -> str:
+        """Take a POLICY from the client (an empty one clears it).  Returns the reply to send."""
+        if text is None or text.strip() == "":
+            self.policy = None
+            return "OK"
+        if len(text) > MAX_POLICY_LENGTH:
+            return "INVALID POLICY is longer than " + str(MAX_POLICY_LENGTH) + " characters."
+        try:
+            self.policy = Policy(text)
+        except ValueError as e:
+            return "INVALID " + str(e)
+        return "OK"
+
+    def active_policy(self) -> Policy:
+        """The seats of a multi-seat client play by the owner's policy."""
+        return self.group.owner.policy if self.group is not None else self.policy
+
+    def policy_bet(self, table) -> str:
+        policy = self.active_policy()
+        return None if policy is None else policy.bet(table.true_count, self.currency)
+
+    def policy_insurance(self) -> str:
+        policy = self.active_policy()
+        return None if policy is None else policy.insurance
+
+    def policy_act(self, table, valid_verbs: list) -> str:
+        policy = self.active_policy()
+        return None if policy is None else \
+            policy.act(self.holding[0], len(self.holding), table.dealer_holding, valid_verbs)
+
     def send_to_player(self, s: str):
-        if self.sock is None:
+        """Send a line to the client.  A seated client that has dropped is quietly skipped (and marked disconnected)
+        so the hand carries on without it; anyone else gets a ConnectionError."""
+        if self.disconnected and self.seated:
+            return
+        sock = self.sock
+        if sock is None:
             print(s)
         else:
             try:
                 if SHOW_COMMS == 1:
                     print("SEND:" + self.name + ":" + s)
-                self.sock.sendall(bytes(s + "\n", "utf-8"))
+                if self.binary:
+                    sock.sendall(binproto.encode_server(s))
+                else:
+                    sock.sendall(bytes(s + "\n", "utf-8"))
             except:
+                if self.seated:
+                    self.discon(sock)
+                    return
                 raise ConnectionError
 
     def holding_state(self, monitor=False):
@@ -391,7 +1818,8 @@ class Player:
             # Provide the Monitor the player statistics.
             ret = self.name + ":" + str(self.currency) + ":" + str(self.count_wins) + "," + \
                 str(self.count_losses) + "," + str(self.count_pushes) + "," + str(self.count_sitout) + "," + \
-                str(self.total_bets) + "," + str(self.interactions_count) + "," + str(self.interactions_time) + ":"
+                str(self.total_bets) + "," + str(self.interactions_count) + "," + str(self.interactions_time) + "," + \
+                scorer.cost(self.token) + ":"
             if self.timedout is True:
                 ret += "t:"
             elif self.active is True:
@@ -415,20 +1843,146 @@ class Player:
     def make_active_hand(self, idx: int):
         h = self.holding.pop(idx)
         self.holding.insert(0, h)
+        if self.table is not None and self.table.arrays is not None:
+            self.table.arrays.activate(self, idx)
+
+    def discon(self, sock: socket = None):
+        """Called when we detect a socket error and our client has disappeared.  A seated player keeps their bet and
+        hands so a LOGIN during the hand can pick them back up; if nobody does, they are unseated at the end of the
+        hand.  If sock is given and the client has already moved to a new socket, this does nothing."""
+        with self.lock:
+            if sock is not None and sock is not self.sock:
+                return
+            if not self.seated:
+                self.playing = False
+            self.disconnected = True
+            self.reconnected.clear()
+            sock = self.sock
+        self.unwatch(sock)
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def resume(self, sock: socket, srcip: str, srcpt: int, binary: bool = False):
+        """Move this player onto a new client connection, waking up anything waiting for them to come back."""
+        with self.lock:
+            old = self.sock
+            self.sock = sock
+            self.binary = binary
+            self.frame_buffer = bytearray()     # Whatever was left of the old connection's stream is no use now.
+            self.srcip = srcip
+            self.srcpt = srcpt
+            self.session += 1
+            self.disconnected = False
+            self.reconnected.set()
+        if self.subscription != "PLAY":
+            # A fresh connection starts out playing again.
+            self.unwatch(old)
+            self.subscription = "PLAY"
+        if old is not None and old is not sock:
+            try:
+                old.close()
+            except OSError:
+                pass
 
-    def discon(self):
-        """Called when we detect a socket error and our client has disappeared."""
+    def subscribe(self, level: str):
+        """Stop taking part in hands (level SITOUT gets the DONE for every hand, WATCH just a RESULT line) until the
+        client sends RESUME.  In the meantime its connection is watched by the acceptor thread, not a pool thread."""
+        self.subscription = level
+        self.start_currency = self.currency
         self.playing = False
-        self.disconnected = True
-        self.sock.close()
+        self.count_sitout += 1
+        if self.sock is not None:
+            sel.register(self.sock, selectors.EVENT_READ, self.idle_input)
 
-    def Ready(self, table: Table):
-        """Perform READY step.  Initializes our state as well."""
-        global house_currency, house_total
+    def unwatch(self, sock: socket):
+        try:
+            sel.unregister(sock)
+        except (KeyError, ValueError):
+            pass
+
+    def idle_input(self, sock: socket, mask):
+        """Called on the acceptor thread when a client sitting out sends something."""
+        try:
+            line = sock_readframe(sock, 0.1, self.frame_buffer) if self.binary else sock_readline(sock, 0.1)
+        except ConnectionError:
+            self.discon(sock)
+            return
+        if line is None:
+            return
+        status = self.limiter.charge(len(line) + 1)
+        if status == "KICK":
+            self.kick(sock)
+            return
+        if status is not None:
+            return
+        m = cmd_regex.match(line)
+        verb = m.group(1).upper() if m else ""
+        if verb == "RESUME":
+            self.unwatch(sock)
+            self.subscription = "PLAY"
+            self.send_to_player("OK")
+        elif verb in ("SITOUT", "WATCH"):
+            self.subscription = verb
+            self.send_to_player("OK")
+        elif verb == "POLICY":
+            self.send_to_player(self.set_policy(m.group(3)))
+        else:
+            self.limiter.invalid()
+            self.send_to_player("INVALID Sitting out - send RESUME to play again.")
+
+    def new_hand(self):
+        """Clear out the last hand's bet and cards."""
         self.insured = False
         self.cur_bet = 0
         self.playing = False
         self.holding = []
+        self.decisions = []
+
+    def ready_request(self, table: Table) -> str:
+        return "READY {0!s} {1!s} {2!s}".format(self.currency, table.decks, len(table.shoe))
+
+    def place_bet(self, amount: str) -> str:
+        """Take the BET amount the client sent (empty for none).  Returns the INVALID message if it can't be taken,
+        otherwise None."""
+        global house_currency, house_total
+        if amount == "":
+            # Assume no bet, i.e. bet_amt is 0.
+            self.start_currency = self.currency
+            self.playing = False
+            self.count_sitout += 1
+            return None
+
+        try:
+            bet_amt = int(amount)
+        except (ValueError, TypeError):
+            return "BET must be a positive integer."
+        if bet_amt < 0 or (bet_amt / 2 != bet_amt // 2):
+            return "BET must be a positive even integer"
+        if bet_amt > self.currency:
+            return "You do not have that much currency."
+        self.start_currency = self.currency  # So we can show win/loss at end of hand.
+        if bet_amt == 0:
+            self.playing = False
+            self.count_sitout += 1
+        else:
+            self.cur_bet = bet_amt
+            self.currency -= bet_amt
+            self.total_bets += bet_amt
+            house_currency += bet_amt
+            house_total += bet_amt
+            self.playing = True
+            if self.table is not None and self.table.arrays is not None:
+                self.table.arrays.place_bet(self, bet_amt)
+        return None
+
+    def Ready(self, table: Table):
+        """Perform READY step.  Initializes our state as well."""
+        self.new_hand()
+        bet = self.policy_bet(table)
+        if bet is not None and self.place_bet(bet) is None:
+            return
         timeout_at = time.monotonic() + COMMAND_TIMEOUT
         while True:
             if time.monotonic() > timeout_at:
@@ -437,48 +1991,41 @@ class Player:
                 self.playing = False
                 return
             try:
-                s = self.get_from_player(timeout_at - time.monotonic(),
-                                        "READY {0!s} {1!s} {2!s}".format(self.currency, table.decks, len(table.shoe)),
-                                        ["BET"], "BET")
+                s = self.get_from_player(timeout_at - time.monotonic(), self.ready_request(table),
+                                         ["BET", "SITOUT", "WATCH"], "BET")
             except ConnectionError:
                 self.discon()
                 return
             else:
-                if s[1] == "":
-                    # Assume no bet, i.e. bet_amt is 0.
-                    self.start_currency = self.currency
-                    self.playing = False
-                    self.count_sitout += 1
+                if s[0] in ("SITOUT", "WATCH"):
+                    self.subscribe(s[0])
                     return
+                error = self.place_bet(s[1])
+                if error is None:
+                    return
+                self.send_to_player("INVALID " + error)
 
-                try:
-                    bet_amt = int(s[1])
-                    if bet_amt < 0 or (bet_amt / 2 != bet_amt // 2):
-                        self.send_to_player("INVALID BET must be a positive even integer")
-                    else:
-                        if bet_amt > self.currency:
-                            self.send_to_player("INVALID You do not have that much currency.")
-                        else:
-                            self.start_currency = self.currency  # So we can show win/loss at end of hand.
-                            if bet_amt == 0:
-                                self.playing = False
-                                self.count_sitout += 1
-                            else:
-                                self.cur_bet = bet_amt
-                                self.currency -= bet_amt
-                                self.total_bets += bet_amt
-                                house_currency += bet_amt
-                                house_total += bet_amt
-                                self.playing = True
-                            return
-                except ValueError:
-                    self.send_to_player("INVALID BET must be a positive integer.")
+    def can_insure(self) -> bool:
+        return self.currency > self.cur_bet // 2
 
-    def Insurance(self, table: Table):
-        """Perform INSURANCE step.  Updates the insured flag appropriately."""
+    def take_insurance(self, verb: str) -> str:
+        """Apply the client's YES or NO to insurance.  Always accepted, so always returns None."""
         global house_currency, house_total
         insur_amt = self.cur_bet // 2
-        if self.currency > insur_amt:
+        if verb == "YES":
+            self.insured = True
+            self.currency -= insur_amt
+            house_currency += insur_amt
+            house_total += insur_amt
+            if self.table is not None and self.table.arrays is not None:
+                self.table.arrays.insure(self)
+        return None
+
+    def Insurance(self, table: Table):
+        """Perform INSURANCE step.  Updates the insured flag appropriately."""
+        if self.can_insure() and self.policy_insurance() is not None:
+            self.take_insurance(self.policy_insurance())
+        elif self.can_insure():
             try:
                 s = self.get_from_player(COMMAND_TIMEOUT,
                                         "INSURANCE " + table.get_table_state(self.token),
@@ -487,17 +2034,88 @@ class Player:
                 self.discon()
                 return
             else:
-                if s[0] == "YES":
-                    self.insured = True
-                    self.currency -= insur_amt
-                    house_currency += insur_amt
-                    house_total += insur_amt
+                self.take_insurance(s[0])
         table.update_monitors()
 
+    def act_choices(self) -> (list, dict):
+        """Work out what the client may do with its first hand.  Returns the valid verbs, and a dictionary of the
+        reasons the other verbs aren't allowed."""
+        valid_verbs = ["HIT", "STAND"]
+        invalid_verbs = {}
+
+        # Check for double down status
+        if len(self.holding[0]) == 4:
+            if 9 <= hand_value(self.holding[0]) <= 11:
+                if self.currency >= self.cur_bet:
+                    valid_verbs.append("DOUBLE")
+                else:
+                    invalid_verbs["DOUBLE"] = "You do not have sufficient currency to double down - " \
+                                              + str(self.cur_bet) + " needed, you hold " + str(self.currency) + "."
+            else:
+                invalid_verbs["DOUBLE"] = "Double down only permitted on card values between 9 and 11 - " \
+                                          + "you are holding " + str(hand_value(self.holding[0])) + "."
+        else:
+            invalid_verbs["DOUBLE"] = "Double down only permitted on the first two cards dealt."
+
+        # Check for split status
+        if len(self.holding[0]) == 4:
+            if card_values[self.holding[0][0]] == card_values[self.holding[0][2]]:
+                if self.currency >= self.cur_bet:
+                    if len(self.holding) <= 4:
+                        valid_verbs.append("SPLIT")
+                    else:
+                        invalid_verbs["SPLIT"] = "You are already holding four hands at once, the table limit."
+                else:
+                    invalid_verbs["SPLIT"] = "You do not have sufficient currency to split - " + str(self.cur_bet) \
+                                             + " needed, you hold " + str(self.currency) + "."
+            else:
+                invalid_verbs["SPLIT"] = "You can only split hands whose two cards are the same value."
+        else:
+            invalid_verbs["SPLIT"] = "You can only split on the first two cards dealt."
+        return (valid_verbs, invalid_verbs)
+
+    def act_on(self, table: Table, verb: str) -> bool:
+        """Carry out a HIT, STAND, DOUBLE or SPLIT on our first hand.  Returns True once that hand is finished."""
+        global house_currency, house_total
+        if SCORING == 1:
+            self.decisions.append((self.holding[0], len(self.holding), self.currency >= self.cur_bet, verb))
+        if verb == "HIT":
+            table.get_card(self)
+
+        if verb == "STAND":
+            self.holding[0] += "."
+            return True
+
+        if verb == "DOUBLE":
+            table.get_card(self)
+            self.holding[0] += "+"  # Add our "doubled down" marker.
+            if table.arrays is not None:
+                table.arrays.double(self)
+            self.currency -= self.cur_bet
+            house_currency += self.cur_bet
+            house_total += self.cur_bet
+            return True
+
+        if verb == "SPLIT":
+            # Get two cards from the shoe, then do the split, cards 1 & 3 with 2 & 4.
+            table.get_card(self)
+            table.get_card(self)
+            curhand = self.holding.pop(0)
+            self.holding.insert(0, curhand[2:4] + curhand[6:8])
+            self.holding.insert(0, curhand[0:2] + curhand[4:6])
+            if table.arrays is not None:
+                table.arrays.split(self, self.holding[0], self.holding[1])
+            self.currency -= self.cur_bet
+            self.total_bets += self.cur_bet
+            house_currency += self.cur_bet
+            house_total += self.cur_bet
+
+        table.update_monitors()
+        return False
+
     def Act(self, table: Table):
         """Perform a round of ACTs on a hand.  Note the number of hands held may change as a side effect of this
         function (due to SPLITs)."""
-        global house_currency, house_total
         timeout_at = time.monotonic() + COMMAND_TIMEOUT
         while True:
             # Determine what's valid for the player to do.
@@ -505,39 +2123,12 @@ class Player:
                 self.holding[0] += "."
                 return
 
-            valid_verbs = ["HIT", "STAND"]
-            invalid_verbs = {}
-
-            # Check for double down status
-            if len(self.holding[0]) == 4:
-                if 9 <= hand_value(self.holding[0]) <= 11:
-                    if self.currency >= self.cur_bet:
-                        valid_verbs.append("DOUBLE")
-                    else:
-                        invalid_verbs["DOUBLE"] = "You do not have sufficient currency to double down - " \
-                                                  + str(self.cur_bet) + " needed, you hold " + str(self.currency) + "."
-                else:
-                    invalid_verbs["DOUBLE"] = "Double down only permitted on card values between 9 and 11 - " \
-                                              + "you are holding " + str(hand_value(self.holding[0])) + "."
-            else:
-                invalid_verbs["DOUBLE"] = "Double down only permitted on the first two cards dealt."
-
-            # Check for split status
-            if len(self.holding[0]) == 4:
-                if card_values[self.holding[0][0]] == card_values[self.holding[0][2]]:
-                    if self.currency >= self.cur_bet:
-                        if len(self.holding) <= 4:
-                            valid_verbs.append("SPLIT")
-                        else:
-                            invalid_verbs["SPLIT"] = "You are already holding four hands at once, the table limit."
-                    else:
-                        invalid_verbs["SPLIT"] = "You do not have sufficient currency to split - " + str(self.cur_bet) \
-                                                 + " needed, you hold " + str(self.currency) + "."
-                else:
-                    invalid_verbs["SPLIT"] = "You can only split hands whose two cards are the same value."
-            else:
-                invalid_verbs["SPLIT"] = "You can only split on the first two cards dealt."
-
+            (valid_verbs, invalid_verbs) = self.act_choices()
+            verb = self.policy_act(table, valid_verbs)
+            if verb is not None:
+                if self.act_on(table, verb):
+                    return
+                continue
             try:
                 s = self.get_from_player(timeout_at - time.monotonic(),
                                         "ACT " + table.get_table_state(self.token),
@@ -546,37 +2137,31 @@ class Player:
                 self.discon()
                 return
             else:
-                if s[0] == "HIT":
-                    table.get_card(self)
-
-                if s[0] == "STAND":
-                    self.holding[0] += "."
+                if self.act_on(table, s[0]):
                     return
 
-                if s[0] == "DOUBLE":
-                    table.get_card(self)
-                    self.holding[0] += "+"  # Add our "doubled down" marker.
-                    self.currency -= self.cur_bet
-                    house_currency += self.cur_bet
-                    house_total += self.cur_bet
-                    return
-
-                if s[0] == "SPLIT":
-                    # Get two cards from the shoe, then do the split, cards 1 & 3 with 2 & 4.
-                    table.get_card(self)
-                    table.get_card(self)
-                    curhand = self.holding.pop(0)
-                    self.holding.insert(0, curhand[2:4] + curhand[6:8])
-                    self.holding.insert(0, curhand[0:2] + curhand[4:6])
-                    self.currency -= self.cur_bet
-                    self.total_bets += self.cur_bet
-                    house_currency += self.cur_bet
-                    house_total += self.cur_bet
-
-                table.update_monitors()
+    def Done(self, table: Table, settle: bool = True):
+        """Perform DONE step.  Evaluates win/loss, and updates currency.  Pass settle=False if the hands have already
+        been settled from the table's SeatArrays.  The seats of a multi-seat client get their DONE from SeatGroup.Done."""
+        if settle:
+            self.Settle(table)
+        leaderboard.update(self)
+        if len(self.decisions) > 0:
+            scorer.add(self)
+        if self.group is not None:
+            return
+        try:
+            if self.subscription == "WATCH":
+                self.send_to_player(table.get_result())
+            else:
+                self.send_to_player("DONE " + table.get_table_state(self.token) + ":" +
+                                    str(self.currency - self.start_currency))
+        except ConnectionError:
+            self.discon()
+            return
 
-    def Done(self, table: Table):
-        """Perform DONE step.  Evaluates win/loss, and updates currency."""
+    def Settle(self, table: Table):
+        """Evaluate win/loss for each of our hands against the dealer, and update currency and our counters."""
         global house_currency
         dealer_value = hand_value(table.dealer_holding)
 
@@ -618,25 +2203,487 @@ class Player:
                 self.count_pushes += 1
             else:
                 self.count_losses += 1
+
+
+class SeatGroup:
+    """The seats of a client that logged in with SEATS=n.  The owner (the player that logged in) holds the connection;
+    the other seats are players with no socket of their own.  One pool thread runs every seat's turn, and each round
+    of prompts goes out as a single SEATS line with one slot per seat, answered by a single SEATS line:
+        S:SEATS READY 10000 6 312|READY 9960 6 312
+        C:SEATS BET 10|BET 0
+    A slot is "-" for a seat with nothing to answer, and INVALID for a seat whose answer has to be sent again."""
+
+    def __init__(self, owner, extras: list):
+        self.owner = owner
+        self.seats = [owner] + extras
+
+    def exchange(self, prompts: dict, accept, timeout_at: float):
+        """Send the prompts ({seat index: (request, valid verbs, invalid verbs, timeout verb)}) as SEATS lines until
+        every seat has answered or timeout_at.  accept(seat, verb, noun) applies an answer, returning an INVALID message
+        to re-prompt that seat with, or None.  Seats that never answer get their timeout verb."""
+        start_time = time.monotonic()
+        pending = dict(prompts)
+        slots = {i: prompts[i][0] for i in prompts}
+        for i in pending:
+            self.seats[i].active = True
+            self.seats[i].timedout = False
+        while len(pending) > 0:
+            line = "SEATS " + "|".join(slots.get(i, "-") for i in range(0, len(self.seats)))
+            try:
+                v, n = self.owner.get_from_player(max(0.0, timeout_at - time.monotonic()), line, ["SEATS"], "")
+            except ConnectionError:
+                self.owner.discon()
+                v = ""
+            if v == "":
+                break
+            answers = (n or "").split("|")
+            slots = {}
+            for i in list(pending):
+                (request, valid_verbs, invalid_verbs, timeout_verb) = pending[i]
+                m = cmd_regex.match(answers[i].strip()) if i < len(answers) else None
+                if not m:
+                    error = "Bad command format"
+                else:
+                    verb = m.group(1).upper()
+                    if verb in valid_verbs:
+                        error = accept(self.seats[i], verb, m.group(3))
+                    elif verb in invalid_verbs:
+                        error = invalid_verbs[verb]
+                    else:
+                        error = "Bad command '" + verb + "' - valid commands: " + " ".join(valid_verbs)
+                if error is None:
+                    del pending[i]
+                else:
+                    slots[i] = "INVALID " + error
+        for i in pending:
+            self.seats[i].timedout = True
+            accept(self.seats[i], pending[i][3], "")
+        elapsed = time.monotonic() - start_time
+        for i in prompts:
+            seat = self.seats[i]
+            seat.active = False
+            if seat is not self.owner:      # The owner's get_from_player already counted it.
+                seat.interactions_count += 1
+                seat.interactions_time += elapsed
+
+    def Ready(self, table: Table):
+        prompts = {}
+        for (i, seat) in enumerate(self.seats):
+            seat.new_hand()
+            bet = seat.policy_bet(table)
+            if bet is None or seat.place_bet(bet) is not None:
+                prompts[i] = (seat.ready_request(table), ["BET"], {}, "BET")
+        if len(prompts) > 0:
+            self.exchange(prompts, lambda seat, verb, noun: seat.place_bet(noun), time.monotonic() + COMMAND_TIMEOUT)
+
+    def Insurance(self, table: Table):
+        prompts = {}
+        for (i, seat) in enumerate(self.seats):
+            if seat.playing and seat.can_insure():
+                if seat.policy_insurance() is not None:
+                    seat.take_insurance(seat.policy_insurance())
+                else:
+                    prompts[i] = ("INSURANCE " + table.get_table_state(seat.token), ["YES", "NO"], {}, "NO")
+        if len(prompts) > 0:
+            self.exchange(prompts, lambda seat, verb, noun: seat.take_insurance(verb),
+                          time.monotonic() + COMMAND_TIMEOUT)
+        table.update_monitors()
+
+    def Act(self, table: Table):
+        """Play every seat's hands.  Each round prompts each seat for the hand it's on, so a seat that splits or hits
+        just carries on in the next round.  As with a single seat, each hand gets one COMMAND_TIMEOUT, however many
+        rounds it takes: a seat's n-th hand has to be finished n COMMAND_TIMEOUTs after the phase started, which is as
+        long as the seats would have had on connections of their own."""
+        start_time = time.monotonic()
+        while True:
+            prompts = {}
+            hands = 1
+            for (i, seat) in enumerate(self.seats):
+                h = seat.hand_left_to_play() if seat.playing else None
+                while h is not None:
+                    seat.make_active_hand(h)
+                    if hand_value(seat.holding[0]) >= 21:
+                        seat.holding[0] += "."  # No more actions allowed if already showing 21 or more.
+                    else:
+                        (valid_verbs, invalid_verbs) = seat.act_choices()
+                        verb = seat.policy_act(table, valid_verbs)
+                        if verb is None:
+                            prompts[i] = ("ACT " + table.get_table_state(seat.token), valid_verbs, invalid_verbs,
+                                          "STAND")
+                            hands = max(hands, 1 + sum(1 for held in seat.holding if held.endswith(".")))
+                            break
+                        seat.act_on(table, verb)
+                    h = seat.hand_left_to_play()
+            if len(prompts) == 0:
+                return
+            self.exchange(prompts, self.accept_act, start_time + hands * COMMAND_TIMEOUT)
+
+    @staticmethod
+    def accept_act(seat, verb: str, noun: str) -> str:
+        seat.act_on(seat.table, verb)
+        return None
+
+    def Done(self, table: Table):
+        """Send every seat's DONE in one line.  The seats have already been settled.  A seat that isn't at the table
+        (yet) gets "-"."""
         try:
-            self.send_to_player("DONE " + table.get_table_state(self.token) + ":" +
-                                str(self.currency - self.start_currency))
+            self.owner.send_to_player("SEATS " + "|".join(
+                "DONE " + table.get_table_state(seat.token) + ":" + str(seat.currency - seat.start_currency)
+                if seat.token in table.players else "-" for seat in self.seats))
         except ConnectionError:
-            self.discon()
+            self.owner.discon()
+
+
+class SeatArrays:
+    """The hand in play as NumPy arrays, one row per seat, for SOA_SETTLEMENT.  Table.deal gives every player a row at
+    the start of the hand, and from then on the bet, insurance and each hand's hard total, aces, cards and double are
+    kept up to date as they happen - place_bet, take_insurance, the deal, Table.get_card, act_on and make_active_hand
+    all report here.  So at the end of the hand there's nothing to gather: settle() is whole-table array operations,
+    and only the results go back to the players.  Hands are columns, in the same order as the player's holding."""
+    max_hands = 5       # Splitting is allowed while holding four hands, so a seat can end up with five.
+
+    def __init__(self):
+        self.players = []
+        self.allocate(64)
+
+    def allocate(self, seats: int):
+        self.bet = np.zeros(seats, np.int64)
+        self.insured = np.zeros(seats, bool)
+        self.num_hands = np.zeros(seats, np.int64)
+        self.hard = np.zeros((seats, self.max_hands), np.int64)     # Totals with every ace counted as 1.
+        self.aces = np.zeros((seats, self.max_hands), np.int64)
+        self.cards = np.zeros((seats, self.max_hands), np.int64)
+        self.doubled = np.zeros((seats, self.max_hands), bool)
+
+    def begin(self, players: list):
+        """Start a hand with a row for each of players.  Rows are only handed out here, between hands."""
+        if len(players) > len(self.bet):
+            self.allocate(max(len(players), len(self.bet) * 2))
+        n = len(players)
+        for a in (self.bet, self.insured, self.num_hands, self.hard, self.aces, self.cards, self.doubled):
+            a[:n] = 0
+        self.players = players
+        for (i, p) in enumerate(players):
+            p.seat_index = i
+
+    def row(self, player) -> int:
+        """The player's row, or -1 for anyone not dealt into this hand."""
+        i = player.seat_index
+        return i if 0 <= i < len(self.players) and self.players[i] is player else -1
+
+    def set_hand(self, i: int, j: int, hand: str):
+        cards = [hand[k] for k in range(0, len(hand) - len(hand) % 2, 2)]
+        self.hard[i, j] = sum(card_values[c] for c in cards)
+        self.aces[i, j] = cards.count("A")
+        self.cards[i, j] = len(cards)
+        self.doubled[i, j] = False
+
+    def place_bet(self, player, bet: int):
+        i = self.row(player)
+        if i >= 0:
+            self.bet[i] = bet
+
+    def insure(self, player):
+        i = self.row(player)
+        if i >= 0:
+            self.insured[i] = True
+
+    def deal(self, player, hand: str):
+        i = self.row(player)
+        if i >= 0:
+            self.num_hands[i] = 1
+            self.set_hand(i, 0, hand)
+
+    def add_card(self, player, card: str):
+        """A card onto the player's first hand."""
+        i = self.row(player)
+        if i >= 0:
+            self.hard[i, 0] += card_values[card[0]]
+            self.aces[i, 0] += card[0] == "A"
+            self.cards[i, 0] += 1
+
+    def double(self, player):
+        i = self.row(player)
+        if i >= 0:
+            self.doubled[i, 0] = True
+
+    def split(self, player, first: str, second: str):
+        """The first hand has become the two hands first and second, pushing the others along one."""
+        i = self.row(player)
+        if i < 0:
             return
+        n = self.num_hands[i]
+        for a in (self.hard, self.aces, self.cards, self.doubled):
+            a[i, 2:n + 1] = a[i, 1:n].copy()
+        self.set_hand(i, 0, first)
+        self.set_hand(i, 1, second)
+        self.num_hands[i] = n + 1
+
+    def activate(self, player, idx: int):
+        """Hand idx has moved to the front, as in make_active_hand."""
+        i = self.row(player)
+        if i < 0 or idx == 0:
+            return
+        for a in (self.hard, self.aces, self.cards, self.doubled):
+            a[i, :idx + 1] = np.roll(a[i, :idx + 1], 1)
+
+    def settle(self, dealer_holding: str) -> tuple:
+        """Settle every row against the dealer, by the rules in Player.Settle.  Returns per-seat arrays of (currency
+        paid out, wins, losses, pushes)."""
+        dealer_value = hand_value(dealer_holding)
+        dealer_bj = dealer_value == 21 and len(dealer_holding) == 5
+        n = len(self.players)
+        num_hands = self.num_hands[:n]
+        bet = self.bet[:n, None]
+        hard = self.hard[:n]
+        hv = np.where((self.aces[:n] > 0) & (hard + 10 <= 21), hard + 10, hard)
+        doubled = self.doubled[:n]
+        held = np.arange(self.max_hands) < num_hands[:, None]
+
+        alive = held & (hv <= 21)
+        insurance = alive & self.insured[:n, None] & dealer_bj
+        push = alive & (hv == dealer_value)
+        won = alive & ~push & ((dealer_value > 21) | (hv > dealer_value))
+        # A two card 21 is always marked finished before settling, so this is Player.Settle's len(h) == 5.
+        blackjack = won & ~doubled & (hv == 21) & (self.cards[:n] == 2) & (num_hands[:, None] == 1)
+        paid = (insurance.astype(np.int64) + push + won) * bet + (won & doubled) * 3 * bet + \
+            (won & ~doubled & ~blackjack) * bet + blackjack * np.rint(bet * 1.5).astype(np.int64)
+
+        wins = (insurance | won).sum(axis=1)
+        pushes = (push & ~(insurance | won)).sum(axis=1)
+        return (paid.sum(axis=1), wins, num_hands - wins - pushes, pushes)
+
+
+def check_settlement(rounds: int = 2000) -> int:
+    """Differential check of SeatArrays against Player.Settle.  Random hands are played through the calls Table.deal
+    makes - bets, insurance, the deal, random HITs, DOUBLEs and SPLITs through act_on, hands brought to the front with
+    make_active_hand - so the arrays are kept up to date exactly as in play, then every seat is settled both ways.
+    Returns the number of rounds that disagreed."""
+    global house_currency, house_total
+    table = Table()
+    table.arrays = SeatArrays()
+    failures = 0
+    start = (house_currency, house_total)
+    for r in range(0, rounds):
+        table.shoe = new_shoe(8)
+        players = []
+        for i in range(0, random.randint(1, 12)):
+            p = Player.__new__(Player)
+            p.reset(None, table, "", 0)
+            p.currency = random.randint(0, 50) * 2 + random.choice([0, 20, 1000])    # Some can't double or split.
+            players.append(p)
+        table.arrays.begin(players)
+        for p in players:
+            p.place_bet(str(random.randint(0, min(50, p.currency // 2)) * 2))
+            if p.playing:
+                p.holding = [table.get_card() + table.get_card()]
+                table.arrays.deal(p, p.holding[0])
+        table.dealer_holding = table.get_card() + table.get_card()
+        for p in players:
+            if p.playing and p.can_insure() and random.random() < 0.3:
+                p.take_insurance("YES")
+        if table.dealer_holding[0] == "A" and hand_value(table.dealer_holding) == 21:
+            for p in players:
+                if p.playing:
+                    p.holding[0] += "."
+        else:
+            for p in players:
+                h = p.hand_left_to_play() if p.playing else None
+                while h is not None:
+                    p.make_active_hand(h)
+                    if hand_value(p.holding[0]) >= 21:
+                        p.holding[0] += "."
+                    else:
+                        p.act_on(table, random.choice(p.act_choices()[0]))
+                    h = p.hand_left_to_play()
+            table.play_dealer()
+
+        fields = ("currency", "count_wins", "count_losses", "count_pushes")
+        before = [[getattr(p, f) for f in fields] for p in players]
+        house = house_currency
+        for p in players:
+            p.Settle(table)
+        scalar = [[getattr(p, f) for f in fields] for p in players]
+        scalar_house = house_currency - house
+        for (p, values) in zip(players, before):
+            for (f, v) in zip(fields, values):
+                setattr(p, f, v)
+        house_currency = house
+        table.settle_arrays()
+        vector = [[getattr(p, f) for f in fields] for p in players]
+        if scalar_house != house_currency - house or scalar != vector:
+            failures += 1
+            print("Mismatch: dealer " + table.dealer_holding + " " + " ".join("/".join(p.holding) for p in players))
+    (house_currency, house_total) = start
+    print("Settlement check: {0!s} of {1!s} rounds disagreed.".format(failures, rounds))
+    return failures
+
+
+def check_evsolver(decks: int) -> int:
+    """Compare evsolver's STAND and DOUBLE values, for every two card start against every up card, with an exact
+    enumeration through the server's own rules: each way the dealer can finish (drawing to hand_value 17, with a peek
+    under an ace) and each double card, settled by Player.Settle.  Cards are drawn from the same fixed composition
+    evsolver assumes, so the two should agree to rounding - anything more is a rule evsolver gets wrong.  Returns the
+    number of values that disagreed."""
+    failures = 0
+    table = Table()
+    p = Player.__new__(Player)
+    p.reset(None, table, "", 0)
+    values = {}         # hand_value of each dealer hand - the same hands come up for every start.
+
+    def settle(hand: str, dealer: str, bets: int) -> float:
+        """What hand wins, in bets, against the dealer's finished hand, having put bets bets in."""
+        p.holding = [hand]
+        p.cur_bet = 2
+        p.currency = 1000 - 2 * bets
+        p.insured = False
+        table.dealer_holding = dealer
+        p.Settle(table)
+        return (p.currency - 1000) / 2
+
+    for up in range(0, 10):
+        for r1 in range(0, 10):
+            for r2 in range(r1, 10):
+                hard = evsolver.VALUES[r1] + evsolver.VALUES[r2]
+                if evsolver.value(hard, r1 == 0) == 21:
+                    continue        # A blackjack never gets an ACT.
+                counts = evsolver.composition(decks, [r1, r2, up])
+                situation = evsolver.Situation(up, counts)
+                chances = [c / sum(counts) for c in counts]
+                # The dealer's finishing hands, one of each kind Settle can tell apart, with their chances.
+                finals = {}
+                holes = [0.0 if up == 0 and r == 9 else chances[r] for r in range(0, 10)]
+                pending = {evsolver.RANKS[up] + "S" + evsolver.RANKS[r] + "S": holes[r] / sum(holes)
+                           for r in range(0, 10) if holes[r] > 0.0}
+                while len(pending) > 0:
+                    drawing = {}
+                    for (dealer, chance) in pending.items():
+                        if dealer not in values:
+                            values[dealer] = hand_value(dealer)
+                        if values[dealer] < 17:
+                            for r in range(0, 10):
+                                if chances[r] > 0.0:
+                                    # Hands that drew the same cards in a different order play on the same way, so
+                                    # they're kept as one, with the draws sorted.
+                                    drawn = sorted([dealer[i:i + 2] for i in range(4, len(dealer), 2)] +
+                                                   [evsolver.RANKS[r] + "S"])
+                                    key = dealer[0:4] + "".join(drawn)
+                                    drawing[key] = drawing.get(key, 0.0) + chance * chances[r]
+                        else:
+                            key = (min(values[dealer], 22), len(dealer) == 4)
+                            finals[key] = (finals[key][0] if key in finals else dealer + ".",
+                                           chance + (finals[key][1] if key in finals else 0.0))
+                    pending = drawing
+                hand = evsolver.RANKS[r1] + "S" + evsolver.RANKS[r2] + "S"
+                stand = sum(chance * settle(hand + ".", dealer, 1) for (dealer, chance) in finals.values())
+                double = sum(chances[r] * chance * settle(hand + evsolver.RANKS[r] + "S+", dealer, 2)
+                             for r in range(0, 10) if chances[r] > 0.0 for (dealer, chance) in finals.values())
+                for (verb, exact, solved) in (("STAND", stand, situation.stand(evsolver.value(hard, r1 == 0))),
+                                              ("DOUBLE", double, situation.double(hard, r1 == 0))):
+                    if abs(exact - solved) > 1e-9:
+                        failures += 1
+                        print("Mismatch: {0} decks, {1}{2} against {3}: evsolver has {4} at {5:+.6f}, the server's "
+                              "rules give {6:+.6f}.".format(decks, evsolver.RANKS[r1], evsolver.RANKS[r2],
+                                                            evsolver.RANKS[up], verb, solved, exact))
+    return failures
+
+
+def check_strategy(path: str, rounds: int = 200000) -> int:
+    """Check a basicstrategy.py file against the server.  First that evsolver (which the tables come from) totals hands
+    the way hand_value does, and that its STAND and DOUBLE values match an exact enumeration through Player.Settle
+    (check_evsolver) for each table's deck count.  Then, as a coarser end to end check, that each table, played for
+    rounds hands through Policy, Player.act_on and Player.Settle, returns what it says it will - within four standard
+    errors, which over 200,000 hands is about a percent either way.  The shoe is dealt down and reshuffled the way
+    Table.shuffle_if_needed does it.  Returns the number of checks that failed."""
+    global house_currency, house_total
+    failures = 0
+    hands = [""]
+    for n in range(0, 6):
+        hands = [h + c + "S" for h in hands for c in "A23456789T" if h == "" or c >= h[-2]]
+        for h in hands:
+            ranks = evsolver.hand_ranks(h)
+            if len(ranks) >= 2 and \
+                    evsolver.value(sum(evsolver.VALUES[r] for r in ranks), 0 in ranks) != hand_value(h):
+                failures += 1
+                print("Mismatch: evsolver totals " + h + " differently from hand_value.")
+
+    start = (house_currency, house_total)
+    table = Table()
+    tables = basicstrategy.load(path)
+    for decks in sorted(d for d in tables if d > 0):
+        mismatches = check_evsolver(decks)
+        failures += mismatches
+        print("{0!s} decks: {1!s} STAND and DOUBLE values disagree with the server's rules.".format(decks, mismatches))
+    for decks in sorted(d for d in tables if d > 0):     # There's no dealing from the infinite shoe.
+        strategy = tables[decks]
+        policy = Policy(strategy.policy_line()[len("POLICY "):])
+        table.decks = decks
+        table.shoe = []
+        total = 0.0
+        squares = 0.0
+        for r in range(0, rounds):
+            # As Table.shuffle_if_needed, with more to spare - a hand split four times can take a lot of cards.
+            if len(table.shoe) < decks * 52 * SHOE_MIN_PERCENT / 100 or len(table.shoe) < 26:
+                table.shoe = new_shoe(decks)
+            p = Player.__new__(Player)
+            p.reset(None, table, "", 0)
+            p.policy = policy
+            p.currency = 998        # After a bet of 2, so a blackjack's 3:2 comes out even.
+            p.cur_bet = 2
+            p.holding = [table.get_card() + table.get_card()]
+            table.dealer_holding = table.get_card() + table.get_card()
+            if table.dealer_holding[0] == "A" and hand_value(table.dealer_holding) == 21:
+                p.holding[0] += "."     # The peek - as Table.deal, with policy's INS=N.
+            else:
+                h = p.hand_left_to_play()
+                while h is not None:
+                    p.make_active_hand(h)
+                    if hand_value(p.holding[0]) >= 21:
+                        p.holding[0] += "."
+                    else:
+                        (valid_verbs, invalid_verbs) = p.act_choices()
+                        p.act_on(table, p.policy_act(table, valid_verbs))
+                    h = p.hand_left_to_play()
+                table.play_dealer()
+            p.Settle(table)
+            won = (p.currency - 1000) / 2
+            total += won
+            squares += won * won
+        mean = total / rounds
+        error = ((squares / rounds - mean * mean) / rounds) ** 0.5
+        ok = abs(mean - strategy.ev) <= 4.0 * error
+        if not ok:
+            failures += 1
+        print("{0!s} decks: expected {1:+.3%} per hand, played {2:+.3%} +/- {3:.3%}{4}".format(
+            decks, strategy.ev, mean, error, "" if ok else " - MISMATCH"))
+    (house_currency, house_total) = start
+    print("Strategy check: {0!s} checks failed.".format(failures))
+    return failures
 
 
 # Helper functions to allow us to query all the players at once for things that don't depend on the order of plays.
 def helper_ready(k):
-    gametable.players[k].Ready(gametable)
+    group = gametable.players[k].group
+    if group is None:
+        gametable.players[k].Ready(gametable)
+    elif group.owner is gametable.players[k]:      # The owner's task plays every seat in the group.
+        group.Ready(gametable)
 
 
 def helper_insurance(k):
-    if gametable.players[k].playing is True:
+    group = gametable.players[k].group
+    if group is not None:
+        if group.owner is gametable.players[k]:
+            group.Insurance(gametable)
+    elif gametable.players[k].playing is True:
         gametable.players[k].Insurance(gametable)
 
 def helper_act(p):
-    if gametable.players[p].playing:
+    group = gametable.players[p].group
+    if group is not None:
+        if group.owner is gametable.players[p]:
+            group.Act(gametable)
+    elif gametable.players[p].playing:
         h = gametable.players[p].hand_left_to_play()
         while h is not None and gametable.players[p].playing:   # We need the and here in case the client disconnects
                                                                 # in the middle of the hand.
@@ -664,48 +2711,256 @@ def AcceptClient(sock, mask):
     (clientsocket, address) = sock.accept()
     clientsocket.setblocking(False)
     print("Answering a client from source IP " + address[0] + ", source port " + str(address[1]))
+    # Talk the client through HELLO on its own thread, so a crowd of clients logging back in after a blip is handled
+    # all at once, and a LOGIN can take its seat back in the middle of a hand.
+    threading.Thread(target=HandshakeClient, args=(clientsocket, address), daemon=True).start()
+
+
+def HandshakeClient(clientsocket, address):
     try:
         p = Player(clientsocket, gametable, address[0], address[1])
         if p.monitor is True:
-            gametable.monitors[p.token] = p
-        else:
-            gametable.players[p.token] = p
+            sessions.join(p)
     except ConnectionError:
         clientsocket.close()
 
 
-def RunServer():
-    # Set up server socket
-    serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    # bind the socket to a public host, and a well-known port
-    # while True:
-    #    try:
-    #        serversocket.bind(('', 9876))
-    #    except OSError:
-    #        print("Port is unavailable.  Sleeping a couple and trying again.")
-    #        time.sleep(2)
-    #        pass
-    serversocket.bind(('', 9876))
-
-    # become a server socket
-    serversocket.listen(5)
-    # set nonblocking
-    serversocket.setblocking(False)
+def RunAcceptor():
+    """Accept connections for as long as the server runs, independent of the game loop."""
+    while True:
+        events = sel.select()
+        for key, mask in events:
+            callback = key.data
+            callback(key.fileobj, mask)
+
+
+def recv_exactly(sock: socket, n: int) -> bytes:
+    ret = b""
+    while len(ret) < n:
+        data = sock.recv(n - len(ret))
+        if len(data) == 0:
+            raise ConnectionError("Handoff connection closed early.")
+        ret += data
+    return ret
+
+
+def StartUpgrade() -> (socket, subprocess.Popen):
+    """Start a new copy of this script that will take over from us, and return the Unix socket it will connect back
+    to and the new process.  The new process gets to load while we keep dealing; the actual handoff happens between
+    hands."""
+    path = os.path.join(tempfile.gettempdir(), "blackjack-upgrade-" + str(os.getpid()) + ".sock")
+    if os.path.exists(path):
+        os.unlink(path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(path)
+    listener.listen(1)
+    listener.setblocking(False)
+    print("Upgrade requested - starting the new server.")
+    args = [sys.executable, os.path.abspath(__file__), "--takeover", path]
+    if capture is not None:
+        args += ["--capture", capture.path]     # The new server appends to the same capture.
+    if table_snapshot is None:
+        args += ["--no-snapshot"]
+    if shoe_factory.seed_value is not None:
+        args += ["--seed", str(shoe_factory.seed_value)]
+    return (listener, subprocess.Popen(args))
+
+
+def AbandonUpgrade(listener: socket, process: subprocess.Popen, reason: str):
+    """Give up on an upgrade the new server never connected back for, so another SIGUSR1 can try again."""
+    print("Upgrade abandoned: " + reason)
+    path = listener.getsockname()
+    listener.close()
+    if os.path.exists(path):
+        os.unlink(path)
+    if process.poll() is None:
+        process.kill()
+    process.wait()
+
+
+def HandOff(conn: socket, serversocket: socket):
+    """Pass the table, every registered player and the listening and client sockets to the new server process, and
+    exit once it has picked them up.  Clients see nothing but a short pause.  If the new process fails to take over,
+    we carry on as before."""
+    start_time = time.monotonic()
+    sel.unregister(serversocket)
+    sessions.seat_joining(gametable)
+
+    fds = [serversocket.fileno()]
+    players = []
+    for p in list(sessions.by_token.values()) + list(gametable.monitors.values()):
+        st = {f: getattr(p, f) for f in Player.saved_fields}
+        st["seated"] = p.seated
+        st["fd"] = None
+        if (p.seated or p.monitor) and not p.disconnected and p.sock is not None:
+            st["fd"] = len(fds)
+            fds.append(p.sock.fileno())
+        players.append(st)
+    for st in sessions.offline.states():
+        st["seated"] = False
+        st["fd"] = None
+        players.append(st)
+    state = {"players": players, "hands_dealt": gametable.hands_dealt, "decks": gametable.decks,
+             "shoe": gametable.shoe, "house_currency": house_currency, "house_total": house_total,
+             "settings": [COMMAND_TIMEOUT, SHOE_MIN_PERCENT, GAME_WAIT_TIME, START_CURRENCY, MINIMUM_DECKS, AUTOTUNE,
+                          AUTOTUNE_TARGET_HPM, AUTOTUNE_SLO, SOA_SETTLEMENT, SCORING],
+             "fd_count": len(fds)}
+    with scorer.lock:
+        state["scores"] = {token: list(t) for (token, t) in scorer.totals.items()}
+    data = pickle.dumps(state)
+    try:
+        conn.setblocking(True)
+        conn.sendall(struct.pack("!Q", len(data)) + data)
+        for i in range(0, len(fds), HANDOFF_FDS_PER_MSG):
+            socket.send_fds(conn, [b"F"], fds[i:i + HANDOFF_FDS_PER_MSG])
+        if conn.recv(1) != b"K":
+            raise ConnectionError("New server did not acknowledge the handoff.")
+    except OSError as e:
+        print("Upgrade failed, continuing on the old server: " + str(e))
+        sel.register(serversocket, selectors.EVENT_READ, AcceptClient)
+        return
+    print("Handed off {0!s} players and {1!s} sockets in {2:.1f} ms.".format(
+        len(players), len(fds), (time.monotonic() - start_time) * 1000.0))
+    if capture is not None:
+        capture.close()
+    if profiler.running():
+        try:
+            print("Wrote {0!s} samples ({1!s} stacks) to {2}.".format(*profiler.stop()))
+        except OSError as e:
+            print("Couldn't write the profile: " + str(e))
+    sys.stdout.flush()
+    # Leave without closing anything - the sockets now belong to the new server.
+    os._exit(0)
+
+
+def TakeOver(path: str) -> socket:
+    """Connect to the old server process at path, rebuild its state and adopt its sockets.  Returns the listening
+    socket."""
+    global house_currency, house_total, COMMAND_TIMEOUT, SHOE_MIN_PERCENT, GAME_WAIT_TIME, START_CURRENCY, MINIMUM_DECKS
+    global AUTOTUNE, AUTOTUNE_TARGET_HPM, AUTOTUNE_SLO, SOA_SETTLEMENT, SCORING
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.connect(path)
+    (length,) = struct.unpack("!Q", recv_exactly(conn, 8))
+    state = pickle.loads(recv_exactly(conn, length))
+    fds = []
+    while len(fds) < state["fd_count"]:
+        (msg, new_fds, flags, addr) = socket.recv_fds(conn, 1, HANDOFF_FDS_PER_MSG)
+        if len(msg) == 0:
+            raise ConnectionError("Handoff connection closed early.")
+        fds += new_fds
+    socks = [socket.socket(fileno=fd) for fd in fds]
+    for sk in socks:
+        sk.setblocking(False)
+
+    gametable.hands_dealt = state["hands_dealt"]
+    gametable.decks = state["decks"]
+    gametable.shoe = state["shoe"]
+    house_currency = state["house_currency"]
+    house_total = state["house_total"]
+    settings = state["settings"]
+    (COMMAND_TIMEOUT, SHOE_MIN_PERCENT, GAME_WAIT_TIME, START_CURRENCY, MINIMUM_DECKS, AUTOTUNE, AUTOTUNE_TARGET_HPM,
+     AUTOTUNE_SLO) = settings[0:8]
+    if len(settings) > 8:       # Servers from before these could be SET don't send them.
+        (SOA_SETTLEMENT, SCORING) = settings[8:10]
+    scorer.restore(state.get("scores", {}))
+    for st in state["players"]:
+        p = Player.restore(st, socks[st["fd"]] if st["fd"] is not None else None, gametable)
+        if p.monitor is True:
+            gametable.monitors[p.srcip + ":" + str(p.srcpt)] = p
+            continue
+        leaderboard.update(p)
+        sessions.by_token[p.token] = p
+        sessions.by_name[p.name] = p.token
+        if st["seated"] and p.sock is not None:
+            gametable.players[p.token] = p
+            p.seated = True
+            if p.subscription != "PLAY":
+                sel.register(p.sock, selectors.EVENT_READ, p.idle_input)
+        else:
+            sessions.put_offline(p)
+    # Multi-seat clients pick their other seats back up (they went offline above, having no socket of their own).
+    for p in list(gametable.players.values()):
+        if p.seats > 1:
+            sessions.claim_seats(p, p.seats)
+    conn.sendall(b"K")
+    conn.close()
+    os.unlink(path)
+    return socks[0]
+
+
+def RequestUpgrade(signum, frame):
+    global upgrade_requested
+    upgrade_requested = True
+
+
+def RunServer(takeover: str = None):
+    global upgrade_requested
+    if takeover is None:
+        # Set up server socket
+        serversocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # bind the socket to a public host, and a well-known port
+        # while True:
+        #    try:
+        #        serversocket.bind(('', 9876))
+        #    except OSError:
+        #        print("Port is unavailable.  Sleeping a couple and trying again.")
+        #        time.sleep(2)
+        #        pass
+        serversocket.bind(('', 9876))
+
+        # become a server socket
+        serversocket.listen(5)
+        # set nonblocking
+        serversocket.setblocking(False)
+    else:
+        # Picking up from a server being upgraded - it hands us the listening socket along with everyone else's.
+        serversocket = TakeOver(takeover)
+        print("Took over {0!s} players from the previous server.".format(len(gametable.players)))
+    if SCORING == 1:
+        scorer.start()
     sel.register(serversocket, selectors.EVENT_READ, AcceptClient)
     print("Now accepting connections at " + socket.gethostname() + ", port 9876.")
-
-    # Now iterate.  Listen to server socket for things.  Process other things.
+    threading.Thread(target=RunAcceptor, daemon=True).start()
+    # "kill -USR1" upgrades to whatever server.py is on disk now.
+    signal.signal(signal.SIGUSR1, RequestUpgrade)
+    upgrade_listener = None
+    upgrade_process = None
+    upgrade_deadline = 0.0
+
+    # Now iterate.  Seat anyone who joined since the last hand, then play.
     while True:
         if SHOW_COMMS == 1:
             print("Tick")
-        events = sel.select(GAME_WAIT_TIME)
-        for key, mask in events:
-            callback = key.data
-            callback(key.fileobj, mask)
+        time.sleep(GAME_WAIT_TIME)
+        if upgrade_requested and upgrade_listener is None:
+            (upgrade_listener, upgrade_process) = StartUpgrade()
+            upgrade_deadline = time.monotonic() + UPGRADE_TIMEOUT
+        if upgrade_listener is not None:
+            failed = None
+            try:
+                (conn, addr) = upgrade_listener.accept()
+            except BlockingIOError:  # New server still starting up, keep dealing.
+                if upgrade_process.poll() is not None:
+                    failed = "the new server exited with status " + str(upgrade_process.returncode) + "."
+                elif time.monotonic() > upgrade_deadline:
+                    failed = "the new server didn't connect back within " + str(UPGRADE_TIMEOUT) + " seconds."
+            else:
+                HandOff(conn, serversocket)     # Only returns if the new server didn't take over.
+                conn.close()
+                failed = "the handoff failed."
+            if failed is not None:
+                AbandonUpgrade(upgrade_listener, upgrade_process, failed)
+                upgrade_listener = None
+                upgrade_process = None
+                upgrade_requested = False
+        sessions.seat_joining(gametable)
 
         # If we have ready players, run a hand.
         if len(gametable.players) > 0:
             gametable.deal()
+            autotuner.adjust(gametable)
+            if capture is not None:
+                capture.flush()
     exit(0)
 
     try:
@@ -735,7 +2990,14 @@ def RunServer():
         serversocket.close()
 
 
-# Set up our table.
+# Decision scoring pool, background shuffler, registered players, and our table.
+scorer = DecisionScorer(SCORING_WORKERS)
+sessions = SessionRegistry()
+shoe_factory = ShoeFactory()
+autotuner = AutoTuner()
+profiler = StackSampler()
+leaderboard = Leaderboard()
+shoe_factory.request(MINIMUM_DECKS)     # Have the first shoe ready before the first hand.
 gametable = Table()
 # Prep selector.
 sel = selectors.DefaultSelector()
@@ -743,4 +3005,34 @@ sel = selectors.DefaultSelector()
 pool = ThreadPool(8)
 
 if __name__ == "__main__":
-    RunServer()
+    parser = argparse.ArgumentParser(description="The Blackjack server.")
+    parser.add_argument("--check-settlement", action="store_true",
+                        help="Check the vectorized settlement against the per-player one, then exit.")
+    parser.add_argument("--check-strategy", metavar="FILE",
+                        help="Play the tables in a basicstrategy.py file through the server's rules, then exit.")
+    parser.add_argument("--takeover", help=argparse.SUPPRESS)   # Used by an upgrade - see StartUpgrade.
+    parser.add_argument("--capture", help="Append every seated client's responses to this file, for replay.py.")
+    parser.add_argument("--seed", type=int, help="Shuffle reproducible shoes from this seed.")
+    parser.add_argument("--no-snapshot", action="store_true",
+                        help="Don't publish the table state in shared memory (" + tablesnapshot.SNAPSHOT_NAME + ").")
+    args = parser.parse_args()
+    if args.check_settlement:
+        sys.exit(1 if check_settlement() > 0 else 0)
+    if args.check_strategy is not None:
+        sys.exit(1 if check_strategy(args.check_strategy) > 0 else 0)
+    if args.seed is not None:
+        shoe_factory.seed(args.seed)
+    if args.capture is not None:
+        capture = TrafficCapture(args.capture)
+        atexit.register(capture.close)
+    if not args.no_snapshot:
+        # An upgraded server carries on in the same segment, so only a clean exit removes it.
+        try:
+            table_snapshot = tablesnapshot.SnapshotWriter(takeover=args.takeover is not None)
+        except FileExistsError as e:
+            print(str(e) + "  Carrying on without a snapshot.")
+        else:
+            atexit.register(table_snapshot.close)
+    atexit.register(profiler.close)
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    RunServer(args.takeover)
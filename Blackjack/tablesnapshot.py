@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+"""The table state in shared memory, for tools running on the server's own machine.
+
+Instead of opening a MONITOR connection, a local tool can map the server's snapshot segment (SNAPSHOT_NAME, under
+/dev/shm on Linux) and poll it.  After every monitor update the server writes a fixed header followed by the monitor
+line, exactly as MONITOR clients get it:
+
+    seq         Q   Seqlock sequence - odd while the server is writing.
+    version     Q   Updates published since the segment was created.
+    magic       4s  b"BJS1".
+    pid         I   The server process writing it.
+    time        d   Unix time of the update.
+    hands       q   Hands dealt.
+    decks       i   Decks in the shoe.
+    shoe        i   Cards left in the shoe.
+    house       q   House winnings.
+    house_total q   Total bet.
+    players     I   Players seated.
+    flags       I   FLAG_TOO_BIG if the monitor line didn't fit - then length is 0 and only the header is current.
+    length      I   Bytes of monitor line after the header.
+    capacity    I   Bytes of room after the header.
+
+all little endian.  A reader copies the header and line out between two reads of seq, and keeps the copy only if seq
+was even and didn't change - otherwise the server was mid-write and it tries again.  The numbers in the header are
+enough for a scraper; anything else can go through monitor.parse_table_state on the line."""
+import os
+import fcntl
+import struct
+import time
+import threading
+from multiprocessing import shared_memory, resource_tracker
+
+SNAPSHOT_NAME = "blackjack_table"
+SNAPSHOT_BYTES = 8388608        # Room for the monitor line - about 100,000 players.
+HEADER = struct.Struct("<QQ4sIdqiiqqIIII")
+MAGIC = b"BJS1"
+FLAG_TOO_BIG = 1
+READ_RETRIES = 1000
+
+
+def untrack(shm: shared_memory.SharedMemory):
+    """Stop the resource tracker unlinking the segment when this process exits.  The server unlinks it itself on a
+    clean shutdown, and leaves it for the upgraded server to pick up on a handoff."""
+    try:
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except (AttributeError, KeyError):
+        pass
+
+
+def pid_alive(pid: int) -> bool:
+    if pid <= 0:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class SnapshotWriter:
+    """The server's end.  publish() is called from whichever thread updated the monitors, so writes are serialized
+    with a lock - the seqlock only has to protect readers from a writer, not writers from each other.  During an upgrade
+    the old and new servers both have the segment open, so the lock is an flock on the segment itself.
+
+    An existing segment is only carried on in when taking over from the server that wrote it, or when that server is
+    gone.  Otherwise FileExistsError - another server is still publishing there."""
+
+    def __init__(self, name: str = SNAPSHOT_NAME, size: int = SNAPSHOT_BYTES, takeover: bool = False):
+        self.lock = threading.Lock()
+        try:
+            self.create(name, size)
+        except FileExistsError:
+            self.shm = shared_memory.SharedMemory(name)
+            untrack(self.shm)
+            if bytes(self.shm.buf[16:20]) != MAGIC:
+                self.shm.close()
+                raise FileExistsError(name + " exists and is not a table snapshot.")
+            pid = struct.unpack_from("<I", self.shm.buf, 20)[0]
+            if not takeover and pid != os.getpid() and pid_alive(pid):
+                self.shm.close()
+                raise FileExistsError(name + " is in use by server process " + str(pid) + ".")
+            # When taking over, the old server is still writing it until the handoff - so even if it's too small, carry
+            # on in it rather than pull it away.
+            if self.shm.size < HEADER.size + size and not takeover:
+                self.shm.close()
+                self.shm.unlink()
+                self.create(name, size)
+        self.buf = self.shm.buf
+        self.capacity = self.shm.size - HEADER.size
+        if not takeover:
+            # Claim it now, so a second server started by mistake sees it taken before our first publish.
+            struct.pack_into("<I", self.buf, 20, os.getpid())
+
+    def create(self, name: str, size: int):
+        self.shm = shared_memory.SharedMemory(name, create=True, size=HEADER.size + size)
+        untrack(self.shm)
+        self.shm.buf[16:20] = MAGIC
+
+    def publish(self, hands: int, decks: int, shoe: int, house: int, house_total: int, players: int, line: str):
+        data = bytes(line, "utf-8")
+        with self.lock:
+            fcntl.flock(self.shm._fd, fcntl.LOCK_EX)
+            try:
+                self.write(data, hands, decks, shoe, house, house_total, players)
+            finally:
+                fcntl.flock(self.shm._fd, fcntl.LOCK_UN)
+
+    def write(self, data: bytes, hands: int, decks: int, shoe: int, house: int, house_total: int, players: int):
+        # Carry on from whatever is in the segment, which may have been left there by the server we took over from.
+        (seq, version) = struct.unpack_from("<QQ", self.buf, 0)
+        seq += 1 + seq % 2      # Odd - and if a writer died mid-update, past its odd number.
+        struct.pack_into("<Q", self.buf, 0, seq)
+        flags = 0
+        if len(data) > self.capacity:
+            flags = FLAG_TOO_BIG
+            data = b""
+        self.buf[HEADER.size:HEADER.size + len(data)] = data
+        HEADER.pack_into(self.buf, 0, seq, version + 1, MAGIC, os.getpid(), time.time(), hands, decks, shoe,
+                         house, house_total, players, flags, len(data), self.capacity)
+        struct.pack_into("<Q", self.buf, 0, seq + 1)
+
+    def close(self, unlink: bool = True):
+        """Unmap the segment, and unlink it too if this process is the one publishing there.  A server that never got
+        going (a failed takeover, say) leaves it to the server it belongs to."""
+        with self.lock:
+            fcntl.flock(self.shm._fd, fcntl.LOCK_EX)
+            if unlink and struct.unpack_from("<I", self.buf, 20)[0] == os.getpid():
+                try:
+                    resource_tracker.register(self.shm._name, "shared_memory")   # unlink() unregisters it again.
+                    self.shm.unlink()
+                except FileNotFoundError:
+                    pass
+            self.buf = None
+            self.shm.close()
+
+
+class SnapshotReader:
+    """A tool's end.  Cheap to poll: version() is one unpack, and read() only copies when there's something new."""
+
+    def __init__(self, name: str = SNAPSHOT_NAME):
+        self.shm = shared_memory.SharedMemory(name)
+        untrack(self.shm)
+        self.buf = self.shm.buf
+        if bytes(self.buf[16:20]) != MAGIC:
+            raise ValueError(name + " is not a table snapshot.")
+
+    def version(self) -> int:
+        return struct.unpack_from("<Q", self.buf, 8)[0]
+
+    def read(self) -> (dict, str):
+        """Return a consistent copy of the header (as a dict) and the monitor line."""
+        for i in range(READ_RETRIES):
+            seq = struct.unpack_from("<Q", self.buf, 0)[0]
+            if seq % 2 == 1:
+                time.sleep(0)
+                continue
+            header = HEADER.unpack_from(self.buf, 0)
+            line = bytes(self.buf[HEADER.size:HEADER.size + min(header[12], header[13])])
+            if struct.unpack_from("<Q", self.buf, 0)[0] == seq:
+                keys = ("seq", "version", "magic", "pid", "time", "hands", "decks", "shoe", "house_currency",
+                        "house_total", "players", "flags", "length", "capacity")
+                return (dict(zip(keys, header)), str(line, "utf-8"))
+        raise TimeoutError("The snapshot never held still long enough to read.")
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+import selectors
+import socket
+import random
+import time
+import argparse
+from collections import deque
+import monitor
+
+# Some global variables
+PROXY_PORT = 9875               # Where clients connect instead of the server.
+RETRANSMIT_DELAY = 0.2          # What a "lost" segment costs.  TCP resends it, so loss shows up as an extra delay.
+REPORT_INTERVAL = 10.0          # How often to print the degradation report.
+PROMPT_VERBS = ("READY", "INSURANCE", "ACT")
+
+
+class Link:
+    """One direction of one proxied connection.  Bytes read from src are held until their due time and then written to
+    dst.  Delivery stays in order, so jitter can stretch the gaps between chunks but never reorder them."""
+
+    def __init__(self, src: socket, dst: socket, args):
+        self.src = src
+        self.dst = dst
+        self.args = args
+        self.queue = deque()        # (due time, bytes), in due time order.
+        self.last_due = 0.0
+        self.free_at = 0.0          # When the emulated wire has finished sending what's already queued.
+        self.lines = bytearray()    # Undelivered partial line, for the statistics.
+
+    def receive(self, data: bytes, now: float):
+        a = self.args
+        due = now + max(0.0, random.gauss(a.delay, a.jitter)) / 1000.0
+        if random.random() < a.loss:
+            due += RETRANSMIT_DELAY
+        if random.random() < a.stall_rate:
+            due += a.stall_time
+        if a.bandwidth > 0:
+            due = max(due, self.free_at) + len(data) * 8 / (a.bandwidth * 1000.0)
+            self.free_at = due
+        due = max(due, self.last_due)
+        self.last_due = due
+        self.queue.append((due, data))
+
+    def next_due(self) -> float:
+        return self.queue[0][0] if len(self.queue) > 0 else None
+
+    def deliver(self, now: float) -> list:
+        """Write out everything that's due.  Returns the complete lines that went past, for the statistics."""
+        out = bytearray()
+        while len(self.queue) > 0 and self.queue[0][0] <= now:
+            out += self.queue.popleft()[1]
+        if len(out) == 0:
+            return []
+        self.dst.sendall(out)
+        self.lines += out
+        end = self.lines.rfind(b"\n")
+        if end < 0:
+            return []
+        ret = str(bytes(self.lines[:end]), "utf-8", "replace").split("\n")
+        del self.lines[:end + 1]
+        return ret
+
+
+class ProxiedClient:
+    def __init__(self, client: socket, server: socket, args):
+        self.client = client
+        self.server = server
+        self.up = Link(client, server, args)
+        self.down = Link(server, client, args)
+        self.binary = False         # After a LOGIN ... BIN1 the stream is no longer lines, so we stop counting.
+
+    def links(self):
+        return (self.up, self.down)
+
+
+class Stats:
+    """What the proxy sees go past, plus what the server's own monitor line says about the same period."""
+
+    def __init__(self):
+        self.prompts = 0
+        self.timeouts = 0
+        self.dones = 0
+        self.connections = 0
+        self.first = None           # (time, parsed table state) at the start of the run.
+        self.latest = None
+
+    def count(self, pc: ProxiedClient, lines: list, from_server: bool):
+        if pc.binary:
+            return
+        for line in lines:
+            verb = line.strip().split(" ")[0].upper()
+            if from_server:
+                if verb in PROMPT_VERBS:
+                    self.prompts += 1
+                elif verb == "TIMEOUT":
+                    self.timeouts += 1
+                elif verb == "DONE":
+                    self.dones += 1
+            elif verb == "LOGIN" and "BIN1" in line:
+                pc.binary = True
+
+    def table(self, state: str):
+        try:
+            self.latest = (time.monotonic(), monitor.parse_table_state(state))
+        except (ValueError, IndexError):
+            return
+        if self.first is None:
+            self.first = self.latest
+
+    def report(self, args) -> str:
+        ret = "{0} delay={1:.0f}+/-{2:.0f}ms loss={3:.1%} stall={4:.1%}x{5:.1f}s bw={6} | clients={7} prompts={8} " \
+              "timeouts={9} ({10:.1%}) results={11}".format(
+                  time.strftime("%H:%M:%S"), args.delay, args.jitter, args.loss, args.stall_rate, args.stall_time,
+                  str(args.bandwidth) + "kbit" if args.bandwidth > 0 else "-", self.connections, self.prompts,
+                  self.timeouts, self.timeouts / self.prompts if self.prompts > 0 else 0.0, self.dones)
+        if self.first is not None and self.latest[0] > self.first[0]:
+            (t0, old) = self.first
+            (t1, new) = self.latest
+            icount = 0
+            itime = 0.0
+            for name, stats in new["players"].items():
+                before = old["players"].get(name, [0] * 8)
+                icount += stats[6] - before[6]
+                itime += stats[7] - before[7]
+            ret += " | server: hands/min={0:.0f} interactions={1} avg wait={2:.1f}ms".format(
+                (new["hands"] - old["hands"]) * 60.0 / (t1 - t0), icount, itime / icount * 1000.0 if icount > 0 else 0.0)
+        return ret
+
+
+def RunProxy(args):
+    """Accept clients on args.port, open a connection to the server for each, and pass the bytes both ways through the
+    emulated WAN.  Everything runs on one selector loop; the only timer is the earliest due chunk."""
+    sel = selectors.DefaultSelector()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind(('', args.port))
+    listener.listen(50)
+    listener.setblocking(False)
+    sel.register(listener, selectors.EVENT_READ, None)
+    print("Proxying port " + str(args.port) + " to " + args.ip + ":" + str(args.server_port) + ".", flush=True)
+
+    stats = Stats()
+    receiver = None
+    if not args.no_monitor:
+        # The server's view of the same hands, taken directly rather than through the emulated WAN.
+        monitor.SERVER_PORT = args.server_port
+        receiver = monitor.TableStateReceiver(args.ip, "WanProxy_Mon")
+        receiver.daemon = True
+        receiver.start()
+    seen_version = 0
+    clients = []
+    next_report = time.monotonic() + args.interval
+
+    def drop(pc: ProxiedClient):
+        for s in (pc.client, pc.server):
+            try:
+                sel.unregister(s)
+            except KeyError:
+                pass
+            s.close()
+        clients.remove(pc)
+
+    while True:
+        now = time.monotonic()
+        dues = [l.next_due() for pc in clients for l in pc.links() if len(l.queue) > 0]
+        wait = min(dues + [next_report]) - now
+        for key, mask in sel.select(max(wait, 0.0)):
+            if key.data is None:
+                (conn, address) = listener.accept()
+                try:
+                    server = socket.create_connection((args.ip, args.server_port))
+                except OSError as msg:
+                    print("Could not reach the server for " + address[0] + ": " + str(msg))
+                    conn.close()
+                    continue
+                for s in (conn, server):
+                    s.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                pc = ProxiedClient(conn, server, args)
+                clients.append(pc)
+                stats.connections += 1
+                sel.register(conn, selectors.EVENT_READ, (pc, pc.up))
+                sel.register(server, selectors.EVENT_READ, (pc, pc.down))
+                continue
+            (pc, link) = key.data
+            if pc not in clients:
+                continue
+            try:
+                data = link.src.recv(65536)
+            except OSError:
+                data = b""
+            if len(data) == 0:
+                drop(pc)
+                continue
+            link.receive(data, time.monotonic())
+
+        now = time.monotonic()
+        for pc in list(clients):
+            try:
+                stats.count(pc, pc.up.deliver(now), False)
+                stats.count(pc, pc.down.deliver(now), True)
+            except OSError:
+                drop(pc)
+
+        if receiver is not None:
+            (version, state) = receiver.get_latest()
+            if version != seen_version:
+                seen_version = version
+                stats.table(state)
+        if now >= next_report:
+            next_report += args.interval
+            print(stats.report(args), flush=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Put an emulated WAN (delay, jitter, loss, stalls, bandwidth cap) "
+                                                 "between clients and the server, and report how play degrades.")
+    parser.add_argument("ip", help="Server to proxy to.")
+    parser.add_argument("--server-port", type=int, default=monitor.SERVER_PORT)
+    parser.add_argument("--port", type=int, default=PROXY_PORT, help="Port clients connect to.")
+    parser.add_argument("--delay", type=float, default=50.0, help="One way delay in ms.")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Standard deviation of the delay in ms.")
+    parser.add_argument("--loss", type=float, default=0.0,
+                        help="Chance a chunk is 'lost' and delayed by a retransmit (" + str(RETRANSMIT_DELAY) + "s).")
+    parser.add_argument("--stall-rate", type=float, default=0.0, help="Chance a chunk stalls the link.")
+    parser.add_argument("--stall-time", type=float, default=1.0, help="Length of a stall in seconds.")
+    parser.add_argument("--bandwidth", type=int, default=0, help="Cap in kbit/s each way, per connection (0 = none).")
+    parser.add_argument("--interval", type=float, default=REPORT_INTERVAL, help="Seconds between reports.")
+    parser.add_argument("--no-monitor", action="store_true", help="Don't watch the server's own statistics.")
+    RunProxy(parser.parse_args())